@@ -26,19 +26,37 @@
 
 
 import os
+import shutil
+import tempfile
+from collections import OrderedDict
+from contextlib import contextmanager
+from time import time
 
 from .extractor import (
     extract_captions,
     extract_context,
+    get_image_options,
 )
 from .converter import convert_images, untar, detect_images_and_tex
 from .output_utils import (
+    keep_figure_files,
     prepare_image_data,
 )
+from .config import CFG_PLOTEXTRACTOR_PNG_PRESET, CFG_PLOTEXTRACTOR_PROFILER
 from .errors import NoTexFilesFound
+from .pipeline import run_pipeline
+from .profiling import profiled
+from .sinks import Uploader
 
 
-def process_tarball(tarball, output_directory=None, context=False):
+def process_tarball(tarball, output_directory=None, context=False,
+                    postprocess=None, timings=None, profile=None,
+                    profile_directory=None,
+                    profiler=CFG_PLOTEXTRACTOR_PROFILER, pipeline=False,
+                    keep_originals=True, cleanup=None,
+                    scratch_directory=None, sink=None,
+                    png_preset=CFG_PLOTEXTRACTOR_PNG_PRESET,
+                    vector_format=None):
     """Process one tarball end-to-end.
 
     If output directory is given, the tarball will be extracted there.
@@ -61,37 +79,223 @@ def process_tarball(tarball, output_directory=None, context=False):
         (optional)
     :param: context: if True, also try to extract context where images are
         referenced in the text. (optional)
+    :param: postprocess ([string, ...]): post-processing to apply on the
+        images while converting them, among ``'flatten'`` (transparency),
+        ``'trim'`` (borders) and ``'grayscale'`` (detection). The images then
+        also get their ``width``, ``height``, ``bbox`` and ``grayscale``.
+        Requires numpy. (optional)
+    :param: timings (dict): filled with the time spent in every stage
+        (``untar``, ``detect``, ``convert`` and ``extract``), in seconds.
+        (optional)
+    :param: profile (float): profile the processing, and keep the profile
+        if it took at least that many seconds, as ``<tarball name>.prof``
+        (optional)
+    :param: profile_directory (string): where to write the profile (by
+        default next to the output directory)
+    :param: profiler (string): ``'cprofile'``, or ``'pyinstrument'`` for an
+        HTML report, see :mod:`plotextractor.profiling`
+    :param: pipeline (bool): convert the images and read the TeX files while
+        the tarball is being extracted, see :mod:`plotextractor.pipeline`.
+        The timings are then ``untar``, ``convert`` (the time waiting for
+        the conversions after that) and ``extract``. (optional)
+    :param: keep_originals (bool): if False, images are converted from the
+        bytes of the tarball and their original is not written to disk, so
+        their ``original_url`` does not exist. Implies ``pipeline``.
+        (optional)
+    :param: cleanup (string): once the figures are found, remove all the
+        other files from the output directory: ``'figures'`` only keeps the
+        ``url`` of every figure, ``'originals'`` also keeps its
+        ``original_url``. (optional)
+    :param: scratch_directory (string): extract the tarball in a temporary
+        directory in there, for instance on a tmpfs, and only move the files
+        kept by ``cleanup`` (``'figures'`` by default) to the output
+        directory. (optional)
+    :param: sink: where to upload the converted images while the others are
+        being converted, see :mod:`plotextractor.sinks`. The ``url`` of the
+        figures is then their url in the sink, and ``cleanup`` does not
+        keep them on disk. (optional)
+    :param: png_preset (string): how to encode the converted images,
+        ``'fast'``, ``'balanced'`` or ``'small'`` (which reduces them to 256
+        colors), see :func:`~plotextractor.converter.set_png_preset`
+    :param: vector_format (string): ``'svg'`` or ``'pdf'`` to convert the
+        PDF and EPS images to that format instead of rasterizing them, when
+        the tools for it are installed, see
+        :func:`~plotextractor.converter.convert_vector_image`. Their ``url``
+        is then the vector image. (optional)
     :return: images(list): list of dictionaries for each image with captions.
     """
     if not output_directory:
         # No directory given, so we use the same path as the tarball
         output_directory = os.path.abspath("{0}_files".format(tarball))
 
-    extracted_files_list = untar(tarball, output_directory)
-    image_list, tex_files = detect_images_and_tex(extracted_files_list)
+    if cleanup not in (None, 'figures', 'originals'):
+        raise ValueError('Unknown cleanup {0!r}'.format(cleanup))
+
+    if timings is None:
+        timings = {}
+
+    if profile_directory is None:
+        profile_directory = os.path.dirname(output_directory)
+
+    if scratch_directory is None:
+        return _process_tarball(
+            tarball, output_directory, context, postprocess, timings,
+            profile, profile_directory, profiler, pipeline, keep_originals,
+            cleanup, sink, png_preset, vector_format)
+
+    working_directory = tempfile.mkdtemp(
+        prefix='{0}_'.format(os.path.basename(tarball)),
+        dir=scratch_directory)
+    try:
+        figures = _process_tarball(
+            tarball, working_directory, context, postprocess, timings,
+            profile, profile_directory, profiler, pipeline, keep_originals,
+            None, sink, png_preset, vector_format)
+        # moving the figure files out also cleans up the rest
+        with timed(timings, 'cleanup'):
+            keep_figure_files(
+                figures, working_directory, output_directory,
+                originals=cleanup == 'originals')
+        return figures
+    finally:
+        shutil.rmtree(working_directory, ignore_errors=True)
+
+
+def _process_tarball(tarball, output_directory, context, postprocess,
+                     timings, profile, profile_directory, profiler, pipeline,
+                     keep_originals, cleanup, sink, png_preset,
+                     vector_format):
+    image_metadata = {}
+    parsed_tex_files = {}
+    image_options = {}
+    uploader = urls = rotated_images = None
+    if sink is not None:
+        uploader = Uploader(sink, output_directory)
+        # rotated once uploaded, so uploaded again
+        rotated_images = set()
+    with profiled(tarball, profile_directory, profile, profiler):
+        converted = False
+        try:
+            converted_image_mapping, tex_files = _convert_tarball(
+                tarball, output_directory, postprocess, timings, pipeline,
+                keep_originals, image_metadata, parsed_tex_files,
+                image_options, uploader, png_preset, vector_format)
+            converted = True
+        finally:
+            if uploader is not None:
+                with timed(timings, 'upload'):
+                    try:
+                        urls = uploader.wait()
+                    except Exception:
+                        # the error of the conversion is the one to raise
+                        if converted:
+                            raise
+        with timed(timings, 'extract'):
+            figures = map_images_in_tex(
+                tex_files,
+                converted_image_mapping,
+                output_directory,
+                context,
+                image_metadata=image_metadata,
+                parsed_tex_files=parsed_tex_files,
+                urls=urls,
+                image_options=image_options,
+                rotated_images=rotated_images
+            )
+        if rotated_images:
+            with timed(timings, 'upload'):
+                for rotated_image in sorted(rotated_images):
+                    uploader.submit(rotated_image)
+                uploader.wait()
+        if cleanup is not None:
+            with timed(timings, 'cleanup'):
+                keep_figure_files(
+                    figures, output_directory,
+                    originals=cleanup == 'originals')
+    return figures
+
+
+def _convert_tarball(tarball, output_directory, postprocess, timings,
+                     pipeline, keep_originals, image_metadata,
+                     parsed_tex_files, image_options, uploader, png_preset,
+                     vector_format):
+    """Untar the tarball and convert its images."""
+    if pipeline or not keep_originals:
+        converted_image_mapping, tex_files = run_pipeline(
+            tarball,
+            output_directory,
+            postprocess=postprocess,
+            image_metadata=image_metadata,
+            parsed_tex_files=parsed_tex_files,
+            timings=timings,
+            keep_originals=keep_originals,
+            uploader=uploader,
+            png_preset=png_preset,
+            vector_format=vector_format,
+            image_options=image_options
+        )
+        if not tex_files:
+            raise NoTexFilesFound(
+                "No TeX files found in {0}".format(tarball))
+    else:
+        with timed(timings, 'untar'):
+            extracted_files_list = untar(tarball, output_directory)
+        with timed(timings, 'detect'):
+            image_list, tex_files = detect_images_and_tex(
+                extracted_files_list)
+
+        if tex_files == [] or tex_files is None:
+            raise NoTexFilesFound(
+                "No TeX files found in {0}".format(tarball))
+
+        with timed(timings, 'convert'):
+            image_options.update(get_image_options(
+                tex_files,
+                image_list,
+                output_directory,
+                parsed_tex_files=parsed_tex_files
+            ))
+            converted_image_mapping = convert_images(
+                image_list,
+                postprocess=postprocess,
+                image_metadata=image_metadata,
+                graphics_options=image_options,
+                uploader=uploader,
+                png_preset=png_preset,
+                vector_format=vector_format
+            )
+    return converted_image_mapping, tex_files
 
-    if tex_files == [] or tex_files is None:
-        raise NoTexFilesFound("No TeX files found in {0}".format(tarball))
 
-    converted_image_mapping = convert_images(image_list)
-    return map_images_in_tex(
-        tex_files,
-        converted_image_mapping,
-        output_directory,
-        context
-    )
+@contextmanager
+def timed(timings, stage):
+    """Add the time spent in the block to the timings of a stage."""
+    start = time()
+    try:
+        yield
+    finally:
+        timings[stage] = timings.get(stage, 0) + time() - start
 
 
 def map_images_in_tex(tex_files, image_mapping,
-                      output_directory, context=False):
+                      output_directory, context=False, image_metadata=None,
+                      parsed_tex_files=None, urls=None, image_options=None,
+                      rotated_images=None):
     """Return caption and context for image references found in TeX sources."""
     extracted_image_data = []
+    # shared between all TeX files, so that files included from several of
+    # them are only parsed once and each image only shows up once
+    if parsed_tex_files is None:
+        parsed_tex_files = {}
+    prepared_images = OrderedDict()
     for tex_file in tex_files:
         # Extract images, captions and labels based on tex file and images
         partly_extracted_image_data = extract_captions(
             tex_file,
             output_directory,
-            image_mapping.keys()
+            image_mapping.keys(),
+            parsed_tex_files=parsed_tex_files,
+            rotated_images=rotated_images
         )
         if partly_extracted_image_data:
             # Convert to dict, add proper filepaths and do various cleaning
@@ -99,6 +303,10 @@ def map_images_in_tex(tex_files, image_mapping,
                 partly_extracted_image_data,
                 output_directory,
                 image_mapping,
+                prepared_images=prepared_images,
+                image_metadata=image_metadata,
+                urls=urls,
+                image_options=image_options,
             )
             if context:
                 # Using prev. extracted info, get contexts for each image found
@@ -106,4 +314,4 @@ def map_images_in_tex(tex_files, image_mapping,
 
             extracted_image_data.extend(cleaned_image_data)
 
-    return extracted_image_data
+    return [figure.to_dict() for figure in extracted_image_data]
@@ -0,0 +1,404 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of plotextractor.
+# Copyright (C) 2020 CERN.
+#
+# plotextractor is free software; you can redistribute it
+# and/or modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# plotextractor is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with plotextractor; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+# MA 02111-1307, USA.
+#
+# In applying this license, CERN does not
+# waive the privileges and immunities granted to it by virtue of its status
+# as an Intergovernmental Organization or submit itself to any jurisdiction.
+
+"""Streaming access to the members of arXiv source archives.
+
+A submission can be a tarball (compressed or not), a zip file, a single
+gzipped TeX file, or any of those with more archives inside. They are all
+read through ``iter_archive_members``, which descends into the nested
+archives while streaming the outer one, so nothing is unpacked twice.
+"""
+
+import io
+import os
+import posixpath
+import tarfile
+import zipfile
+import zlib
+
+from .config import (
+    CFG_PLOTEXTRACTOR_ARCHIVE_LIMITS,
+    CFG_PLOTEXTRACTOR_ARCHIVE_NESTING,
+    CFG_PLOTEXTRACTOR_ARCHIVE_RATIO_MIN_SIZE,
+)
+from .errors import ArchiveLimitExceeded, InvalidTarball
+
+# The errors of reading a corrupt or truncated archive.
+ARCHIVE_ERRORS = (tarfile.TarError, zipfile.BadZipfile, zlib.error, EOFError)
+
+# Enough to see the tar magic, which is at offset 257.
+SNIFF_SIZE = 512
+CHUNK_SIZE = 64 * 1024
+
+GZIP_MAGIC = b'\x1f\x8b'
+ZIP_MAGIC = b'PK\x03\x04'
+BZIP2_MAGIC = b'BZh'
+XZ_MAGIC = b'\xfd7zXZ\x00'
+TAR_MAGIC = b'ustar'
+
+ARCHIVE_EXTENSIONS = ('.tar', '.tgz', '.gz', '.zip', '.bz2', '.xz')
+
+
+class ArchiveMember(object):
+
+    """A file or directory read from an archive.
+
+    ``fileobj`` is only readable until the iteration moves on to the next
+    member, and is ``None`` for directories.
+    """
+
+    __slots__ = ('name', 'fileobj', 'size')
+
+    def __init__(self, name, fileobj=None, size=None):
+        self.name = name
+        self.fileobj = fileobj
+        self.size = size
+
+    @property
+    def isdir(self):
+        return self.fileobj is None
+
+
+class HeadStream(object):
+
+    """Put the bytes read to sniff a stream back in front of it."""
+
+    def __init__(self, fileobj, size=SNIFF_SIZE):
+        self.fileobj = fileobj
+        self.head = fileobj.read(size)
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            data, self.head = self.head + self.fileobj.read(), b''
+            return data
+        data, self.head = self.head[:size], self.head[size:]
+        if len(data) < size:
+            data += self.fileobj.read(size - len(data))
+        return data
+
+
+class GunzipStream(object):
+
+    """Decompress a gzip stream without seeking in it."""
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.buffer = b''
+
+    def _fill(self, size):
+        while size < 0 or len(self.buffer) < size:
+            chunk = b''
+            if self.decompressor is not None:
+                chunk = self.decompressor.unused_data
+                if chunk:
+                    # the end of a member, maybe followed by another one
+                    self.decompressor = None
+            if not chunk:
+                chunk = self.fileobj.read(CHUNK_SIZE)
+            if not chunk:
+                if self.decompressor is not None:
+                    # Python 2 cannot tell, but tarfile still notices a
+                    # truncated tarball
+                    if not getattr(self.decompressor, 'eof', True):
+                        raise EOFError('Truncated gzip member')
+                    self.buffer += self.decompressor.flush()
+                return
+            if self.decompressor is None:
+                # many tools pad gzip files with zeros, which gzip skips
+                chunk = chunk.lstrip(b'\x00')
+                if not chunk:
+                    continue
+                self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            self.buffer += self.decompressor.decompress(chunk)
+
+    def read(self, size=-1):
+        if size is None:
+            size = -1
+        self._fill(size)
+        if size < 0:
+            data, self.buffer = self.buffer, b''
+        else:
+            data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+
+def sniff(head):
+    """Tell the kind of archive from its first bytes.
+
+    :param: head (bytes): the first ``SNIFF_SIZE`` bytes of the file.
+
+    :return: one of ``'gzip'``, ``'zip'``, ``'tar'`` or None.
+    """
+    if head.startswith(GZIP_MAGIC):
+        return 'gzip'
+    if head.startswith(ZIP_MAGIC):
+        return 'zip'
+    if head.startswith(BZIP2_MAGIC) or head.startswith(XZ_MAGIC):
+        # only ever seen around tarballs
+        return 'tar'
+    if head[257:262] == TAR_MAGIC:
+        return 'tar'
+    return None
+
+
+def clean_member_name(name):
+    """Return the relative path to extract a member to, or None if unsafe.
+
+    :param: name (string): the name of the member in its archive.
+    """
+    name = posixpath.normpath(name.replace('\\', '/'))
+    if name in ('.', '..') or name.startswith('../') or \
+            posixpath.isabs(name):
+        return None
+    return name
+
+
+def single_file_name(archive_name):
+    """Name the file a single-file gzip archive decompresses to."""
+    name = posixpath.basename(archive_name)
+    for extension in ('.gz', '.tgz'):
+        if name.endswith(extension) and len(name) > len(extension):
+            return name[:-len(extension)]
+    return name
+
+
+def iter_archive_members(archive,
+                         max_nesting=CFG_PLOTEXTRACTOR_ARCHIVE_NESTING,
+                         limits=None):
+    """Stream the members of an archive, descending into nested ones.
+
+    Members of a nested archive are named relative to the directory the
+    nested archive is in, as if it had been unpacked in place, and the
+    nested archive itself is not yielded. Links, devices and members that
+    would land outside of the archive are skipped.
+
+    :param: archive (string): path to a tarball, zip or gzip file.
+    :param: max_nesting (int): how many levels of nested archives to open;
+        deeper ones are yielded as plain files.
+    :param: limits (dict): overrides of ``CFG_PLOTEXTRACTOR_ARCHIVE_LIMITS``,
+        see :class:`ArchiveGuard` (optional)
+
+    :return: iterator of ``ArchiveMember``.
+
+    :raises: InvalidTarball if the file is not an archive we can read, and
+        ArchiveLimitExceeded as soon as it goes over one of the limits.
+    """
+    with open(archive, 'rb') as fileobj:
+        counter = CountingStream(fileobj)
+        stream = HeadStream(counter)
+        kind = sniff(stream.head)
+        if kind is None:
+            raise InvalidTarball
+        if kind == 'zip':
+            # the directory of a zip file is at its end, let zipfile seek
+            compressed_size = os.path.getsize(archive)
+            guard = ArchiveGuard(limits, lambda: compressed_size)
+            members = _iter_zip(archive, '', max_nesting, guard)
+        else:
+            guard = ArchiveGuard(limits, lambda: counter.count)
+            members = _iter_stream(
+                stream, kind, os.path.basename(archive), '', max_nesting,
+                guard)
+        try:
+            for member in members:
+                yield member
+        except ARCHIVE_ERRORS:
+            raise InvalidTarball
+
+
+class ArchiveGuard(object):
+
+    """Enforce the limits of an archive while its members are read.
+
+    The limits are the number of ``members`` (nested ones included), their
+    total uncompressed ``size`` and the ``member_size`` of each, in bytes,
+    the ``depth`` of their paths and the compression ``ratio`` of the
+    archive. The sizes are checked both against what the headers declare,
+    which stops most bombs before any of their content is read, and
+    against what is actually read. None disables a limit.
+    """
+
+    def __init__(self, limits=None, compressed_size=None):
+        """Start guarding an archive.
+
+        :param: limits (dict): overrides of
+            ``CFG_PLOTEXTRACTOR_ARCHIVE_LIMITS`` (optional)
+        :param: compressed_size (callable): returns how much of the archive
+            file has been read so far, for the compression ratio (optional)
+        """
+        self.limits = dict(CFG_PLOTEXTRACTOR_ARCHIVE_LIMITS)
+        if limits:
+            self.limits.update(limits)
+        self.compressed_size = compressed_size
+        self.members = 0
+        self.declared_size = 0
+        self.size = 0
+
+    def check(self, limit, value):
+        """Raise ArchiveLimitExceeded if value is over the limit."""
+        maximum = self.limits.get(limit)
+        if maximum is not None and value > maximum:
+            raise ArchiveLimitExceeded(limit, value, maximum)
+
+    def add_member(self, name, size=None, archive=False):
+        """Check a new member against the limits, from its header.
+
+        :param: name (string): the path of the member
+        :param: size (int): its declared size, if known
+        :param: archive (bool): whether the member is a nested archive, whose
+            size is not added to the total as its members will be
+        """
+        self.members += 1
+        self.check('members', self.members)
+        self.check('depth', name.count('/') + 1)
+        if size is not None:
+            self.check('member_size', size)
+            if not archive:
+                self.declared_size += size
+                self.check('size', self.declared_size)
+
+    def add_bytes(self, count, member_size):
+        """Check the bytes read from a member against the limits.
+
+        :param: count (int): how many bytes were just read
+        :param: member_size (int): how many were read from the member so far
+        """
+        self.size += count
+        self.check('member_size', member_size)
+        self.check('size', self.size)
+        if self.compressed_size is not None and \
+                self.size >= CFG_PLOTEXTRACTOR_ARCHIVE_RATIO_MIN_SIZE:
+            self.check(
+                'ratio', float(self.size) / max(self.compressed_size(), 1))
+
+
+class CountingStream(object):
+
+    """Count the bytes read from a stream."""
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.count = 0
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.count += len(data)
+        return data
+
+
+class GuardedStream(object):
+
+    """Report the bytes read from a member to the guard of its archive.
+
+    Corrupt or truncated data raises InvalidTarball, as it does while
+    iterating over the members.
+    """
+
+    def __init__(self, fileobj, guard):
+        self.fileobj = fileobj
+        self.guard = guard
+        self.count = 0
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            # in chunks, so that a bomb is caught before it fills the memory
+            return b''.join(iter(lambda: self.read(CHUNK_SIZE), b''))
+        try:
+            data = self.fileobj.read(size)
+        except ARCHIVE_ERRORS:
+            raise InvalidTarball
+        self.count += len(data)
+        self.guard.add_bytes(len(data), self.count)
+        return data
+
+
+def _iter_stream(stream, kind, name, prefix, max_nesting, guard):
+    if kind == 'gzip':
+        stream = HeadStream(GunzipStream(stream))
+        if sniff(stream.head) != 'tar':
+            member_name = posixpath.join(prefix, single_file_name(name))
+            guard.add_member(member_name)
+            yield ArchiveMember(member_name, GuardedStream(stream, guard))
+            return
+        kind = 'tar'
+
+    tarball = tarfile.open(fileobj=stream, mode='r|*')
+    for info in tarball:
+        member_name = clean_member_name(info.name)
+        if member_name is None:
+            continue
+        member_name = posixpath.join(prefix, member_name)
+        if info.isdir():
+            guard.add_member(member_name)
+            yield ArchiveMember(member_name)
+        elif info.isfile():
+            for member in _expand(tarball.extractfile(info), member_name,
+                                  info.size, max_nesting, guard):
+                yield member
+
+
+def _iter_zip(fileobj, prefix, max_nesting, guard):
+    with zipfile.ZipFile(fileobj) as archive:
+        for info in archive.infolist():
+            member_name = clean_member_name(info.filename)
+            if member_name is None:
+                continue
+            member_name = posixpath.join(prefix, member_name)
+            if info.filename.endswith('/'):
+                guard.add_member(member_name)
+                yield ArchiveMember(member_name)
+                continue
+            with archive.open(info) as member_file:
+                for member in _expand(member_file, member_name,
+                                      info.file_size, max_nesting, guard):
+                    yield member
+
+
+def _expand(fileobj, name, size, max_nesting, guard):
+    """Yield a member, or the members inside it if it is an archive."""
+    if max_nesting <= 0 or not name.lower().endswith(ARCHIVE_EXTENSIONS):
+        guard.add_member(name, size)
+        yield ArchiveMember(name, GuardedStream(fileobj, guard), size)
+        return
+
+    stream = HeadStream(fileobj)
+    kind = sniff(stream.head)
+    prefix = posixpath.dirname(name)
+    if kind is None:
+        guard.add_member(name, size)
+        yield ArchiveMember(name, GuardedStream(stream, guard), size)
+        return
+
+    guard.add_member(name, size, archive=True)
+    if kind == 'zip':
+        # buffered whole for zipfile to seek in, so its bytes count too
+        members = _iter_zip(
+            io.BytesIO(GuardedStream(stream, guard).read()), prefix,
+            max_nesting - 1, guard)
+    else:
+        members = _iter_stream(
+            stream, kind, name, prefix, max_nesting - 1, guard)
+    for member in members:
+        yield member
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of plotextractor.
+# Copyright (C) 2020 CERN.
+#
+# plotextractor is free software; you can redistribute it
+# and/or modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# plotextractor is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with plotextractor; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+# MA 02111-1307, USA.
+#
+# In applying this license, CERN does not
+# waive the privileges and immunities granted to it by virtue of its status
+# as an Intergovernmental Organization or submit itself to any jurisdiction.
+
+"""Compare the size and encoding time of the PNG presets.
+
+Every image of the tarballs that would be converted is read once, then
+encoded with each preset::
+
+    $ python -m plotextractor.benchmark ./tarballs/ -p fast -p small
+    preset      figures   bytes/figure   ms/figure
+    fast             22         184320        12.4
+    small            22          41287        61.0
+
+The encoding time includes the palette quantization of the preset, but not
+reading or rasterizing the image, which is the same for all of them.
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+from collections import OrderedDict
+from time import time
+
+from .cli import find_tarballs
+from .config import (
+    CFG_PLOTEXTRACTOR_KEEP_FORMATS,
+    CFG_PLOTEXTRACTOR_MAX_IMAGE_SIZE,
+    CFG_PLOTEXTRACTOR_PNG_PRESETS,
+)
+from .converter import (
+    detect_images_and_tex,
+    fit_image,
+    get_density,
+    get_raster_format,
+    is_oversized,
+    set_png_preset,
+    untar,
+)
+from .errors import InvalidTarball
+from .headers import get_image_size
+
+
+def benchmark_presets(image_files, presets,
+                      max_size=CFG_PLOTEXTRACTOR_MAX_IMAGE_SIZE):
+    """Encode images with every preset.
+
+    :param: image_files ([string, ...]): the images to encode; the ones that
+        would be kept as they are, or cannot be read, are skipped
+    :param: presets ([string, ...]): names of ``CFG_PLOTEXTRACTOR_PNG_PRESETS``
+    :param: max_size (int): the largest width or height of the images
+
+    :return: results ({preset: {'figures', 'bytes', 'seconds'}, ...}): the
+        number of images encoded, and their total size and encoding time
+    """
+    from wand.exceptions import WandException
+    from wand.image import Image
+
+    results = OrderedDict(
+        (preset, {'figures': 0, 'bytes': 0, 'seconds': 0.0})
+        for preset in presets)
+    for image_file in image_files:
+        if get_raster_format(image_file) in CFG_PLOTEXTRACTOR_KEEP_FORMATS:
+            continue
+        image_size = get_image_size(image_file)
+        if is_oversized(image_size):
+            continue
+        try:
+            resolution = get_density(image_size, max_size)
+            with Image(filename='%s[0]' % image_file,
+                       resolution=resolution) as original:
+                fit_image(original, max_size)
+                with original.convert('png') as converted:
+                    for preset in presets:
+                        with converted.clone() as image:
+                            start = time()
+                            set_png_preset(image, preset)
+                            blob = image.make_blob()
+                            elapsed = time() - start
+                        result = results[preset]
+                        result['figures'] += 1
+                        result['bytes'] += len(blob)
+                        result['seconds'] += elapsed
+        except WandException:
+            continue
+    return results
+
+
+def format_report(results):
+    """Return the bytes and milliseconds per figure of every preset."""
+    lines = ['{0:<10}{1:>9}{2:>15}{3:>12}'.format(
+        'preset', 'figures', 'bytes/figure', 'ms/figure')]
+    for preset, result in results.items():
+        figures = result['figures']
+        lines.append('{0:<10}{1:>9}{2:>15}{3:>12.1f}'.format(
+            preset, figures, result['bytes'] // max(figures, 1),
+            1000 * result['seconds'] / max(figures, 1)))
+    return '\n'.join(lines) + '\n'
+
+
+def get_parser():
+    """Return the parser of the command-line arguments."""
+    parser = argparse.ArgumentParser(
+        prog='python -m plotextractor.benchmark',
+        description='Compare the PNG presets on the images of tarballs.',
+    )
+    parser.add_argument(
+        'paths', nargs='+', metavar='PATH',
+        help='tarballs, or directories of tarballs')
+    parser.add_argument(
+        '-p', '--preset', action='append',
+        choices=sorted(CFG_PLOTEXTRACTOR_PNG_PRESETS),
+        help='preset to compare, can be repeated (default: all of them)')
+    return parser
+
+
+def main(argv=None):
+    """Run the benchmark from the command line."""
+    args = get_parser().parse_args(argv)
+    presets = args.preset or sorted(CFG_PLOTEXTRACTOR_PNG_PRESETS)
+    image_files = []
+    directory = tempfile.mkdtemp()
+    try:
+        for index, tarball in enumerate(find_tarballs(args.paths)):
+            try:
+                extracted_files = untar(
+                    tarball, os.path.join(directory, str(index)))
+            except InvalidTarball:
+                continue
+            image_files.extend(detect_images_and_tex(extracted_files)[0])
+        sys.stdout.write(format_report(
+            benchmark_presets(image_files, presets)))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
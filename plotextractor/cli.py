@@ -0,0 +1,337 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of plotextractor.
+# Copyright (C) 2015, 2020 CERN.
+#
+# plotextractor is free software; you can redistribute it
+# and/or modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# plotextractor is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with plotextractor; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+# MA 02111-1307, USA.
+#
+# In applying this license, CERN does not
+# waive the privileges and immunities granted to it by virtue of its status
+# as an Intergovernmental Organization or submit itself to any jurisdiction.
+
+"""Command-line batch runner."""
+
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+from multiprocessing import Pool
+from time import time
+
+import six
+
+from .api import process_tarball
+from .archive import ARCHIVE_EXTENSIONS
+from .config import (
+    CFG_PLOTEXTRACTOR_PNG_PRESET,
+    CFG_PLOTEXTRACTOR_PNG_PRESETS,
+    CFG_PLOTEXTRACTOR_PROFILER,
+)
+from .profiling import PROFILE_EXTENSIONS
+
+# the submissions untar reads: tarballs, zip files and gzipped TeX files
+TARBALL_EXTENSIONS = ARCHIVE_EXTENSIONS
+
+
+def find_tarballs(paths):
+    """Return the tarballs to process, looking into the directories.
+
+    :param: paths ([string, ...]): tarballs and directories of tarballs
+
+    :return: tarballs ([string, ...]): absolute paths of the tarballs
+    """
+    tarballs = []
+    for path in paths:
+        if os.path.isdir(path):
+            tarballs.extend(
+                os.path.join(path, file_name)
+                for file_name in sorted(os.listdir(path))
+                if file_name.endswith(TARBALL_EXTENSIONS)
+            )
+        else:
+            tarballs.append(path)
+    return [os.path.abspath(tarball) for tarball in tarballs]
+
+
+def in_shard(tarball, shard, shards):
+    """Tell whether a tarball belongs to a shard.
+
+    Tarballs are spread between the shards by the hash of their name, so
+    that every machine gets the same share whatever its paths.
+    """
+    name = six.ensure_binary(os.path.basename(tarball))
+    return int(hashlib.md5(name).hexdigest(), 16) % shards == shard
+
+
+def read_checkpoint(output):
+    """Return the tarballs already processed in a JSON lines output.
+
+    A line left half written by a crash is dropped.
+
+    :param: output (string): path of the JSON lines file
+
+    :return: tarballs (set): the tarballs with a record in the output
+    """
+    done = set()
+    if not os.path.exists(output):
+        return done
+
+    complete_size = 0
+    with open(output, 'rb') as stream:
+        for line in stream:
+            if not line.endswith(b'\n'):
+                break
+            try:
+                done.add(json.loads(line.decode('utf-8'))['tarball'])
+            except (ValueError, KeyError):
+                pass
+            complete_size += len(line)
+    with open(output, 'ab') as stream:
+        stream.truncate(complete_size)
+    return done
+
+
+def process_one(job):
+    """Process one tarball and return its record.
+
+    :param: job ((string, dict)): the tarball, and the keyword arguments of
+        :func:`~plotextractor.api.process_tarball`
+
+    :return: record (dict): the ``tarball``, its ``figures`` or ``error``,
+        and the ``timings`` of every stage, in seconds
+    """
+    tarball, options = job
+    record = {'tarball': tarball}
+    timings = {}
+    start = time()
+    try:
+        record['figures'] = process_tarball(
+            tarball, timings=timings, **options)
+    except Exception as err:
+        record['error'] = {
+            'type': err.__class__.__name__,
+            'message': six.text_type(err),
+        }
+    timings['total'] = time() - start
+    record['timings'] = timings
+    return record
+
+
+def run_batch(tarballs, output, workers=1, output_directory=None,
+              context=False, shard=0, shards=1, profile=None,
+              profile_directory=None, profiler=CFG_PLOTEXTRACTOR_PROFILER,
+              pipeline=False, keep_originals=True, cleanup=None,
+              scratch_directory=None,
+              png_preset=CFG_PLOTEXTRACTOR_PNG_PRESET, vector_format=None):
+    """Process tarballs, writing one JSON line per tarball to output.
+
+    The tarballs already in output are skipped, so that a crashed run can
+    be resumed by running it again.
+
+    :param: tarballs ([string, ...]): paths of the tarballs
+    :param: output (string): path of the JSON lines file
+    :param: workers (int): number of worker processes
+    :param: output_directory (string): where to extract every tarball, in a
+        ``<tarball name>_files`` directory (by default next to the tarball)
+    :param: context (bool): also extract the context of the figures
+    :param: shard (int): which shard of the tarballs to process
+    :param: shards (int): in how many shards the tarballs are split
+    :param: profile (float): keep the profile of the tarballs that took at
+        least that many seconds, see :mod:`plotextractor.profiling`
+    :param: profile_directory (string): where to write the profiles (by
+        default next to output)
+    :param: profiler (string): ``'cprofile'`` or ``'pyinstrument'``
+    :param: pipeline (bool): overlap the stages of every tarball, see
+        :mod:`plotextractor.pipeline`
+    :param: keep_originals (bool): also write the images that are converted
+    :param: cleanup (string): ``'figures'`` or ``'originals'``, the files to
+        keep in the output directory of every tarball
+    :param: scratch_directory (string): where to extract the tarballs before
+        moving their figures to the output directory
+    :param: png_preset (string): how to encode the converted images
+    :param: vector_format (string): ``'svg'`` or ``'pdf'`` to keep vector
+        images as vectors
+
+    :return: (processed, failed) (int, int): number of tarballs processed,
+        and how many of them failed
+    """
+    done = read_checkpoint(output)
+    jobs = []
+    for tarball in tarballs:
+        if tarball in done or not in_shard(tarball, shard, shards):
+            continue
+        options = {'context': context}
+        if pipeline:
+            options['pipeline'] = True
+        if not keep_originals:
+            options['keep_originals'] = False
+        if cleanup is not None:
+            options['cleanup'] = cleanup
+        if scratch_directory is not None:
+            options['scratch_directory'] = scratch_directory
+        if png_preset != CFG_PLOTEXTRACTOR_PNG_PRESET:
+            options['png_preset'] = png_preset
+        if vector_format is not None:
+            options['vector_format'] = vector_format
+        if profile is not None:
+            options.update(
+                profile=profile,
+                profile_directory=profile_directory or os.path.dirname(
+                    os.path.abspath(output)),
+                profiler=profiler,
+            )
+        if output_directory:
+            options['output_directory'] = os.path.join(
+                output_directory,
+                '{0}_files'.format(os.path.basename(tarball)))
+        jobs.append((tarball, options))
+
+    pool = None
+    if workers > 1:
+        pool = Pool(workers)
+        records = pool.imap_unordered(process_one, jobs)
+    else:
+        records = (process_one(job) for job in jobs)
+
+    processed = failed = 0
+    try:
+        with open(output, 'a') as stream:
+            for record in records:
+                stream.write(json.dumps(record, sort_keys=True) + '\n')
+                stream.flush()
+                os.fsync(stream.fileno())
+                processed += 1
+                failed += 'error' in record
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+    return processed, failed
+
+
+def parse_shard(value):
+    """Parse a ``SHARD/SHARDS`` option, like ``0/4``."""
+    try:
+        shard, shards = (int(part) for part in value.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            'expected SHARD/SHARDS, got {0!r}'.format(value))
+    if not 0 <= shard < shards:
+        raise argparse.ArgumentTypeError(
+            'shard must be between 0 and {0}'.format(shards - 1))
+    return shard, shards
+
+
+def get_parser():
+    """Return the parser of the command-line arguments."""
+    parser = argparse.ArgumentParser(
+        prog='plotextractor',
+        description='Extract the figures of tarballs, one JSON line each.',
+    )
+    parser.add_argument(
+        'paths', nargs='+', metavar='PATH',
+        help='tarballs, or directories of tarballs, to process')
+    parser.add_argument(
+        '-o', '--output', required=True,
+        help='JSON lines file to append to; tarballs already in it are '
+             'skipped')
+    parser.add_argument(
+        '-j', '--workers', type=int, default=1,
+        help='number of worker processes (default: %(default)s)')
+    parser.add_argument(
+        '-d', '--output-directory',
+        help='where to extract the tarballs (default: next to them)')
+    parser.add_argument(
+        '-c', '--context', action='store_true',
+        help='also extract the context of the figures')
+    parser.add_argument(
+        '--shard', type=parse_shard, default=(0, 1), metavar='SHARD/SHARDS',
+        help='only process this shard of the tarballs, like 0/4')
+    parser.add_argument(
+        '--pipeline', action='store_true',
+        help='convert the images while the tarballs are being extracted')
+    parser.add_argument(
+        '--discard-originals', action='store_true',
+        help='convert the images from the tarballs without writing the '
+             'originals to disk (implies --pipeline)')
+    parser.add_argument(
+        '--cleanup', choices=('figures', 'originals'),
+        help='only keep the figures (and their originals) in the output '
+             'directory')
+    parser.add_argument(
+        '--scratch-directory',
+        help='extract the tarballs in there, for instance on a tmpfs, and '
+             'only move their figures to the output directory')
+    parser.add_argument(
+        '--png-preset', choices=sorted(CFG_PLOTEXTRACTOR_PNG_PRESETS),
+        default=CFG_PLOTEXTRACTOR_PNG_PRESET,
+        help='fast, balanced, or small (256 colors) PNGs '
+             '(default: %(default)s)')
+    parser.add_argument(
+        '--vector-format', choices=('pdf', 'svg'),
+        help='convert PDF and EPS images to SVG (with pdftocairo and '
+             'dvisvgm) or PDF (with gs) instead of rasterizing them')
+    parser.add_argument(
+        '--profile', type=float, metavar='SECONDS',
+        help='profile the tarballs, and keep the profiles of the ones that '
+             'took at least SECONDS as <tarball name>.prof')
+    parser.add_argument(
+        '--profile-directory',
+        help='where to write the profiles (default: next to the output)')
+    parser.add_argument(
+        '--profiler', choices=sorted(PROFILE_EXTENSIONS),
+        default=CFG_PLOTEXTRACTOR_PROFILER,
+        help='cprofile, which includes the conversion and upload threads, '
+             'or pyinstrument for HTML reports of the main thread only '
+             '(default: %(default)s)')
+    return parser
+
+
+def main(argv=None):
+    """Run the batch runner from the command line.
+
+    :return: the exit status, 1 if any tarball failed.
+    """
+    args = get_parser().parse_args(argv)
+    shard, shards = args.shard
+    processed, failed = run_batch(
+        find_tarballs(args.paths),
+        args.output,
+        workers=args.workers,
+        output_directory=args.output_directory,
+        context=args.context,
+        shard=shard,
+        shards=shards,
+        profile=args.profile,
+        profile_directory=args.profile_directory,
+        profiler=args.profiler,
+        pipeline=args.pipeline,
+        keep_originals=not args.discard_originals,
+        cleanup=args.cleanup,
+        scratch_directory=args.scratch_directory,
+        png_preset=args.png_preset,
+        vector_format=args.vector_format,
+    )
+    sys.stderr.write(
+        '{0} tarballs processed, {1} failed\n'.format(processed, failed))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
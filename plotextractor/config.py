@@ -43,3 +43,115 @@ CFG_PLOTEXTRACTOR_DISALLOWED_TEX = [
     'begin', 'end', 'section', 'includegraphics', 'caption',
     'acknowledgements',
 ]
+
+# ImageMagick limits (in bytes, pixels for area) for the whole node, divided
+# between CFG_PLOTEXTRACTOR_CONVERSION_WORKERS concurrent conversions.
+# None leaves the ImageMagick default.
+CFG_PLOTEXTRACTOR_RESOURCE_BUDGET = {
+    'memory': None,
+    'map': None,
+    'disk': None,
+    'area': None,
+    'thread': None,
+}
+
+CFG_PLOTEXTRACTOR_CONVERSION_WORKERS = 1
+
+# How far (0-255) from the background color a channel can be to be trimmed.
+CFG_PLOTEXTRACTOR_TRIM_FUZZ = 8
+
+# How far (0-255) apart the RGB channels of a pixel can be to be gray.
+CFG_PLOTEXTRACTOR_GRAYSCALE_TOLERANCE = 2
+
+CFG_PLOTEXTRACTOR_CLASSIFICATION_WORKERS = 1
+
+# How many levels of archives inside the submission archive are unpacked.
+CFG_PLOTEXTRACTOR_ARCHIVE_NESTING = 2
+
+# Raster formats served as they are instead of being converted to PNG.
+# Earlier versions converted everything, set to ('png',) to keep doing so.
+CFG_PLOTEXTRACTOR_KEEP_FORMATS = ('png', 'jpeg', 'webp')
+
+# Largest width or height of converted images, in pixels.
+CFG_PLOTEXTRACTOR_MAX_IMAGE_SIZE = 4096
+
+# Rasters with more pixels than this are not converted at all.
+CFG_PLOTEXTRACTOR_MAX_INPUT_PIXELS = 10000 * 10000
+
+# Profiler of the slow tarballs, 'cprofile' or 'pyinstrument'.
+CFG_PLOTEXTRACTOR_PROFILER = 'cprofile'
+
+# How many pieces of an image name that cannot be found as a whole are
+# looked up, at most.
+CFG_PLOTEXTRACTOR_IMAGE_LOCATION_PIECES = 64
+
+# How many files can wait for each stage of the pipeline.
+CFG_PLOTEXTRACTOR_PIPELINE_QUEUE_SIZE = 32
+
+# Limits of the tarballs, enforced while they are read: number of members,
+# total and per member uncompressed size in bytes, depth of the paths and
+# compression ratio. None disables a limit.
+CFG_PLOTEXTRACTOR_ARCHIVE_LIMITS = {
+    'members': 20000,
+    'size': 4 * 1024 ** 3,
+    'member_size': 1024 ** 3,
+    'depth': 32,
+    'ratio': 100,
+}
+
+# The compression ratio is only checked past this many bytes, in bytes.
+CFG_PLOTEXTRACTOR_ARCHIVE_RATIO_MIN_SIZE = 16 * 1024 ** 2
+
+# How many converted images are uploaded to the sink at the same time.
+CFG_PLOTEXTRACTOR_UPLOAD_WORKERS = 8
+
+# How converted PNGs are encoded: the zlib compression level (0-9), row
+# filter (0-4, or 5 for adaptive) and strategy (0-4), the bit depth and the
+# number of colors to quantize the image to, as a palette. None leaves the
+# ImageMagick default.
+CFG_PLOTEXTRACTOR_PNG_PRESETS = {
+    'fast': {
+        'compression-level': 1,
+        'compression-filter': 0,
+        'compression-strategy': 0,
+        'bit-depth': 8,
+        'colors': None,
+    },
+    'balanced': {
+        'compression-level': 6,
+        'compression-filter': 5,
+        'compression-strategy': 1,
+        'bit-depth': 8,
+        'colors': None,
+    },
+    'small': {
+        'compression-level': 9,
+        'compression-filter': 5,
+        'compression-strategy': 0,
+        'bit-depth': None,
+        'colors': 256,
+    },
+}
+
+CFG_PLOTEXTRACTOR_PNG_PRESET = 'balanced'
+
+# How long the tools converting vector images to SVG or PDF can run for, in
+# seconds, before falling back to rasterizing the image.
+CFG_PLOTEXTRACTOR_VECTOR_TIMEOUT = 60
+
+# The lengths that \includegraphics sizes are relative to, in PostScript
+# points (1/72 inch). Wide enough for the text of most papers.
+CFG_PLOTEXTRACTOR_TEX_LENGTHS = {
+    'textwidth': 470,
+    'linewidth': 470,
+    'columnwidth': 470,
+    'hsize': 470,
+    'textheight': 650,
+    'vsize': 650,
+    'paperwidth': 612,
+    'paperheight': 792,
+}
+
+# How many pixels per inch of their size on the page vector images are
+# rasterized with, when the TeX gives that size.
+CFG_PLOTEXTRACTOR_DISPLAY_DENSITY = 150
@@ -22,179 +22,845 @@
 # waive the privileges and immunities granted to it by virtue of its status
 # as an Intergovernmental Organization or submit itself to any jurisdiction.
 
-"""Functions related to conversion and untarring."""
+"""Functions related to conversion and untarring.
 
+Wand (ImageMagick) and libmagic are only loaded once they are needed, so
+that importing plotextractor stays cheap.
+"""
 
+
+import io
 import os
-import tarfile
 import re
+import shutil
+import subprocess
 import sys
-from time import time
-
-if sys.version_info[0] == 2:
-    from subprocess32 import check_output
-else:
-    from subprocess import check_output
-
-import magic
-from wand.exceptions import MissingDelegateError, ResourceLimitError
-from wand.image import Image
-from wand.resource import limits
-
-from .errors import InvalidTarball
+import threading
+from collections import OrderedDict
+
+from .archive import iter_archive_members
+from .config import (
+    CFG_PLOTEXTRACTOR_CLASSIFICATION_WORKERS,
+    CFG_PLOTEXTRACTOR_DISPLAY_DENSITY,
+    CFG_PLOTEXTRACTOR_KEEP_FORMATS,
+    CFG_PLOTEXTRACTOR_MAX_IMAGE_SIZE,
+    CFG_PLOTEXTRACTOR_MAX_INPUT_PIXELS,
+    CFG_PLOTEXTRACTOR_PNG_PRESET,
+    CFG_PLOTEXTRACTOR_PNG_PRESETS,
+    CFG_PLOTEXTRACTOR_VECTOR_TIMEOUT,
+)
+from .headers import (
+    DOS_EPS_SIGNATURE,
+    JPEG_SIGNATURE,
+    PDF_SIGNATURE,
+    PNG_SIGNATURE,
+    POSTSCRIPT_SIGNATURE,
+    get_image_size,
+    is_vector,
+    read_image_size,
+)
 from .output_utils import get_converted_image_name, get_image_location
-
-
-def untar(original_tarball, output_directory):
+from .profiling import profile_calls
+from .resources import get_resource_governor
+
+# the density ImageMagick rasterizes PDF and PostScript at by default
+DEFAULT_DENSITY = 72
+POINTS_PER_INCH = 72
+
+ALLOWED_IMAGE_TYPES = ('eps', 'png', 'ps', 'jpg', 'pdf')
+
+# what preflight reads of every member, enough for most image headers
+PREFLIGHT_HEAD_SIZE = 64 * 1024
+# an A4 page, in points
+UNKNOWN_IMAGE_SIZE = ('pdf', 595, 842)
+
+# the commands converting a (source, target) vector format, for one page
+# counted from 1. PDF files are served as they are.
+VECTOR_COMMANDS = {
+    ('pdf', 'svg'): [
+        'pdftocairo', '-svg', '-f', '{page}', '-l', '{page}', '{source}',
+        '{target}',
+    ],
+    ('ps', 'svg'): [
+        'dvisvgm', '--eps', '--no-fonts', '--output={target}', '{source}',
+    ],
+    ('ps', 'pdf'): [
+        'gs', '-q', '-dSAFER', '-dBATCH', '-dNOPAUSE', '-dEPSCrop',
+        '-sDEVICE=pdfwrite', '-sOutputFile={target}', '{source}',
+    ],
+}
+VECTOR_OUTPUT_FORMATS = ('svg', 'pdf')
+
+# the sources of the same converted image, from the cheapest to convert,
+# and from the best when the vector images are not rasterized
+SOURCE_PREFERENCE = ('png', 'jpeg', 'webp', 'pdf', 'ps')
+VECTOR_SOURCE_PREFERENCE = ('pdf', 'ps', 'png', 'jpeg', 'webp')
+SOURCE_EXTENSIONS = {
+    '.png': 'png',
+    '.jpg': 'jpeg',
+    '.jpeg': 'jpeg',
+    '.webp': 'webp',
+    '.pdf': 'pdf',
+    '.eps': 'ps',
+    '.ps': 'ps',
+}
+
+
+def untar(original_tarball, output_directory, limits=None):
     """Untar given tarball file into directory.
 
-    Here we decide if our file is actually a tarball, then
-    we untar it and return a list of extracted files.
+    Besides tarballs, zip files and single gzipped files are accepted, and
+    archives found inside are unpacked in place while the outer one is
+    being read.
 
     :param: tarball (string): the name of the tar file from arXiv
     :param: output_directory (string): the directory to untar in
+    :param: limits (dict): overrides of the archive limits, see
+        :class:`~plotextractor.archive.ArchiveGuard` (optional)
 
     :return: list of absolute file paths
+
+    :raises: ArchiveLimitExceeded as soon as the tarball goes over one of
+        the limits.
     """
-    if not tarfile.is_tarfile(original_tarball):
-        raise InvalidTarball
+    return list(iter_untar(original_tarball, output_directory, limits))
 
-    tarball = tarfile.open(original_tarball)
-    # set mtimes of members to now
-    epochsecs = int(time())
-    for member in tarball.getmembers():
-        member.mtime = epochsecs
-    tarball.extractall(output_directory)
 
-    file_list = []
+def iter_untar(original_tarball, output_directory, limits=None):
+    """Untar given tarball file into directory, one member at a time.
 
-    for extracted_file in tarball.getnames():
-        if extracted_file == '':
-            break
-        if extracted_file.startswith('./'):
-            extracted_file = extracted_file[2:]
+    See :func:`untar`.
+
+    :return: iterator of the absolute paths of the members, each one
+        yielded as soon as it has been written.
+    """
+    for member in iter_archive_members(original_tarball, limits=limits):
         # ensure we are actually looking at the right file
-        extracted_file = os.path.join(output_directory, extracted_file)
+        extracted_file = os.path.join(output_directory, member.name)
+        extract_member(member, extracted_file)
+        yield extracted_file
+
+
+def extract_member(member, extracted_file, data=None):
+    """Write a member of a tarball to disk.
+
+    :param: member (ArchiveMember): the member, from
+        :func:`~plotextractor.archive.iter_archive_members`
+    :param: extracted_file (string): where to write it
+    :param: data (bytes): the content of the member, if it was already read
+    """
+    if member.isdir:
+        if not os.path.isdir(extracted_file):
+            os.makedirs(extracted_file)
+        return
+    parent_directory = os.path.dirname(extracted_file)
+    if not os.path.isdir(parent_directory):
+        os.makedirs(parent_directory)
+    with open(extracted_file, 'wb') as output:
+        if data is None:
+            shutil.copyfileobj(member.fileobj, output)
+        else:
+            output.write(data)
+
 
-        # Add to full list of extracted files
-        file_list.append(extracted_file)
+def preflight(original_tarball,
+              keep_formats=CFG_PLOTEXTRACTOR_KEEP_FORMATS,
+              max_size=CFG_PLOTEXTRACTOR_MAX_IMAGE_SIZE, limits=None):
+    """Estimate the cost of processing a tarball without extracting it.
 
-    return file_list
+    The tarball is streamed and only the first bytes of every member are
+    looked at, to classify it and read the size of the images.
+
+    :param: original_tarball (string): the tarball, as for :func:`untar`
+    :param: keep_formats ([string, ...]): the raster formats that are not
+        converted, see :func:`convert_images`
+    :param: max_size (int): the largest width or height of converted images
+    :param: limits (dict): overrides of the archive limits, see
+        :class:`~plotextractor.archive.ArchiveGuard` (optional)
+
+    :return: report (dict) with the number of ``files`` and
+        ``directories``, their uncompressed ``size`` and its ``ratio`` to
+        the size of the tarball, the number of ``tex`` files, of
+        ``images`` by type, of ``conversions`` to do and of ``oversized``
+        images that would be skipped, and the ``cost`` of the conversions,
+        in megapixels to rasterize.
+
+    :raises: InvalidTarball if the file is not an archive we can read, and
+        ArchiveLimitExceeded as soon as it goes over one of the limits.
+    """
+    classifier = FileClassifier(ALLOWED_IMAGE_TYPES)
+    report = {
+        'files': 0,
+        'directories': 0,
+        'size': 0,
+        'tex': 0,
+        'images': {},
+        'conversions': 0,
+        'oversized': 0,
+        'cost': 0.0,
+    }
+    for member in iter_archive_members(original_tarball, limits=limits):
+        if member.isdir:
+            report['directories'] += 1
+            continue
+        report['files'] += 1
+        head = member.fileobj.read(PREFLIGHT_HEAD_SIZE)
+        size = member.size
+        if size is None:
+            # a single gzipped file does not tell its size
+            size = len(head)
+            for chunk in iter(lambda: member.fileobj.read(65536), b''):
+                size += len(chunk)
+        report['size'] += size
+
+        kind = classifier.classify(member.name, head)
+        if kind == 'tex':
+            report['tex'] += 1
+        if kind != 'image':
+            continue
+        image_size = read_image_size(io.BytesIO(head))
+        image_type = image_size[0] if image_size else \
+            os.path.splitext(member.name)[1][1:].lower()
+        report['images'][image_type] = report['images'].get(image_type, 0) + 1
+        if get_raster_format(None, head) in keep_formats:
+            continue
+        if is_oversized(image_size):
+            report['oversized'] += 1
+            continue
+        report['conversions'] += 1
+        report['cost'] += get_conversion_pixels(image_size, max_size) / 1e6
+
+    compressed_size = os.path.getsize(original_tarball)
+    report['ratio'] = float(report['size']) / max(compressed_size, 1)
+    return report
+
+
+def get_conversion_pixels(image_size, max_size):
+    """Estimate how many pixels converting an image rasterizes.
+
+    :param: image_size (tuple): as returned by ``get_image_size``, or None
+        when unknown, in which case a page at the default density is assumed
+    :param: max_size (int): the largest width or height of converted images
+    """
+    if image_size is None:
+        image_size = UNKNOWN_IMAGE_SIZE
+    width, height = image_size[1:]
+    if is_vector(image_size):
+        width = width * DEFAULT_DENSITY / POINTS_PER_INCH
+        height = height * DEFAULT_DENSITY / POINTS_PER_INCH
+    longest_side = max(width, height, 1)
+    if max_size is not None and longest_side > max_size:
+        ratio = float(max_size) / longest_side
+        width, height = width * ratio, height * ratio
+    return width * height
 
 
 def detect_images_and_tex(
         file_list,
-        allowed_image_types=('eps', 'png', 'ps', 'jpg', 'pdf'),
-        timeout=20):
+        allowed_image_types=ALLOWED_IMAGE_TYPES,
+        timeout=20,
+        workers=CFG_PLOTEXTRACTOR_CLASSIFICATION_WORKERS):
     """Detect from a list of files which are TeX or images.
 
+    Files with an unambiguous extension are classified by it, the others
+    with libmagic, in ``workers`` threads.
+
     :param: file_list (list): list of absolute file paths
     :param: allowed_image_types (list): list of allows image formats
     :param: timeout (int): the timeout value on shell commands.
+    :param: workers (int): number of threads classifying the files.
 
     :return: (image_list, tex_file) (([string, string, ...], string)):
         list of images in the tarball and the name of the TeX file in the
-        tarball.
+        tarball, in the order of file_list.
     """
-    tex_file_extension = 'tex'
+    classifier = FileClassifier(allowed_image_types)
+    if workers > 1 and len(file_list) > 1:
+        from multiprocessing.pool import ThreadPool
+
+        pool = ThreadPool(workers)
+        try:
+            kinds = pool.map(profile_calls(classifier.classify), file_list)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        kinds = [classifier.classify(path) for path in file_list]
 
     image_list = []
     might_be_tex = []
+    for extracted_file, kind in zip(file_list, kinds):
+        if kind == 'tex':
+            might_be_tex.append(extracted_file)
+        elif kind == 'image':
+            image_list.append(extracted_file)
+
+    return image_list, might_be_tex
+
+
+class FileClassifier(object):
+
+    """Tell TeX files and images apart, with one libmagic handle per thread."""
 
-    for extracted_file in file_list:
+    tex_file_extension = 'tex'
+    # extensions libmagic would not tell us anything more about
+    unambiguous_image_extensions = ('png', 'jpg', 'pdf')
+
+    def __init__(self, allowed_image_types):
+        self.allowed_image_types = allowed_image_types
+        self._local = threading.local()
+
+    @property
+    def magic(self):
+        """Return the libmagic handle of the current thread."""
+        if not hasattr(self._local, 'magic'):
+            import magic
+
+            self._local.magic = magic.Magic(mime=True)
+        return self._local.magic
+
+    def classify(self, extracted_file, blob=None):
+        """Classify a file.
+
+        :param: extracted_file (string): absolute file path
+        :param: blob (bytes): the content of the file, if it is not on disk
+
+        :return: kind (string): ``'tex'``, ``'image'`` or None
+        """
         # Ignore directories and hidden (metadata) files
         if (re.search(r'[\uD800-\uDFFF]', extracted_file)
                 and sys.version_info[0] == 3):
             # Illegal file path/name
-            continue
-        if os.path.isdir(extracted_file) \
+            return None
+        if (blob is None and os.path.isdir(extracted_file)) \
            or os.path.basename(extracted_file).startswith('.'):
-            continue
+            return None
 
-        magic_str = magic.from_file(extracted_file, mime=True)
+        _, dotted_file_extension = os.path.splitext(extracted_file)
+        file_extension = dotted_file_extension[1:]
+
+        if file_extension == self.tex_file_extension:
+            return 'tex'
+        if file_extension in self.unambiguous_image_extensions \
+                and file_extension in self.allowed_image_types:
+            return 'image'
+
+        if blob is not None:
+            magic_str = self.magic.from_buffer(blob)
+        else:
+            magic_str = self.magic.from_file(extracted_file)
 
         if magic_str == "application/x-tex":
-            might_be_tex.append(extracted_file)
+            return 'tex'
         elif magic_str.startswith('image/') \
                 or magic_str == "application/postscript":
-            image_list.append(extracted_file)
+            return 'image'
 
         # If neither, maybe it is TeX or an image anyway, otherwise,
         # we don't care.
-        else:
-            _, dotted_file_extension = os.path.splitext(extracted_file)
-            file_extension = dotted_file_extension[1:]
+        if file_extension in self.allowed_image_types:
+            return 'image'
+        return None
 
-            if file_extension == tex_file_extension:
-                might_be_tex.append(extracted_file)
-            elif file_extension in allowed_image_types:
-                image_list.append(extracted_file)
 
-    return image_list, might_be_tex
+def get_raster_format(image_file, blob=None):
+    """Tell the raster format of an image from its signature.
 
+    :param: image_file (string): path to the image.
+    :param: blob (bytes): the content of the image, if it is not on disk.
 
-def convert_images(image_list, image_format="png", timeout=20):
+    :return: ``'png'``, ``'jpeg'``, ``'webp'`` or None for anything else.
+    """
+    if blob is not None:
+        head = blob[:12]
+    else:
+        with open(image_file, 'rb') as f:
+            head = f.read(12)
+    if head.startswith(PNG_SIGNATURE):
+        return 'png'
+    if head.startswith(JPEG_SIGNATURE):
+        return 'jpeg'
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'webp'
+    return None
+
+
+def can_convert_blob(blob, keep_formats=CFG_PLOTEXTRACTOR_KEEP_FORMATS,
+                     vector_format=None):
+    """Tell if an image can be converted without writing it to disk.
+
+    Kept rasters are the output themselves, and PDF files are read from
+    disk so that only the page needed is rasterized. With a
+    ``vector_format``, PostScript files are read from disk by the tools
+    converting them too.
+
+    :param: blob (bytes): the content of the image.
+    """
+    if vector_format is not None and \
+            blob.startswith((POSTSCRIPT_SIGNATURE, DOS_EPS_SIGNATURE)):
+        return False
+    return get_raster_format(None, blob) not in keep_formats and \
+        not blob.startswith(PDF_SIGNATURE)
+
+
+def convert_images(image_list, image_format="png", timeout=20,
+                   postprocess=None, image_metadata=None,
+                   keep_formats=CFG_PLOTEXTRACTOR_KEEP_FORMATS, pages=None,
+                   uploader=None, png_preset=CFG_PLOTEXTRACTOR_PNG_PRESET,
+                   vector_format=None, graphics_options=None):
     """Convert images from list of images to given format, if needed.
 
     Figure out the types of the images that were extracted from
-    the tarball and determine how to convert them into PNG.
+    the tarball and determine how to convert them into PNG. Rasters in
+    one of ``keep_formats`` are kept as they are. Of the images that would
+    be converted to the same file, the ones kept are all served, and the
+    others converted, in the order of :func:`plan_conversions`, only until
+    one of them succeeds.
 
     :param: image_list ([string, string, ...]): the list of image files
         extracted from the tarball in step 1
     :param: image_format (string): which image format to convert to.
         (PNG by default)
-    :param: timeout (int): the timeout value on shell commands.
+    :param: timeout (int): unused, kept for backwards compatibility.
+    :param: postprocess ([string, ...]): post-processing operations applied
+        to every image before it is encoded, see :func:`convert_image`.
+        Kept images are then rewritten in place, in their own format.
+        (optional)
+    :param: image_metadata (dict): filled with the info of every
+        post-processed image, by converted image file. (optional)
+    :param: keep_formats ([string, ...]): raster formats among ``'png'``,
+        ``'jpeg'`` and ``'webp'`` that are not converted.
+    :param: pages ({image: page, ...}): the page to convert of multi-page
+        images, from 0, see :func:`plotextractor.extractor.get_image_pages`.
+        Others are converted from their first page. Rasters larger than
+        ``CFG_PLOTEXTRACTOR_MAX_INPUT_PIXELS`` are skipped. (optional)
+    :param: uploader (Uploader): where to submit every image as soon as it
+        is converted, see :mod:`plotextractor.sinks` (optional)
+    :param: png_preset (string): how to encode the PNGs, one of
+        ``CFG_PLOTEXTRACTOR_PNG_PRESETS``, see :func:`set_png_preset`
+    :param: vector_format (string): ``'svg'`` or ``'pdf'`` to convert PDF
+        and PostScript images to that format instead of rasterizing them,
+        see :func:`convert_vector_image` (optional)
+    :param: graphics_options ({image: options, ...}): the options the TeX
+        includes the images with, see
+        :func:`plotextractor.extractor.get_image_options`. Vector images
+        are rasterized for the size they are shown at, and from their
+        ``page`` unless pages says otherwise. (optional)
 
     :return: image_mapping ({new_image: original_image, ...]): The mapping of
         image files when all have been converted to PNG format.
     """
-    png_output_contains = b'PNG image'
     image_mapping = {}
+    for sources in plan_conversions(image_list, vector_format).values():
+        converted_any = False
+        for image_file in sources:
+            if converted_any and \
+                    get_source_format(image_file) not in keep_formats:
+                continue
+            image_options = (graphics_options or {}).get(image_file) or {}
+            converted = convert_image_file(
+                image_file, image_format, postprocess=postprocess,
+                keep_formats=keep_formats,
+                page=(pages or {}).get(
+                    image_file, image_options.get('page', 0)),
+                png_preset=png_preset, vector_format=vector_format,
+                graphics_options=image_options)
+            if converted is None:
+                continue
+            converted_any = True
+            converted_image_file, image_info = converted
+            image_mapping[converted_image_file] = image_file
+            if image_info and image_metadata is not None:
+                image_metadata[converted_image_file] = image_info
+            if uploader is not None:
+                uploader.submit(converted_image_file)
+
+    return image_mapping
+
+
+def plan_conversions(image_list, vector_format=None, blobs=None):
+    """Group the images that would be converted to the same file.
+
+    Papers often come with ``fig1.eps``, ``fig1.pdf`` and ``fig1.png`` for
+    the same figure, for latex and pdflatex. Only one of them needs to be
+    converted, preferably the cheapest one: PNG, then JPEG, PDF and EPS.
+    With a ``vector_format``, vector images come first instead.
+
+    :param: image_list ([string, ...]): the images of the tarball
+    :param: vector_format (string): see :func:`convert_vector_image`
+        (optional)
+    :param: blobs (dict): the content of the images that are not on disk,
+        by image file (optional)
+
+    :return: sources ({converted_image_file: [image_file, ...], ...}): the
+        images of every converted file, from the preferred one, and in the
+        order of image_list otherwise
+    """
+    preference = VECTOR_SOURCE_PREFERENCE if vector_format \
+        else SOURCE_PREFERENCE
+    sources = OrderedDict()
     for image_file in image_list:
-        if os.path.isdir(image_file):
-            continue
+        sources.setdefault(
+            get_converted_image_name(image_file), []).append(image_file)
+    for image_files in sources.values():
+        if len(image_files) > 1:
+            image_files.sort(key=lambda image_file: get_source_rank(
+                get_source_format(image_file, (blobs or {}).get(image_file)),
+                preference))
+    return sources
 
-        if not os.path.exists(image_file):
-            continue
 
-        cmd_out = check_output(['file', image_file], timeout=timeout)
-        if cmd_out.find(png_output_contains) > -1:
-            # Already PNG
-            image_mapping[image_file] = image_file
+def get_source_format(image_file, blob=None):
+    """Tell the format of an image from its signature, or its extension if
+    it is neither on disk nor in memory.
+
+    :param: image_file (string): path to the image.
+    :param: blob (bytes): the content of the image, if it is not on disk.
+
+    :return: one of ``SOURCE_PREFERENCE``, or None.
+    """
+    if blob is not None or os.path.isfile(image_file):
+        raster_format = get_raster_format(image_file, blob)
+        if raster_format is not None:
+            return raster_format
+        if blob is not None:
+            head = blob[:4]
         else:
-            # we're just going to assume that ImageMagick can convert all
-            # the image types that we may be faced with
-            # for sure it can do EPS->PNG and JPG->PNG and PS->PNG
-            # and PSTEX->PNG
-            converted_image_file = get_converted_image_name(image_file)
-            try:
-                convert_image(image_file, converted_image_file, image_format)
-            except (MissingDelegateError, ResourceLimitError):
-                # Too bad, cannot convert image format.
-                continue
-            if os.path.exists(converted_image_file):
-                image_mapping[converted_image_file] = image_file
+            with open(image_file, 'rb') as f:
+                head = f.read(4)
+        if head.startswith(PDF_SIGNATURE):
+            return 'pdf'
+        if head.startswith((POSTSCRIPT_SIGNATURE, DOS_EPS_SIGNATURE)):
+            return 'ps'
+        return None
+    return SOURCE_EXTENSIONS.get(os.path.splitext(image_file)[1].lower())
+
+
+def get_source_rank(source_format, preference=SOURCE_PREFERENCE):
+    """Rank a source format, unknown ones last."""
+    if source_format in preference:
+        return preference.index(source_format)
+    return len(preference)
+
+
+def convert_image_file(image_file, image_format="png", postprocess=None,
+                       keep_formats=CFG_PLOTEXTRACTOR_KEEP_FORMATS, page=0,
+                       blob=None, png_preset=CFG_PLOTEXTRACTOR_PNG_PRESET,
+                       vector_format=None, graphics_options=None):
+    """Convert one of the images of a tarball, if needed.
+
+    See :func:`convert_images` for the parameters.
+
+    :param: blob (bytes): the content of the image, when it was not written
+        to image_file, see :func:`can_convert_blob`. (optional)
+    :param: graphics_options (dict): the options the TeX includes this
+        image with, see :func:`get_display_size` (optional)
+
+    :return: (converted_image_file, image_info) or None if the image could
+        not be converted.
+    """
+    if blob is None and (os.path.isdir(image_file) or
+                         not os.path.exists(image_file)):
+        return None
+
+    raster_format = get_raster_format(image_file, blob)
+    if raster_format in keep_formats:
+        converted_image_file = image_file
+        target_format = raster_format
+    else:
+        # we're just going to assume that ImageMagick can convert all
+        # the image types that we may be faced with
+        # for sure it can do EPS->PNG and JPG->PNG and PS->PNG
+        # and PSTEX->PNG
+        converted_image_file = get_converted_image_name(image_file)
+        target_format = image_format
+
+    if converted_image_file == image_file and not postprocess:
+        # Already in a format we serve
+        return image_file, {}
+
+    if blob is not None:
+        image_size = read_image_size(io.BytesIO(blob))
+    else:
+        image_size = get_image_size(image_file)
+    if is_oversized(image_size):
+        return None
+
+    if vector_format is not None and blob is None and is_vector(image_size):
+        vector_image_file = convert_vector_image(
+            image_file, image_size[0], vector_format, page)
+        if vector_image_file is not None:
+            return vector_image_file, {}
+
+    from wand.exceptions import MissingDelegateError, ResourceLimitError
+
+    image_info = {}
+    try:
+        convert_image(image_file, converted_image_file, target_format,
+                      postprocess=postprocess, image_info=image_info,
+                      page=page, blob=blob, png_preset=png_preset,
+                      display_size=get_display_size(
+                          image_size, graphics_options))
+    except (MissingDelegateError, ResourceLimitError):
+        # Too bad, cannot convert image format.
+        return None
+    if not os.path.exists(converted_image_file):
+        return None
+    return converted_image_file, image_info
+
+
+def convert_image(from_file, to_file, image_format, governor=None,
+                  postprocess=None, image_info=None, page=0,
+                  max_size=CFG_PLOTEXTRACTOR_MAX_IMAGE_SIZE, blob=None,
+                  png_preset=CFG_PLOTEXTRACTOR_PNG_PRESET, display_size=None):
+    """Convert an image to given format.
+
+    Only one page of multi-page documents is read, and vector images are
+    rasterized at a density that fits them in ``max_size``. From a blob,
+    all the pages are read, and the first one kept.
+
+    :param: governor (ResourceGovernor): the ImageMagick resource limits to
+        convert within (by default the one of this process)
+    :param: postprocess ([string, ...]): operations among ``'flatten'``,
+        ``'trim'`` and ``'grayscale'`` to apply on the raster before it is
+        encoded, see :mod:`plotextractor.postprocess` (requires numpy)
+    :param: image_info (dict): filled with the ``width``, ``height``,
+        ``bbox`` and ``grayscale`` of the post-processed image (optional)
+    :param: page (int): the page (or frame) to convert, from 0.
+    :param: max_size (int): the largest width or height of the converted
+        image, in pixels (None to keep the size of the original)
+    :param: blob (bytes): the content of from_file, to convert without
+        reading it from disk (optional)
+    :param: png_preset (string): how to encode PNGs, see
+        :func:`set_png_preset`
+    :param: display_size ((width, height)): the size the image is shown at
+        in the paper, in points, to rasterize vector images for (optional)
+    """
+    from wand.image import Image
+
+    if blob is not None:
+        image_size = read_image_size(io.BytesIO(blob))
+        source = {'blob': blob}
+    else:
+        image_size = get_image_size(from_file)
+        source = {'filename': '%s[%d]' % (from_file, page)}
+    resolution = get_density(image_size, max_size, display_size)
+    governor = governor or get_resource_governor()
+    with governor.conversion():
+        # the limits SOMETIMES (usualy on first file in a record) reset to
+        # their default value when used inside `with` block in here.
+        with Image(resolution=resolution, **source) as original:
+            governor.apply()
+            fit_image(original, max_size)
+            with original.convert(image_format) as converted:
+                governor.apply()
+                if not postprocess:
+                    if image_format == 'png':
+                        set_png_preset(converted, png_preset)
+                    converted.save(filename=to_file)
+                else:
+                    from .postprocess import postprocess_image
+                    with postprocess_image(
+                            converted, postprocess, image_info) as processed:
+                        processed.format = image_format
+                        if image_format == 'png':
+                            set_png_preset(processed, png_preset)
+                        processed.save(filename=to_file)
+    keep_first_frame(to_file)
+    return to_file
 
-    return image_mapping
 
+def convert_vector_image(from_file, source_format, vector_format, page=0,
+                         timeout=CFG_PLOTEXTRACTOR_VECTOR_TIMEOUT):
+    """Convert a PDF or PostScript image to SVG or PDF, without rasterizing.
+
+    PDF files are served as they are, SVG files are written by
+    ``pdftocairo`` (from PDF) or ``dvisvgm`` (from EPS) and PDF files by
+    ``gs`` (from EPS). Only PDF files can be converted from another page
+    than the first.
+
+    :param: from_file (string): the image to convert
+    :param: source_format (string): ``'pdf'`` or ``'ps'``, as returned by
+        :func:`~plotextractor.headers.get_image_size`
+    :param: vector_format (string): ``'svg'`` or ``'pdf'``
+    :param: page (int): the page to convert, from 0
+    :param: timeout (int): how long the tool can run for, in seconds
 
-def convert_image(from_file, to_file, image_format):
-    """Convert an image to given format."""
-    memory_limit = limits['memory']
-    disk_limit = limits['disk']
-    # fix for weird situation which SOMETIMES
-    # (usualy on first file in  a record)
-    # limits resets to default value when used inside `with` block in here.
-    with Image(filename=from_file) as original:
-        limits['memory'] = memory_limit
-        limits['disk'] = disk_limit
-        with original.convert(image_format) as converted:
-            limits['memory'] = memory_limit
-            limits['disk'] = disk_limit
-            converted.save(filename=to_file)
+    :return: the converted image file, or None if the tool is not installed
+        or failed, in which case the image should be rasterized instead.
+    """
+    if vector_format not in VECTOR_OUTPUT_FORMATS:
+        raise ValueError('Unknown vector format {0!r}'.format(vector_format))
+    if source_format == vector_format:
+        return from_file if page == 0 else None
+    command = VECTOR_COMMANDS.get((source_format, vector_format))
+    if command is None or (page and source_format != 'pdf'):
+        return None
+
+    to_file = '{0}.{1}'.format(
+        os.path.splitext(get_converted_image_name(from_file))[0],
+        vector_format)
+    arguments = [
+        argument.format(source=from_file, target=to_file, page=page + 1)
+        for argument in command
+    ]
+    if run_command(arguments, timeout) != 0 or not os.path.exists(to_file):
+        if os.path.exists(to_file):
+            os.remove(to_file)
+        return None
     return to_file
 
 
+def run_command(arguments, timeout=None):
+    """Run a command quietly, killing it after timeout seconds.
+
+    :return: its return code, or None if it could not be run at all.
+    """
+    try:
+        with open(os.devnull, 'wb') as devnull:
+            process = subprocess.Popen(
+                arguments, stdout=devnull, stderr=devnull)
+    except OSError:
+        return None
+    timer = None
+    if timeout is not None:
+        timer = threading.Timer(timeout, process.kill)
+        timer.start()
+    try:
+        return process.wait()
+    finally:
+        if timer is not None:
+            timer.cancel()
+
+
+def set_png_preset(image, preset=CFG_PLOTEXTRACTOR_PNG_PRESET):
+    """Set how an image is encoded as PNG.
+
+    With ``colors``, the image is quantized to that many colors (without
+    dithering), which ImageMagick then writes as a palette PNG. Line plots
+    rasterized with anti-aliasing have thousands of shades that are not
+    worth storing in truecolor.
+
+    :param: image (wand.image.Image): the image about to be saved
+    :param: preset (string): one of ``CFG_PLOTEXTRACTOR_PNG_PRESETS``, or
+        None to keep the ImageMagick defaults
+    """
+    if preset is None:
+        return
+    settings = CFG_PLOTEXTRACTOR_PNG_PRESETS[preset]
+    for option in ('compression-level', 'compression-filter',
+                   'compression-strategy', 'bit-depth'):
+        if settings.get(option) is not None:
+            image.options['png:' + option] = str(settings[option])
+    if settings.get('colors'):
+        image.quantize(settings['colors'], image.colorspace, 0, False, False)
+
+
+def get_density(image_size, max_size, display_size=None,
+                display_density=CFG_PLOTEXTRACTOR_DISPLAY_DENSITY):
+    """Return the density to rasterize a vector image at to fit max_size.
+
+    :param: image_size (tuple): as returned by ``get_image_size``.
+    :param: max_size (int): the largest width or height wanted, in pixels.
+    :param: display_size ((width, height)): the size the image is shown at,
+        in points, see :func:`get_display_size`. The image is then
+        rasterized with display_density pixels per inch of that size.
+        (optional)
+    :param: display_density (int): in pixels per inch
+
+    :return: (x, y) density in dots per inch, or None to use the default
+        one (which is also the one when the image is small enough or is not
+        a vector image).
+    """
+    if not is_vector(image_size) or min(image_size[1:]) <= 0:
+        return None
+    density = None
+    if display_size is not None:
+        density = float(display_density) * max(
+            display_length / image_length
+            for display_length, image_length in zip(
+                display_size, image_size[1:]))
+    if max_size is not None:
+        longest_side = max(image_size[1:]) * (
+            density or DEFAULT_DENSITY) / POINTS_PER_INCH
+        if longest_side > max_size:
+            density = float(density or DEFAULT_DENSITY) * \
+                max_size / longest_side
+    if density is None:
+        return None
+    return density, density
+
+
+def get_display_size(image_size, graphics_options):
+    """Return the size an image is shown at, from its options in the TeX.
+
+    :param: image_size (tuple): as returned by ``get_image_size``.
+    :param: graphics_options (dict): the ``width``, ``height`` (in points)
+        and ``scale`` of the image, see
+        :func:`plotextractor.extractor.get_image_options`.
+
+    :return: (width, height) in points, or None if the options do not give
+        the size or the size of the image is not known in points.
+    """
+    if not graphics_options or not is_vector(image_size) or \
+            min(image_size[1:]) <= 0:
+        return None
+    image_width, image_height = image_size[1:]
+    width = graphics_options.get('width')
+    height = graphics_options.get('height')
+    if width is not None and height is not None:
+        return width, height
+    if width is not None:
+        return width, width * image_height / image_width
+    if height is not None:
+        return height * image_width / image_height, height
+    if graphics_options.get('scale'):
+        scale = graphics_options['scale']
+        return image_width * scale, image_height * scale
+    return None
+
+
+def fit_image(image, max_size):
+    """Shrink an image in place so that it fits in max_size, if needed."""
+    if max_size is None or max(image.width, image.height) <= max_size:
+        return
+    ratio = float(max_size) / max(image.width, image.height)
+    image.resize(max(1, int(image.width * ratio)),
+                 max(1, int(image.height * ratio)))
+
+
+def is_oversized(image_size, max_pixels=CFG_PLOTEXTRACTOR_MAX_INPUT_PIXELS):
+    """Tell if a raster is too large to be decoded for conversion.
+
+    :param: image_size (tuple): as returned by ``get_image_size``.
+    :param: max_pixels (int): the largest area allowed, in pixels.
+    """
+    if image_size is None or is_vector(image_size) or max_pixels is None:
+        return False
+    return image_size[1] * image_size[2] > max_pixels
+
+
+def keep_first_frame(to_file):
+    """Keep only the first image written for a multi-frame conversion.
+
+    ImageMagick saves the frames of a sequence as ``name-0.png``,
+    ``name-1.png``... instead of ``name.png``.
+    """
+    if os.path.exists(to_file):
+        return
+    root, extension = os.path.splitext(to_file)
+    frame = 0
+    while True:
+        frame_file = '%s-%d%s' % (root, frame, extension)
+        if not os.path.exists(frame_file):
+            return
+        if frame == 0:
+            os.rename(frame_file, to_file)
+        else:
+            os.remove(frame_file)
+        frame += 1
+
+
 def rotate_image(filename, line, sdir, image_list):
     """Rotate a image.
 
@@ -206,7 +872,7 @@ def rotate_image(filename, line, sdir, image_list):
     :param: line (string): the line where the rotate command was found
 
     :output: the image file rotated in accordance with the rotate command
-    :return: True if something was rotated
+    :return: the path of the rotated image, or False if nothing was rotated
     """
     file_loc = get_image_location(filename, sdir, image_list)
     degrees = re.findall(r'(\bangle=-?[\d]+|\brotate=-?[\d]+)', line)
@@ -229,10 +895,17 @@ def rotate_image(filename, line, sdir, image_list):
         if not os.path.exists(file_loc):
             return False
 
+        if os.path.splitext(file_loc)[1].lower() == '.svg' or \
+                is_vector(get_image_size(file_loc)):
+            # served as a vector image, which Wand would only rasterize
+            return False
+
         degrees = -degrees  # ImageMagick and graphicx use opposite conventions
+        from wand.image import Image
+
         with Image(filename=file_loc) as image:
             with image.clone() as rotated:
                 rotated.rotate(degrees)
                 rotated.save(filename=file_loc)
-        return True
+        return file_loc
     return False
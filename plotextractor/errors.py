@@ -30,6 +30,18 @@ class InvalidTarball(Exception):
     """Raised when the file to extract is not a valid tarball."""
 
 
+class ArchiveLimitExceeded(InvalidTarball):
+
+    """Raised when a tarball goes over one of the archive limits."""
+
+    def __init__(self, limit, value, maximum):
+        super(ArchiveLimitExceeded, self).__init__(
+            '{0} limit exceeded: {1} > {2}'.format(limit, value, maximum))
+        self.limit = limit
+        self.value = value
+        self.maximum = maximum
+
+
 class NoTexFilesFound(Exception):
 
     """Raised when the extracted has no TeX files."""
@@ -34,9 +34,12 @@ from .config import (
     CFG_PLOTEXTRACTOR_CONTEXT_SENTENCE_LIMIT,
     CFG_PLOTEXTRACTOR_CONTEXT_EXTRACT_LIMIT,
     CFG_PLOTEXTRACTOR_DISALLOWED_TEX,
+    CFG_PLOTEXTRACTOR_TEX_LENGTHS,
 )
 
+from .figure import Figure
 from .output_utils import (
+    BraceMatcher,
     assemble_caption,
     find_open_and_close_braces,
     get_tex_location,
@@ -47,11 +50,116 @@ from .converter import rotate_image
 ARXIV_HEADER = 'arXiv:'
 PLOTS_DIR = 'plots'
 
-MAIN_CAPTION_OR_IMAGE = 0
-SUB_CAPTION_OR_IMAGE = 1
+INCLUDEGRAPHICS_OPTIONS = re.compile(
+    r'\\includegraphics\s*\*?\s*\[([^\]]*)\]\s*\{([^}]+)\}')
+EPSFIG_OPTIONS = re.compile(r'\\(?:epsfig|psfig)\s*\{([^}]*)\}')
+PAGE_OPTION = re.compile(r'(?:^|,)\s*page\s*=\s*(\d+)\s*(?:,|$)')
+SIZE_OPTION = re.compile(
+    r'(?:^|,)\s*(width|height|totalheight|scale)\s*=\s*([^,]+?)\s*(?=,|$)')
+FILE_OPTION = re.compile(r'(?:^|,)\s*(?:file|figure)\s*=\s*([^,]+?)\s*(?=,|$)')
+LENGTH = re.compile(r'^(-?[\d.]*)\s*(?:\\(\w+)|([a-z]{2}))$')
+COMMENT = re.compile(r'(?<!\\)%.*')
+
+# TeX units, in PostScript points
+UNITS = {
+    'bp': 1.0,
+    'pt': 72 / 72.27,
+    'pc': 12 * 72 / 72.27,
+    'in': 72.0,
+    'cm': 72 / 2.54,
+    'mm': 72 / 25.4,
+    'em': 10.0,
+    'ex': 4.5,
+}
+
+
+class PendingFigure(object):
+
+    """The images and captions found so far for the figure being read.
+
+    A figure has one image and one caption until a second one, or a
+    subfigure, is found. From then on, the following ones are kept as
+    subfigure images or captions, and are matched by position.
+    """
+
+    __slots__ = ('image', 'sub_images', 'caption', 'sub_captions')
+
+    def __init__(self):
+        self.image = ''
+        self.sub_images = None
+        self.caption = ''
+        self.sub_captions = None
+
+    @property
+    def has_image(self):
+        return self.image != '' or self.sub_images is not None
 
+    @property
+    def has_caption(self):
+        return self.caption != '' or self.sub_captions is not None
 
-def get_context(lines, backwards=False):
+    def add_image(self, image):
+        """Add an image to the figure."""
+        if self.sub_images is not None:
+            self.sub_images.append(image)
+        elif self.image == '':
+            self.image = image
+        else:
+            self.sub_images = [self.image, image]
+            self.image = ''
+
+    def add_caption(self, caption):
+        """Add a caption to the figure."""
+        if self.sub_captions is not None:
+            self.sub_captions.append(caption)
+        elif self.caption == '':
+            self.caption = caption
+        elif self.caption != caption:
+            self.sub_captions = [self.caption, caption]
+            self.caption = ''
+
+    def split(self):
+        """Keep track of the following images and captions as subfigures."""
+        if self.sub_images is None:
+            self.sub_images = []
+        if self.sub_captions is None:
+            self.sub_captions = []
+
+
+# a TeX tag in a word, the last one if there are several
+TEX_TAG = re.compile(r".*\\(\w+).*", re.UNICODE)
+SENTENCE = re.compile(r"(?<=[.?!])[\s]+(?=[A-Z])", re.UNICODE)
+WORD = re.compile(r"\S+", re.UNICODE)
+DISALLOWED_TEX = frozenset(CFG_PLOTEXTRACTOR_DISALLOWED_TEX)
+
+
+def iter_words(text, start=0, end=None, backwards=False):
+    """Iterate over the words of a part of a text.
+
+    :param text (string): the text
+    :param start (int): where the part starts in the text
+    :param end (int): where the part ends in the text (its end by default)
+    :param backwards (bool): from the end of the part?
+    """
+    if end is None:
+        end = len(text)
+    if not backwards:
+        for word in WORD.finditer(text, start, end):
+            yield word.group()
+        return
+
+    position = end
+    while position > start:
+        while position > start and text[position - 1].isspace():
+            position -= 1
+        word_end = position
+        while position > start and not text[position - 1].isspace():
+            position -= 1
+        if word_end > position:
+            yield text[position:word_end]
+
+
+def get_context(lines, backwards=False, start=0, end=None):
     """Get context.
 
     Given a relevant string from a TeX file, this function will extract text
@@ -67,26 +175,23 @@ def get_context(lines, backwards=False):
 
     :param lines (string): string to examine
     :param reversed (bool): are we searching backwards?
+    :param start (int): where the text to examine starts in lines
+    :param end (int): where the text to examine ends in lines (by default,
+        at the end of lines)
 
     :return context (string): extracted context
     """
-    tex_tag = re.compile(r".*\\(\w+).*")
-    sentence = re.compile(r"(?<=[.?!])[\s]+(?=[A-Z])")
     context = []
 
-    word_list = lines.split()
-    if backwards:
-        word_list.reverse()
-
     # For each word we do the following:
     #   1. Check if we have reached word limit
     #   2. If not, see if this is a TeX tag and see if its 'illegal'
     #   3. Otherwise, add word to context
-    for word in word_list:
+    for word in iter_words(lines, start, end, backwards):
         if len(context) >= CFG_PLOTEXTRACTOR_CONTEXT_WORD_LIMIT:
             break
-        match = tex_tag.match(word)
-        if match and match.group(1) in CFG_PLOTEXTRACTOR_DISALLOWED_TEX:
+        match = '\\' in word and TEX_TAG.match(word)
+        if match and match.group(1) in DISALLOWED_TEX:
             # TeX Construct matched, return
             if backwards:
                 # When reversed we need to go back and
@@ -102,7 +207,7 @@ def get_context(lines, backwards=False):
     if backwards:
         context.reverse()
     text = " ".join(context)
-    sentence_list = sentence.split(text)
+    sentence_list = SENTENCE.split(text)
 
     if backwards:
         sentence_list.reverse()
@@ -122,13 +227,8 @@ def extract_context(tex_file, extracted_image_data):
     The number of characters to extract before and after is configurable.
 
     :param tex_file (list): path to .tex file
-    :param extracted_image_data ([(string, string, list), ...]):
-        a list of tuples of images matched to labels and captions from
-        this document.
-
-    :return extracted_image_data ([(string, string, list, list),
-        (string, string, list, list),...)]: the same list, but now containing
-        extracted contexts
+    :param extracted_image_data ([Figure, Figure, ...]): the figures with
+        labels and captions from this document, whose contexts are set.
     """
     if os.path.isdir(tex_file) or not os.path.exists(tex_file):
         return []
@@ -136,35 +236,180 @@ def extract_context(tex_file, extracted_image_data):
     lines = "".join(get_lines_from_file(tex_file))
 
     # Generate context for each image and its assoc. labels
-    for data in extracted_image_data:
+    for figure in extracted_image_data:
         context_list = []
 
         # Generate a list of index tuples for all matches
         indicies = [match.span()
                     for match in re.finditer(r"(\\(?:fig|ref)\{%s\})" %
-                                             (re.escape(data['label']),),
+                                             (re.escape(figure.label),),
                                              lines)]
         for startindex, endindex in indicies:
-            # Retrive all lines before label until beginning of file
-            i = startindex - CFG_PLOTEXTRACTOR_CONTEXT_EXTRACT_LIMIT
-            if i < 0:
-                text_before = lines[:startindex]
-            else:
-                text_before = lines[i:startindex]
-            context_before = get_context(text_before, backwards=True)
-
-            # Retrive all lines from label until end of file and get context
-            i = endindex + CFG_PLOTEXTRACTOR_CONTEXT_EXTRACT_LIMIT
-            text_after = lines[endindex:i]
-            context_after = get_context(text_after)
+            # Get context from the lines before the label, up to the limit
+            context_before = get_context(
+                lines, backwards=True,
+                start=max(
+                    startindex - CFG_PLOTEXTRACTOR_CONTEXT_EXTRACT_LIMIT, 0),
+                end=startindex)
+
+            # Get context from the lines after the label, up to the limit
+            context_after = get_context(
+                lines,
+                start=endindex,
+                end=endindex + CFG_PLOTEXTRACTOR_CONTEXT_EXTRACT_LIMIT)
             context_list.append(
-                context_before + ' \\ref{' + data['label'] + '} ' +
+                context_before + ' \\ref{' + figure.label + '} ' +
                 context_after
             )
-        data['contexts'] = context_list
+        figure.contexts = context_list
+
+
+def get_image_pages(tex_files, image_list, sdir, parsed_tex_files=None):
+    """Find the pages of multi-page images that the TeX files include.
+
+    See :func:`get_image_options` for the parameters.
+
+    :return: pages ({image: page, ...}): the page of the included images,
+        counted from 0.
+    """
+    return dict(
+        (image, options['page'])
+        for image, options in get_image_options(
+            tex_files, image_list, sdir, parsed_tex_files).items()
+        if 'page' in options
+    )
+
+
+def get_image_options(tex_files, image_list, sdir, parsed_tex_files=None):
+    """Find the options the TeX files include the images with.
+
+    This is a quick scan for ``\\includegraphics[options]{image}`` and
+    ``\\epsfig{file=image,options}``, done before the images are
+    converted. When an image is included several times, the first value
+    of every option wins.
+
+    :param: tex_files ([string, ...]): the TeX files of the tarball.
+    :param: image_list ([string, ...]): the images of the tarball.
+    :param: sdir (string): the directory the image names are relative to.
+    :param: parsed_tex_files (dict): memo of the TeX files already read, see
+        :func:`extract_captions` (optional)
+
+    :return: options ({image: {option: value, ...}, ...}): the ``page``,
+        counted from 0, the ``width`` and ``height`` in points and the
+        ``scale`` the images are included with, when given.
+    """
+    if parsed_tex_files is None:
+        parsed_tex_files = {}
+    images = {}
+    for image in image_list:
+        images.setdefault(os.path.normpath(image), image)
+        images.setdefault(os.path.splitext(os.path.normpath(image))[0], image)
+    # TeX also finds the images of a subdirectory by their name alone
+    for image in image_list:
+        image_rel = os.path.relpath(image, sdir)
+        if image_rel.count(os.sep) == 1:
+            loose_image = os.path.join(sdir, os.path.basename(image_rel))
+            images.setdefault(os.path.normpath(loose_image), image)
+            images.setdefault(
+                os.path.splitext(os.path.normpath(loose_image))[0], image)
+
+    image_options = {}
+    for tex_file in tex_files:
+        if os.path.isdir(tex_file) or not os.path.exists(tex_file):
+            continue
+        parsed_tex = parsed_tex_files.setdefault(
+            os.path.realpath(tex_file), {'captions': {}})
+        if 'lines' not in parsed_tex:
+            parsed_tex['lines'] = get_lines_from_file(tex_file)
+        if 'graphics' not in parsed_tex:
+            parsed_tex['graphics'] = get_included_graphics(
+                parsed_tex['lines'])
+        for name, parsed_options in parsed_tex['graphics']:
+            image = images.get(os.path.normpath(os.path.join(sdir, name)))
+            if image is None:
+                continue
+            for option, value in parsed_options.items():
+                image_options.setdefault(image, {}).setdefault(option, value)
+    return image_options
+
+
+def get_included_graphics(lines):
+    """Find the graphics included with options in the lines of a TeX file.
+
+    :param: lines ([string, ...]): the lines of the TeX file.
+
+    :return: graphics ([(name, options), ...]): the name of every image
+        included with page or size options, and these options, see
+        :func:`parse_graphics_options`, in the order of the file.
+    """
+    graphics = []
+    for line in lines:
+        if '=' not in line:
+            continue
+        line = COMMENT.sub('', line)
+        included = INCLUDEGRAPHICS_OPTIONS.findall(line)
+        for options in EPSFIG_OPTIONS.findall(line):
+            name = FILE_OPTION.search(options)
+            if name is not None:
+                included.append((options, name.group(1)))
+        for options, name in included:
+            parsed_options = parse_graphics_options(options)
+            if parsed_options:
+                graphics.append((name.strip(), parsed_options))
+    return graphics
+
+
+def parse_graphics_options(options):
+    """Parse the page and size options of ``\\includegraphics``.
+
+    :param: options (string): the options, like ``width=0.5\\textwidth``.
+
+    :return: options (dict): the ``page`` (from 0), ``width`` and ``height``
+        (in points, with ``totalheight`` as ``height``) and ``scale`` that
+        could be read.
+    """
+    parsed_options = {}
+    page = PAGE_OPTION.search(options)
+    if page is not None:
+        parsed_options['page'] = max(int(page.group(1)) - 1, 0)
+    for option, value in SIZE_OPTION.findall(options):
+        if option == 'scale':
+            try:
+                parsed_options['scale'] = float(value)
+            except ValueError:
+                pass
+            continue
+        length = get_length(value)
+        if length is not None:
+            parsed_options.setdefault(
+                'height' if option == 'totalheight' else option, length)
+    return parsed_options
 
 
-def extract_captions(tex_file, sdir, image_list, primary=True):
+def get_length(value):
+    """Return a TeX length in points, like ``3cm`` or ``.5\\linewidth``.
+
+    :return: the length, or None for units that are not known.
+    """
+    length = LENGTH.match(value.strip())
+    if length is None:
+        return None
+    factor, command, unit = length.groups()
+    try:
+        factor = float(factor) if factor not in ('', '-') else 1.0
+    except ValueError:
+        return None
+    if command is not None:
+        reference = CFG_PLOTEXTRACTOR_TEX_LENGTHS.get(command)
+    else:
+        reference = UNITS.get(unit)
+    if reference is None or factor <= 0:
+        return None
+    return factor * reference
+
+
+def extract_captions(tex_file, sdir, image_list, primary=True,
+                     parsed_tex_files=None, rotated_images=None):
     """Extract captions.
 
     Take the TeX file and the list of images in the tarball (which all,
@@ -177,16 +422,30 @@ def extract_captions(tex_file, sdir, image_list, primary=True):
     :param: sdir (string): path to current sub-directory
     :param: image_list (list): list of images in tarball
     :param: primary (bool): is this the primary call to extract_caption?
-
-    :return: images_and_captions_and_labels ([(string, string, list),
-        (string, string, list), ...]):
-        a list of tuples representing the names of images and their
-        corresponding figure labels from the TeX file
+    :param: parsed_tex_files (dict): memo of the TeX files already read and
+        scanned for this tarball, shared between the calls for all its TeX
+        files so that each file is only parsed once (optional)
+    :param: rotated_images (set): filled with the images rotated on disk as
+        the TeX says, see :func:`~plotextractor.converter.rotate_image`
+        (optional)
+
+    :return: figures ([Figure, Figure, ...]): the figures of the TeX file,
+        with the names of their images, their captions and labels
     """
     if os.path.isdir(tex_file) or not os.path.exists(tex_file):
         return []
 
-    lines = get_lines_from_file(tex_file)
+    if parsed_tex_files is None:
+        parsed_tex_files = {}
+    parsed_tex = parsed_tex_files.setdefault(
+        os.path.realpath(tex_file), {'captions': {}})
+    if primary in parsed_tex['captions']:
+        return list(parsed_tex['captions'][primary])
+
+    if 'lines' not in parsed_tex:
+        parsed_tex['lines'] = get_lines_from_file(tex_file)
+    # we modify the lines in place, so keep the cached ones pristine
+    lines = list(parsed_tex['lines'])
 
     # possible figure lead-ins
     figure_head = u'\\begin{figure'  # also matches figure*
@@ -214,8 +473,7 @@ def extract_captions(tex_file, sdir, image_list, primary=True):
     doc_tail = u'\\end{document}'
 
     extracted_image_data = []
-    cur_image = ''
-    caption = ''
+    cur_figure = PendingFigure()
     labels = []
     active_label = ""
 
@@ -226,6 +484,10 @@ def extract_captions(tex_file, sdir, image_list, primary=True):
                 lines[line_index] = ''
             else:
                 break
+        else:
+            # no document here, most likely a file included by another one
+            parsed_tex['captions'][primary] = extracted_image_data
+            return []
 
     # are we using commas in filenames here?
     commas_okay = False
@@ -246,6 +508,9 @@ def extract_captions(tex_file, sdir, image_list, primary=True):
         line = line.strip()
         lines[line_index] = line
 
+    # all the braces of the document, paired once
+    brace_matcher = BraceMatcher(lines)
+
     in_figure_tag = 0
 
     for line_index in range(len(lines)):
@@ -272,10 +537,10 @@ def extract_captions(tex_file, sdir, image_list, primary=True):
             # some punks don't like to put things in the figure tag.  so we
             # just want to see if there is anything that is sitting outside
             # of it when we find it
-            cur_image, caption, extracted_image_data = put_it_together(
-                cur_image, caption,
-                active_label, extracted_image_data,
-                line_index, lines)
+            cur_figure, extracted_image_data = put_it_together(
+                cur_figure, active_label, extracted_image_data,
+                line_index, lines, tex_file=tex_file,
+                brace_matcher=brace_matcher)
 
         # here, you jerks, just make it so that it's fecking impossible to
         # figure out your damn inclusion types
@@ -301,16 +566,7 @@ def extract_captions(tex_file, sdir, image_list, primary=True):
                     commas_okay=commas_okay))
 
             for filename in filenames:
-                filename = str(filename)
-                if cur_image == '':
-                    cur_image = filename
-                elif isinstance(cur_image, list):
-                    if isinstance(cur_image[SUB_CAPTION_OR_IMAGE], list):
-                        cur_image[SUB_CAPTION_OR_IMAGE].append(filename)
-                    else:
-                        cur_image[SUB_CAPTION_OR_IMAGE] = [filename]
-                else:
-                    cur_image = ['', [cur_image, filename]]
+                cur_figure.add_image(str(filename))
 
         """
         Rotate and angle
@@ -332,7 +588,11 @@ def extract_captions(tex_file, sdir, image_list, primary=True):
             already_tried = []
             for filename in filenames:
                 if filename != 'ERROR' and filename not in already_tried:
-                    if rotate_image(filename, line, sdir, image_list):
+                    rotated_image = rotate_image(
+                        filename, line, sdir, image_list)
+                    if rotated_image:
+                        if rotated_images is not None:
+                            rotated_images.add(rotated_image)
                         break
                     already_tried.append(filename)
 
@@ -344,17 +604,10 @@ def extract_captions(tex_file, sdir, image_list, primary=True):
         index = line.find(includegraphics_head)
         if index > -1:
             open_curly, open_curly_line, close_curly, dummy = \
-                find_open_and_close_braces(line_index, index, '{', lines)
+                find_open_and_close_braces(line_index, index, '{', lines,
+                                           brace_matcher)
             filename = lines[open_curly_line][open_curly + 1:close_curly]
-            if cur_image == '':
-                cur_image = filename
-            elif isinstance(cur_image, list):
-                if isinstance(cur_image[SUB_CAPTION_OR_IMAGE], list):
-                    cur_image[SUB_CAPTION_OR_IMAGE].append(filename)
-                else:
-                    cur_image[SUB_CAPTION_OR_IMAGE] = [filename]
-            else:
-                cur_image = ['', [cur_image, filename]]
+            cur_figure.add_image(filename)
 
         r"""
         {\input{FILENAME}}
@@ -375,7 +628,9 @@ def extract_captions(tex_file, sdir, image_list, primary=True):
                         extracted_image_data.extend(extract_captions(
                             new_tex_file, sdir,
                             image_list,
-                            primary=False
+                            primary=False,
+                            parsed_tex_files=parsed_tex_files,
+                            rotated_images=rotated_images
                         ))
 
         r"""
@@ -395,7 +650,9 @@ def extract_captions(tex_file, sdir, image_list, primary=True):
                         extracted_image_data.extend(extract_captions(
                             new_tex_file, sdir,
                             image_list,
-                            primary=False
+                            primary=False,
+                            parsed_tex_files=parsed_tex_files,
+                            rotated_images=rotated_images
                         ))
 
         """PICTURE"""
@@ -433,23 +690,15 @@ def extract_captions(tex_file, sdir, image_list, primary=True):
         index = max([line.find(caption_head), line.find(figcaption_head)])
         if index > -1:
             open_curly, open_curly_line, close_curly, close_curly_line = \
-                find_open_and_close_braces(line_index, index, '{', lines)
+                find_open_and_close_braces(line_index, index, '{', lines,
+                                           brace_matcher)
 
             cap_begin = open_curly + 1
 
             cur_caption = assemble_caption(
                 open_curly_line, cap_begin,
                 close_curly_line, close_curly, lines)
-
-            if caption == '':
-                caption = cur_caption
-            elif isinstance(caption, list):
-                if isinstance(caption[SUB_CAPTION_OR_IMAGE], list):
-                    caption[SUB_CAPTION_OR_IMAGE].append(cur_caption)
-                else:
-                    caption[SUB_CAPTION_OR_IMAGE] = [cur_caption]
-            elif caption != cur_caption:
-                caption = ['', [caption, cur_caption]]
+            cur_figure.add_caption(cur_caption)
 
         r"""
         SUBFIGURES -
@@ -470,21 +719,18 @@ def extract_captions(tex_file, sdir, image_list, primary=True):
 
         index = max([line.find(subfloat_head), line.find(subfig_head)])
         if index > -1:
-            # we need a different structure for keeping track of several
-            # captions and images
-            if not isinstance(cur_image, list):
-                cur_image = [cur_image, []]
-            if not isinstance(caption, list):
-                caption = [caption, []]
+            # we need to keep track of several captions and images
+            cur_figure.split()
 
             open_square, open_square_line, close_square, close_square_line = \
-                find_open_and_close_braces(line_index, index, '[', lines)
+                find_open_and_close_braces(line_index, index, '[', lines,
+                                           brace_matcher)
             cap_begin = open_square + 1
 
             sub_caption = assemble_caption(open_square_line,
                                            cap_begin, close_square_line,
                                            close_square, lines)
-            caption[SUB_CAPTION_OR_IMAGE].append(sub_caption)
+            cur_figure.sub_captions.append(sub_caption)
 
             index_cpy = index
 
@@ -501,10 +747,10 @@ def extract_captions(tex_file, sdir, image_list, primary=True):
 
             open_curly, open_curly_line, close_curly, dummy = \
                 find_open_and_close_braces(line_index,
-                                           index, '{', lines)
+                                           index, '{', lines, brace_matcher)
             sub_image = lines[open_curly_line][open_curly + 1:close_curly]
 
-            cur_image[SUB_CAPTION_OR_IMAGE].append(sub_image)
+            cur_figure.sub_images.append(sub_image)
 
         r"""
         LABELS -
@@ -524,7 +770,7 @@ def extract_captions(tex_file, sdir, image_list, primary=True):
         if index > -1 and in_figure_tag:
             open_curly, open_curly_line, close_curly, dummy =\
                 find_open_and_close_braces(line_index,
-                                           index, '{', lines)
+                                           index, '{', lines, brace_matcher)
             label = lines[open_curly_line][open_curly + 1:close_curly]
             if label not in labels:
                 active_label = label
@@ -544,10 +790,11 @@ def extract_captions(tex_file, sdir, image_list, primary=True):
         ])
         if index > -1:
             in_figure_tag = 0
-            cur_image, caption, extracted_image_data = \
-                put_it_together(cur_image, caption, active_label,
+            cur_figure, extracted_image_data = \
+                put_it_together(cur_figure, active_label,
                                 extracted_image_data,
-                                line_index, lines)
+                                line_index, lines, tex_file=tex_file,
+                                brace_matcher=brace_matcher)
         """
         END DOCUMENT
 
@@ -558,121 +805,95 @@ def extract_captions(tex_file, sdir, image_list, primary=True):
         if index > -1:
             break
 
-    return extracted_image_data
+    parsed_tex['captions'][primary] = extracted_image_data
+    return list(extracted_image_data)
 
 
-def put_it_together(cur_image, caption, context, extracted_image_data,
-                    line_index, lines):
+def put_it_together(cur_figure, context, extracted_image_data,
+                    line_index, lines, tex_file=None, brace_matcher=None):
     """Put it together.
 
     Takes the current image(s) and caption(s) and assembles them into
     something useful in the extracted_image_data list.
 
-    :param: cur_image (string || list): the image currently being dealt with,
-        or the list of images, in the case of subimages
-    :param: caption (string || list): the caption or captions currently in
-        scope
-    :param: extracted_image_data ([(string, string), (string, string), ...]):
-        a list of tuples of images matched to captions from this document.
+    :param: cur_figure (PendingFigure): the image(s) and caption(s) of the
+        figure currently being dealt with
+    :param: context (string): the label of the figure
+    :param: extracted_image_data ([Figure, Figure, ...]): the figures
+        extracted so far from this document.
     :param: line_index (int): the index where we are in the lines (for
         searchback and searchforward purposes)
     :param: lines ([string, string, ...]): the lines in the TeX
+    :param: tex_file (string): the TeX file of the lines
+    :param: brace_matcher (BraceMatcher): the braces of the lines (optional)
 
-    :return: (cur_image, caption, extracted_image_data): the same arguments it
-        was sent, processed appropriately
+    :return: (cur_figure, extracted_image_data): a new empty figure, and the
+        figures processed appropriately
     """
-    if isinstance(cur_image, list):
-        if cur_image[MAIN_CAPTION_OR_IMAGE] == 'ERROR':
-            cur_image[MAIN_CAPTION_OR_IMAGE] = ''
-        for image in cur_image[SUB_CAPTION_OR_IMAGE]:
-            if image == 'ERROR':
-                cur_image[SUB_CAPTION_OR_IMAGE].remove(image)
-
-    if cur_image != '' and caption != '':
-
-        if isinstance(cur_image, list) and isinstance(caption, list):
-
-            if cur_image[MAIN_CAPTION_OR_IMAGE] != '' and\
-                    caption[MAIN_CAPTION_OR_IMAGE] != '':
-                extracted_image_data.append(
-                    (cur_image[MAIN_CAPTION_OR_IMAGE],
-                     caption[MAIN_CAPTION_OR_IMAGE],
-                     context))
-            if isinstance(cur_image[MAIN_CAPTION_OR_IMAGE], list):
-                # why is the main image a list?
-                # it's a good idea to attach the main caption to other
-                # things, but the main image can only be used once
-                cur_image[MAIN_CAPTION_OR_IMAGE] = ''
-
-            if isinstance(cur_image[SUB_CAPTION_OR_IMAGE], list):
-                if isinstance(caption[SUB_CAPTION_OR_IMAGE], list):
-                    for index in \
-                            range(len(cur_image[SUB_CAPTION_OR_IMAGE])):
-                        if index < len(caption[SUB_CAPTION_OR_IMAGE]):
-                            long_caption = \
-                                caption[MAIN_CAPTION_OR_IMAGE] + ' : ' + \
-                                caption[SUB_CAPTION_OR_IMAGE][index]
-                        else:
-                            long_caption = \
-                                caption[MAIN_CAPTION_OR_IMAGE] + ' : ' + \
-                                'Caption not extracted'
-                        extracted_image_data.append(
-                            (cur_image[SUB_CAPTION_OR_IMAGE][index],
-                             long_caption, context))
-
+    def add_figure(image, caption, sub_images=(), sub_caption=None):
+        if sub_caption is None:
+            sub_caption = caption
+        extracted_image_data.append(Figure(
+            image, caption, context,
+            subfigures=[
+                Figure(sub_image, sub_caption, context,
+                       tex_file=tex_file, line=line_index)
+                for sub_image in sub_images
+            ],
+            tex_file=tex_file,
+            line=line_index,
+        ))
+
+    image = cur_figure.image
+    sub_images = cur_figure.sub_images
+    caption = cur_figure.caption
+    sub_captions = cur_figure.sub_captions
+
+    if sub_images is not None:
+        if image == 'ERROR':
+            image = ''
+        for sub_image in sub_images:
+            if sub_image == 'ERROR':
+                sub_images.remove(sub_image)
+
+    if cur_figure.has_image and cur_figure.has_caption:
+
+        if sub_images is not None and sub_captions is not None:
+            subfigures = []
+            for index, sub_image in enumerate(sub_images):
+                if index < len(sub_captions):
+                    long_caption = caption + ' : ' + sub_captions[index]
                 else:
-                    long_caption = caption[MAIN_CAPTION_OR_IMAGE] + \
-                        ' : ' + caption[SUB_CAPTION_OR_IMAGE]
-                    for sub_image in cur_image[SUB_CAPTION_OR_IMAGE]:
-                        extracted_image_data.append(
-                            (sub_image, long_caption, context))
-
-            else:
-                if isinstance(caption[SUB_CAPTION_OR_IMAGE], list):
-                    long_caption = caption[MAIN_CAPTION_OR_IMAGE]
-                    for sub_cap in caption[SUB_CAPTION_OR_IMAGE]:
-                        long_caption = long_caption + ' : ' + sub_cap
-                    extracted_image_data.append(
-                        (cur_image[SUB_CAPTION_OR_IMAGE], long_caption,
-                         context))
-                else:
-                    # wtf are they lists for?
-                    extracted_image_data.append(
-                        (cur_image[SUB_CAPTION_OR_IMAGE],
-                         caption[SUB_CAPTION_OR_IMAGE], context))
-
-        elif isinstance(cur_image, list):
-            if cur_image[MAIN_CAPTION_OR_IMAGE] != '':
-                extracted_image_data.append(
-                    (cur_image[MAIN_CAPTION_OR_IMAGE], caption, context))
-            if isinstance(cur_image[SUB_CAPTION_OR_IMAGE], list):
-                for image in cur_image[SUB_CAPTION_OR_IMAGE]:
-                    extracted_image_data.append((image, caption, context))
-            else:
-                extracted_image_data.append(
-                    (cur_image[SUB_CAPTION_OR_IMAGE], caption, context))
-
-        elif isinstance(caption, list):
-            if caption[MAIN_CAPTION_OR_IMAGE] != '':
-                extracted_image_data.append(
-                    (cur_image, caption[MAIN_CAPTION_OR_IMAGE], context))
-            if isinstance(caption[SUB_CAPTION_OR_IMAGE], list):
-                # multiple caps for one image:
-                long_caption = caption[MAIN_CAPTION_OR_IMAGE]
-                for subcap in caption[SUB_CAPTION_OR_IMAGE]:
-                    if long_caption != '':
-                        long_caption += ' : '
-                    long_caption += subcap
-                extracted_image_data.append((cur_image, long_caption, context))
-            else:
-                extracted_image_data.append(
-                    (cur_image, caption[SUB_CAPTION_OR_IMAGE]. context))
+                    long_caption = caption + ' : ' + 'Caption not extracted'
+                subfigures.append(Figure(
+                    sub_image, long_caption, context,
+                    tex_file=tex_file, line=line_index))
+            # the main image only goes with the main caption
+            extracted_image_data.append(Figure(
+                image if caption != '' else '', caption, context,
+                subfigures=subfigures, tex_file=tex_file, line=line_index))
+
+        elif sub_images is not None:
+            add_figure(image, caption, sub_images)
+
+        elif sub_captions is not None:
+            if caption != '':
+                add_figure(image, caption)
+            # multiple caps for one image:
+            long_caption = caption
+            for sub_caption in sub_captions:
+                if long_caption != '':
+                    long_caption += ' : '
+                long_caption += sub_caption
+            add_figure(image, long_caption)
 
         else:
-            extracted_image_data.append((cur_image, caption, context))
+            add_figure(image, caption)
 
-    elif cur_image != '' and caption == '':
+    elif cur_figure.has_image:
         # we may have missed the caption somewhere.
+        if brace_matcher is None:
+            brace_matcher = BraceMatcher(lines)
         REASONABLE_SEARCHBACK = 25
         REASONABLE_SEARCHFORWARD = 5
         curly_no_tag_preceding = '(?<!\\w){'
@@ -687,7 +908,8 @@ def put_it_together(cur_image, caption, context, extracted_image_data,
                 open_curly = m.start()
                 open_curly, open_curly_line, close_curly, \
                     close_curly_line = find_open_and_close_braces(
-                        line_index - searchback, open_curly, '{', lines)
+                        line_index - searchback, open_curly, '{', lines,
+                        brace_matcher)
 
                 cap_begin = open_curly + 1
 
@@ -695,14 +917,10 @@ def put_it_together(cur_image, caption, context, extracted_image_data,
                                            close_curly_line, close_curly,
                                            lines)
 
-                if isinstance(cur_image, list):
-                    extracted_image_data.append(
-                        (cur_image[MAIN_CAPTION_OR_IMAGE], caption, context))
-                    for sub_img in cur_image[SUB_CAPTION_OR_IMAGE]:
-                        extracted_image_data.append(
-                            (sub_img, caption, context))
+                if sub_images is not None:
+                    add_figure(image, caption, sub_images)
                 else:
-                    extracted_image_data.append((cur_image, caption, context))
+                    add_figure(image, caption)
                     break
 
         if caption == '':
@@ -717,7 +935,8 @@ def put_it_together(cur_image, caption, context, extracted_image_data,
                     open_curly = m.start()
                     open_curly, open_curly_line, close_curly, \
                         close_curly_line = find_open_and_close_braces(
-                            line_index + searchforward, open_curly, '{', lines)
+                            line_index + searchforward, open_curly, '{',
+                            lines, brace_matcher)
 
                     cap_begin = open_curly + 1
 
@@ -725,44 +944,21 @@ def put_it_together(cur_image, caption, context, extracted_image_data,
                                                cap_begin, close_curly_line,
                                                close_curly, lines)
 
-                    if isinstance(cur_image, list):
-                        extracted_image_data.append(
-                            (cur_image[MAIN_CAPTION_OR_IMAGE],
-                             caption, context))
-                        for sub_img in cur_image[SUB_CAPTION_OR_IMAGE]:
-                            extracted_image_data.append(
-                                (sub_img, caption, context))
-                    else:
-                        extracted_image_data.append(
-                            (cur_image, caption, context))
+                    add_figure(image, caption, sub_images or ())
                     break
 
         if caption == '':
-            if isinstance(cur_image, list):
-                extracted_image_data.append(
-                    (cur_image[MAIN_CAPTION_OR_IMAGE], 'No caption found',
-                     context))
-                for sub_img in cur_image[SUB_CAPTION_OR_IMAGE]:
-                    extracted_image_data.append(
-                        (sub_img, 'No caption', context))
-            else:
-                extracted_image_data.append(
-                    (cur_image, 'No caption found', context))
-
-    elif caption != '' and cur_image == '':
-        if isinstance(caption, list):
-            long_caption = caption[MAIN_CAPTION_OR_IMAGE]
-            for subcap in caption[SUB_CAPTION_OR_IMAGE]:
-                long_caption = long_caption + ': ' + subcap
-        else:
-            long_caption = caption
-        extracted_image_data.append(('', 'noimg' + long_caption, context))
+            add_figure(image, 'No caption found', sub_images or (),
+                       sub_caption='No caption')
 
-    # if we're leaving the figure, no sense keeping the data
-    cur_image = ''
-    caption = ''
+    elif cur_figure.has_caption:
+        long_caption = caption
+        for sub_caption in sub_captions or ():
+            long_caption = long_caption + ': ' + sub_caption
+        add_figure('', 'noimg' + long_caption)
 
-    return cur_image, caption, extracted_image_data
+    # if we're leaving the figure, no sense keeping the data
+    return PendingFigure(), extracted_image_data
 
 
 def intelligently_find_filenames(line, TeX=False, ext=False,
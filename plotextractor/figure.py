@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of plotextractor.
+# Copyright (C) 2015, 2020 CERN.
+#
+# plotextractor is free software; you can redistribute it
+# and/or modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# plotextractor is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with plotextractor; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+# MA 02111-1307, USA.
+#
+# In applying this license, CERN does not
+# waive the privileges and immunities granted to it by virtue of its status
+# as an Intergovernmental Organization or submit itself to any jurisdiction.
+
+"""Figure records."""
+
+
+class Figure(object):
+
+    """A figure found in a TeX file.
+
+    Figures are first extracted from the TeX with their raw ``image`` name,
+    ``caption`` and ``label``, and the position (``tex_file`` and ``line``)
+    where they end. The ``subfigures`` of a figure are figures too.
+
+    Once their image is resolved, they get the ``path`` of the (converted)
+    image, its ``original_path`` and ``name``, the ``captions`` of all the
+    references to the image and, optionally, its ``contexts``, extra
+    ``metadata``, the ``url`` of the image when it was uploaded to a sink
+    and the ``graphics_options`` (page and size) the TeX includes it with.
+    """
+
+    __slots__ = (
+        'image', 'caption', 'label', 'subfigures', 'tex_file', 'line',
+        'path', 'original_path', 'name', 'captions', 'contexts', 'metadata',
+        'url', 'graphics_options',
+    )
+
+    def __init__(self, image, caption, label, subfigures=(),
+                 tex_file=None, line=None):
+        self.image = image
+        self.caption = caption
+        self.label = label
+        self.subfigures = subfigures
+        self.tex_file = tex_file
+        self.line = line
+        self.path = None
+        self.original_path = None
+        self.name = None
+        self.captions = None
+        self.contexts = None
+        self.metadata = None
+        self.url = None
+        self.graphics_options = None
+
+    def __repr__(self):
+        return 'Figure({0!r}, {1!r}, {2!r})'.format(
+            self.image, self.caption, self.label)
+
+    def iter_figures(self):
+        """Iterate over this figure and its subfigures."""
+        yield self
+        for subfigure in self.subfigures:
+            yield subfigure
+
+    def to_dict(self):
+        """Return the figure as returned by ``process_tarball``."""
+        figure = dict(
+            url=self.url or self.path,
+            original_url=self.original_path,
+            captions=self.captions,
+            label=self.label,
+            name=self.name,
+        )
+        if self.contexts is not None:
+            figure['contexts'] = self.contexts
+        if self.graphics_options:
+            figure['graphics_options'] = self.graphics_options
+        if self.metadata:
+            figure.update(self.metadata)
+        return figure
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of plotextractor.
+# Copyright (C) 2020 CERN.
+#
+# plotextractor is free software; you can redistribute it
+# and/or modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# plotextractor is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with plotextractor; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+# MA 02111-1307, USA.
+#
+# In applying this license, CERN does not
+# waive the privileges and immunities granted to it by virtue of its status
+# as an Intergovernmental Organization or submit itself to any jurisdiction.
+
+"""Image dimensions read from file headers, without decoding the image."""
+
+import re
+import struct
+
+# PDF and PostScript keep their page size somewhere near the top.
+VECTOR_HEAD_SIZE = 256 * 1024
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+JPEG_SIGNATURE = b'\xff\xd8\xff'
+GIF_SIGNATURES = (b'GIF87a', b'GIF89a')
+PDF_SIGNATURE = b'%PDF'
+POSTSCRIPT_SIGNATURE = b'%!'
+# PostScript with a binary preview, as written by some Windows tools
+DOS_EPS_SIGNATURE = b'\xc5\xd0\xd3\xc6'
+
+# the JPEG start of frame markers, which carry the image size
+JPEG_SOF_MARKERS = frozenset(range(0xc0, 0xd0)) - frozenset((0xc4, 0xc8, 0xcc))
+
+NUMBER = br'(-?[\d.]+)'
+MEDIA_BOX = re.compile(
+    br'/MediaBox\s*\[\s*' + br'\s+'.join([NUMBER] * 4) + br'\s*\]')
+BOUNDING_BOX = re.compile(
+    br'%%BoundingBox:\s*' + br'\s+'.join([NUMBER] * 4))
+
+VECTOR_FORMATS = ('pdf', 'ps')
+
+
+def get_image_size(image_file):
+    """Read the format and size of an image from its header.
+
+    :param: image_file (string): path to the image.
+
+    :return: (format, width, height) with the size in pixels for rasters and
+        in points for ``'pdf'`` and ``'ps'`` (which covers EPS), or None when
+        the format is unknown or the header could not be read.
+    """
+    try:
+        with open(image_file, 'rb') as f:
+            return read_image_size(f)
+    except (IOError, OSError):
+        return None
+
+
+def read_image_size(f):
+    """Read the format and size of an image from a seekable file object.
+
+    See :func:`get_image_size`.
+    """
+    try:
+        head = f.read(32)
+        if head.startswith(PNG_SIGNATURE):
+            if head[12:16] != b'IHDR':
+                return None
+            width, height = struct.unpack('>II', head[16:24])
+            return 'png', width, height
+        if head.startswith(GIF_SIGNATURES):
+            width, height = struct.unpack('<HH', head[6:10])
+            return 'gif', width, height
+        if head.startswith(JPEG_SIGNATURE):
+            f.seek(2)
+            return _read_jpeg_size(f)
+        if head.startswith(PDF_SIGNATURE):
+            f.seek(0)
+            return _read_box('pdf', MEDIA_BOX, f.read(VECTOR_HEAD_SIZE))
+        if head.startswith(POSTSCRIPT_SIGNATURE):
+            f.seek(0)
+            return _read_box('ps', BOUNDING_BOX, f.read(VECTOR_HEAD_SIZE))
+        if head.startswith(DOS_EPS_SIGNATURE):
+            offset, length = struct.unpack('<II', head[4:12])
+            f.seek(offset)
+            return _read_box(
+                'ps', BOUNDING_BOX, f.read(min(length, VECTOR_HEAD_SIZE)))
+    except (IOError, OSError, struct.error):
+        return None
+    return None
+
+
+def _read_jpeg_size(f):
+    while True:
+        marker = f.read(2)
+        if len(marker) < 2 or marker[0:1] != b'\xff':
+            return None
+        marker_type = ord(marker[1:2])
+        if marker_type == 0xff:
+            # padding before the actual marker
+            f.seek(-1, 1)
+            continue
+        segment_length, = struct.unpack('>H', f.read(2))
+        if marker_type in JPEG_SOF_MARKERS:
+            height, width = struct.unpack('>xHH', f.read(5))
+            return 'jpeg', width, height
+        f.seek(segment_length - 2, 1)
+
+
+def _read_box(image_format, box_pattern, head):
+    box = box_pattern.search(head)
+    if box is None:
+        return None
+    try:
+        left, bottom, right, top = [float(value) for value in box.groups()]
+    except ValueError:
+        return None
+    return image_format, abs(right - left), abs(top - bottom)
+
+
+def is_vector(image_size):
+    """Tell if the size returned by ``get_image_size`` is in points."""
+    return image_size is not None and image_size[0] in VECTOR_FORMATS
@@ -23,15 +23,105 @@
 # as an Intergovernmental Organization or submit itself to any jurisdiction.
 
 
+import bisect
+import itertools
 import os
 import re
+import shutil
 import sys
 import six
 
 from collections import OrderedDict
 
+from .config import CFG_PLOTEXTRACTOR_IMAGE_LOCATION_PIECES
+from .figure import Figure
 
-def find_open_and_close_braces(line_index, start, brace, lines):
+
+BRACE_PAIRS = {
+    '{': ('{', '}'),
+    '}': ('{', '}'),
+    '[': ('[', ']'),
+    ']': ('[', ']'),
+    '(': ('(', ')'),
+    ')': ('(', ')'),
+}
+
+# escaped characters, comments and braces of each type
+BRACE_TOKENS = dict(
+    (open_brace, re.compile(r'\\.|%|' + re.escape(open_brace) + '|' +
+                            re.escape(close_brace)))
+    for open_brace, close_brace in BRACE_PAIRS.values()
+)
+
+# extensions of the images that can be served in another format than PNG:
+# rasters that were not converted, and vector images
+KEPT_IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.webp', '.pdf', '.svg')
+
+
+class BraceMatcher(object):
+
+    """Matching braces of a document, paired in a single pass.
+
+    The braces of each type are paired the first time they are looked for.
+    Escaped braces (like ``\\{``) and braces in comments are ignored.
+    """
+
+    def __init__(self, lines):
+        self.lines = lines
+        # by type of brace, the positions of the opening braces in document
+        # order, and of the closing brace matching each of them
+        self.opening = {}
+        self.closing = {}
+
+    def pair(self, open_brace):
+        """Pair all the braces of a type."""
+        opening = []
+        closing = {}
+        pending = []
+        brace_tokens = BRACE_TOKENS[open_brace]
+        for line_index, line in enumerate(self.lines):
+            for token in brace_tokens.finditer(line):
+                brace = token.group()
+                if brace == open_brace:
+                    position = (line_index, token.start())
+                    opening.append(position)
+                    pending.append(position)
+                elif brace == '%':
+                    break
+                elif len(brace) == 1 and pending:
+                    closing[pending.pop()] = (line_index, token.start())
+        self.opening[open_brace] = opening
+        self.closing[open_brace] = closing
+
+    def find(self, line_index, start, brace):
+        """Find the first pair of braces from a position.
+
+        See :func:`find_open_and_close_braces`.
+        """
+        if brace not in BRACE_PAIRS:
+            # unacceptable brace type!
+            return (-1, -1, -1, -1)
+
+        open_brace = BRACE_PAIRS[brace][0]
+        if open_brace not in self.opening:
+            self.pair(open_brace)
+        opening = self.opening[open_brace]
+        index = bisect.bisect_left(opening, (line_index, start))
+        if index == len(opening):
+            # failed to find open braces...
+            return (0, line_index, 0, line_index)
+
+        open_position = opening[index]
+        close_line, close_index = self.closing[open_brace].get(
+            open_position,
+            # hanging braces!
+            open_position
+        )
+        return (open_position[1], open_position[0], close_index, close_line)
+
+
+def find_open_and_close_braces(line_index, start, brace, lines,
+                               brace_matcher=None):
     """
     Take the line where we want to start and the index where we want to start
     and find the first instance of matched open and close braces of the same
@@ -43,80 +133,17 @@ def find_open_and_close_braces(line_index, start, brace, lines):
         [, or ])
     :param lines ([string, string, ...]): the array of lines in the file we
         are looking in.
+    :param brace_matcher (BraceMatcher): the braces of lines, when looking
+        for several of them in the same lines (optional)
 
     :return: (start, start_line, end, end_line): (int, int, int): the index
         of the start and end of whatever braces we are looking for, and the
         line number that the end is on (since it may be different than the line
         we started on)
     """
-
-    if brace in ['[', ']']:
-        open_brace = '['
-        close_brace = ']'
-    elif brace in ['{', '}']:
-        open_brace = '{'
-        close_brace = '}'
-    elif brace in ['(', ')']:
-        open_brace = '('
-        close_brace = ')'
-    else:
-        # unacceptable brace type!
-        return (-1, -1, -1, -1)
-
-    open_braces = []
-    line = lines[line_index]
-
-    ret_open_index = line.find(open_brace, start)
-    line_index_cpy = line_index
-    # sometimes people don't put the braces on the same line
-    # as the tag
-    while ret_open_index == -1:
-        line_index = line_index + 1
-        if line_index >= len(lines):
-            # failed to find open braces...
-            return (0, line_index_cpy, 0, line_index_cpy)
-        line = lines[line_index]
-        ret_open_index = line.find(open_brace)
-
-    open_braces.append(open_brace)
-
-    ret_open_line = line_index
-
-    open_index = ret_open_index
-    close_index = ret_open_index
-
-    while len(open_braces) > 0:
-        if open_index == -1 and close_index == -1:
-            # we hit the end of the line!  oh, noez!
-            line_index = line_index + 1
-
-            if line_index >= len(lines):
-                # hanging braces!
-                return (ret_open_index, ret_open_line,
-                        ret_open_index, ret_open_line)
-
-            line = lines[line_index]
-            # to not skip things that are at the beginning of the line
-            close_index = line.find(close_brace)
-            open_index = line.find(open_brace)
-
-        else:
-            if close_index != -1:
-                close_index = line.find(close_brace, close_index + 1)
-            if open_index != -1:
-                open_index = line.find(open_brace, open_index + 1)
-
-        if close_index != -1:
-            open_braces.pop()
-            if len(open_braces) == 0 and \
-                    (open_index > close_index or open_index == -1):
-                break
-        if open_index != -1:
-            open_braces.append(open_brace)
-
-    ret_close_index = close_index
-
-    return (ret_open_index, ret_open_line, ret_close_index, line_index)
+    if brace_matcher is None:
+        brace_matcher = BraceMatcher(lines)
+    return brace_matcher.find(line_index, start, brace)
 
 
 def assemble_caption(begin_line, begin_index, end_line, end_index, lines):
@@ -142,12 +169,11 @@ def assemble_caption(begin_line, begin_index, end_line, end_index, lines):
     # reassemble that sucker
     if end_line > begin_line:
         # our caption spanned multiple lines
-        caption = lines[begin_line][begin_index:]
-
-        for included_line_index in range(begin_line + 1, end_line):
-            caption = caption + ' ' + lines[included_line_index]
-
-        caption = caption + ' ' + lines[end_line][:end_index]
+        caption = ' '.join(itertools.chain(
+            [lines[begin_line][begin_index:]],
+            itertools.islice(lines, begin_line + 1, end_line),
+            [lines[end_line][:end_index]],
+        ))
         caption = caption.replace('\n', ' ')
         caption = caption.replace('  ', ' ')
     else:
@@ -172,149 +198,249 @@ def assemble_caption(begin_line, begin_index, end_line, end_index, lines):
 
 
 def prepare_image_data(extracted_image_data, output_directory,
-                       image_mapping):
+                       image_mapping, prepared_images=None,
+                       image_metadata=None, urls=None, image_options=None):
     """Prepare and clean image-data from duplicates and other garbage.
 
-    :param: extracted_image_data ([(string, string, list, list) ...],
-        ...])): the images and their captions + contexts, ordered
-    :param: tex_file (string): the location of the TeX (used for finding the
-        associated images; the TeX is assumed to be in the same directory
-        as the converted images)
-    :param: image_list ([string, string, ...]): a list of the converted
+    :param: extracted_image_data ([Figure, Figure, ...]): the figures and
+        their captions, ordered
+    :param: output_directory (string): the location of the TeX (used for
+        finding the associated images; the TeX is assumed to be in the same
+        directory as the converted images)
+    :param: image_mapping ({new_image: original_image, ...}): the converted
         image file names
-    :return extracted_image_data ([(string, string, list, list) ...],
-        ...])) again the list of image data cleaned for output
+    :param: prepared_images (OrderedDict): the figures already prepared for
+        other TeX files of the same tarball, by location. New figures are
+        added to it and the captions of known ones are merged. (optional)
+    :param: image_metadata (dict): extra info to add to the figures, by
+        converted image file (optional)
+    :param: urls (dict): the urls of the images uploaded to a sink, by
+        converted image file (optional)
+    :param: image_options (dict): the options the TeX includes the images
+        with, by original image file (optional)
+    :return extracted_image_data ([Figure, Figure, ...]): the figures (and
+        subfigures) whose image was found, with their paths and captions, but
+        without the ones that were already in prepared_images
     """
-    img_list = OrderedDict()
-    for image, caption, label in extracted_image_data:
+    if prepared_images is None:
+        prepared_images = OrderedDict()
+    img_list = []
+    locator = ImageLocator(output_directory, image_mapping.keys())
+    for figure in itertools.chain.from_iterable(
+            extracted_figure.iter_figures()
+            for extracted_figure in extracted_image_data):
+        image, caption = figure.image, figure.caption
         if not image or image == 'ERROR':
             continue
-        image_location = get_image_location(
-            image,
-            output_directory,
-            image_mapping.keys()
-        )
+        image_location = locator.locate(image)
 
         if not image_location or not os.path.exists(image_location) or \
                 len(image_location) < 3:
             continue
 
         image_location = os.path.normpath(image_location)
-        if image_location in img_list:
-            if caption not in img_list[image_location]['captions']:
-                img_list[image_location]['captions'].append(caption)
+        if image_location in prepared_images:
+            prepared_figure = prepared_images[image_location]
+            if caption not in prepared_figure.captions:
+                prepared_figure.captions.append(caption)
         else:
-            img_list[image_location] = dict(
-                url=image_location,
-                original_url=image_mapping[image_location],
-                captions=[caption],
-                label=label,
-                name=get_name_from_path(image_location, output_directory)
-            )
-    return img_list.values()
-
-
-def get_image_location(image, sdir, image_list, recurred=False):
+            prepared_figure = Figure(
+                image, caption, figure.label,
+                tex_file=figure.tex_file, line=figure.line)
+            prepared_figure.path = image_location
+            prepared_figure.original_path = image_mapping[image_location]
+            prepared_figure.captions = [caption]
+            prepared_figure.name = get_name_from_path(
+                image_location, output_directory)
+            if image_metadata and image_location in image_metadata:
+                prepared_figure.metadata = image_metadata[image_location]
+            if urls:
+                prepared_figure.url = urls.get(image_location)
+            if image_options:
+                prepared_figure.graphics_options = image_options.get(
+                    prepared_figure.original_path)
+            prepared_images[image_location] = prepared_figure
+            img_list.append(prepared_figure)
+    return img_list
+
+
+def get_image_location(image, sdir, image_list, recurred=False,
+                       locator=None):
     """Take a raw image name + directory and return the location of image.
 
     :param: image (string): the name of the raw image from the TeX
     :param: sdir (string): the directory where everything was unzipped to
     :param: image_list ([string, string, ...]): the list of images that
         were extracted from the tarball and possibly converted
+    :param: locator (ImageLocator): the index of the images of sdir and
+        image_list, to share between the images of a TeX file (optional)
 
     :return: converted_image (string): the full path to the (possibly
         converted) image file
     """
-    if isinstance(image, list):
-        # image is a list, not good
-        return None
-    image = image.decode('utf-8') if sys.version_info[0] == 2 else str(image)
-    image = image.strip()
+    if locator is None:
+        locator = ImageLocator(sdir, image_list)
+    return locator.locate(image, recurred)
 
-    figure_or_file = '(figure=|file=)'
-    figure_or_file_in_image = re.findall(figure_or_file, image)
-    if len(figure_or_file_in_image) > 0:
-        image = image.replace(figure_or_file_in_image[0], '')
-
-    includegraphics = r'\\includegraphics{(.+)}'
-    includegraphics_in_image = re.findall(includegraphics, image)
-    if len(includegraphics_in_image) > 0:
-        image = includegraphics_in_image[0]
-
-    image = image.strip()
-
-    some_kind_of_tag = '\\\\\\w+ '
-
-    if image.startswith('./'):
-        image = image[2:]
-    if re.match(some_kind_of_tag, image):
-        image = image[len(image.split(' ')[0]) + 1:]
-    if image.startswith('='):
-        image = image[1:]
-
-    if len(image) == 1:
-        return None
 
-    image = image.strip()
-    converted_image_should_be = get_converted_image_name(image)
+class ImageLocator(object):
 
-    if image_list is None:
-        image_list = os.listdir(sdir)
+    """Find the files of the images named in a TeX file.
 
-    for png_image in image_list:
-        png_image_rel = os.path.relpath(png_image, start=sdir)
-        if converted_image_should_be == png_image_rel:
-            return png_image
-
-    # maybe it's in a subfolder (TeX just understands that)
-    for prefix in ['eps', 'fig', 'figs', 'figures', 'figs', 'images']:
-        if os.path.isdir(os.path.join(sdir, prefix)):
-            image_list = os.listdir(os.path.join(sdir, prefix))
-            for png_image in image_list:
-                if converted_image_should_be == png_image:
-                    return os.path.join(sdir, prefix, png_image)
+    The image list and the directories searched are indexed once, and the
+    names looked up are memoized, so that resolving all the images of a
+    TeX file scans every directory at most once.
+    """
 
-    # maybe it is actually just loose.
-    for png_image in os.listdir(sdir):
-        if os.path.split(converted_image_should_be)[-1] == png_image:
+    def __init__(self, sdir, image_list,
+                 max_pieces=CFG_PLOTEXTRACTOR_IMAGE_LOCATION_PIECES):
+        """Index the images.
+
+        :param: sdir (string): the directory where everything was unzipped to
+        :param: image_list ([string, string, ...]): the list of images that
+            were extracted from the tarball and possibly converted
+        :param: max_pieces (int): how many pieces of a name that cannot be
+            found as a whole are tried, at most
+        """
+        self.sdir = sdir
+        if image_list is None:
+            image_list = os.listdir(sdir)
+        self.image_list_rel = OrderedDict()
+        for png_image in image_list:
+            self.image_list_rel.setdefault(
+                os.path.relpath(png_image, start=sdir), png_image)
+        self.kept_image_stems = {}
+        self.loose_kept_image_stems = {}
+        for kept_image_rel, kept_image in self.image_list_rel.items():
+            if kept_image_rel.lower().endswith(KEPT_IMAGE_EXTENSIONS):
+                kept_image_stem = os.path.splitext(kept_image_rel)[0]
+                self.kept_image_stems.setdefault(kept_image_stem, kept_image)
+                if kept_image_stem.count(os.sep) <= 1:
+                    self.loose_kept_image_stems.setdefault(
+                        os.path.basename(kept_image_stem), kept_image)
+        self.max_pieces = max_pieces
+        self._directories = {}
+        self._loose_images = None
+        self._locations = {}
+
+    def listdir(self, directory):
+        """Return the names in a directory, read once."""
+        if directory not in self._directories:
+            self._directories[directory] = os.listdir(directory)
+        return self._directories[directory]
+
+    @property
+    def loose_images(self):
+        """Map the file names of sdir and its subdirectories to the first
+        subdirectory (None for sdir itself) they are found in."""
+        if self._loose_images is None:
+            self._loose_images = {}
+            for png_image in self.listdir(self.sdir):
+                self._loose_images.setdefault(png_image, None)
+                # try that, too!  we just do two levels, because that's all
+                # that's reasonable..
+                sub_dir = os.path.join(self.sdir, png_image)
+                if os.path.isdir(sub_dir):
+                    for sub_dir_file in self.listdir(sub_dir):
+                        self._loose_images.setdefault(sub_dir_file, sub_dir)
+        return self._loose_images
+
+    def locate(self, image, recurred=False):
+        """Return the location of an image, see :func:`get_image_location`.
+        """
+        if isinstance(image, list):
+            # image is a list, not good
+            return None
+        key = (image, recurred)
+        if key not in self._locations:
+            self._locations[key] = self._locate(image, recurred)
+        return self._locations[key]
+
+    def _locate(self, image, recurred):
+        sdir = self.sdir
+        image = image.decode('utf-8') if sys.version_info[0] == 2 \
+            else str(image)
+        image = image.strip()
+
+        figure_or_file = '(figure=|file=)'
+        figure_or_file_in_image = re.findall(figure_or_file, image)
+        if len(figure_or_file_in_image) > 0:
+            image = image.replace(figure_or_file_in_image[0], '')
+
+        includegraphics = r'\\includegraphics{(.+)}'
+        includegraphics_in_image = re.findall(includegraphics, image)
+        if len(includegraphics_in_image) > 0:
+            image = includegraphics_in_image[0]
+
+        image = image.strip()
+
+        some_kind_of_tag = '\\\\\\w+ '
+
+        if image.startswith('./'):
+            image = image[2:]
+        if re.match(some_kind_of_tag, image):
+            image = image[len(image.split(' ')[0]) + 1:]
+        if image.startswith('='):
+            image = image[1:]
+
+        if len(image) == 1:
+            return None
+
+        image = image.strip()
+        converted_image_should_be = get_converted_image_name(image)
+
+        # rasters that were not converted keep their own extension
+        for image_rel in (image, converted_image_should_be):
+            if image_rel in self.image_list_rel:
+                return self.image_list_rel[image_rel]
+
+        # the TeX can leave the extension of a kept raster out, too
+        image_stem = os.path.splitext(converted_image_should_be)[0]
+        if image_stem in self.kept_image_stems:
+            return self.kept_image_stems[image_stem]
+
+        # maybe it's in a subfolder (TeX just understands that)
+        for prefix in ['eps', 'fig', 'figs', 'figures', 'figs', 'images']:
+            if os.path.isdir(os.path.join(sdir, prefix)):
+                if converted_image_should_be in \
+                        self.listdir(os.path.join(sdir, prefix)):
+                    return os.path.join(
+                        sdir, prefix, converted_image_should_be)
+                if os.path.join(prefix, image_stem) in self.kept_image_stems:
+                    return self.kept_image_stems[
+                        os.path.join(prefix, image_stem)]
+
+        # maybe it is actually just loose.
+        converted_image_name = os.path.split(converted_image_should_be)[-1]
+        if converted_image_name in self.loose_images:
+            sub_dir = self.loose_images[converted_image_name]
+            if sub_dir is None:
+                return converted_image_should_be
+            return os.path.join(sub_dir, converted_image_should_be)
+        if image_stem in self.loose_kept_image_stems:
+            return self.loose_kept_image_stems[image_stem]
+
+        # maybe it's actually up a directory or two: this happens in nested
+        # tarballs where the TeX is stored in a different directory from the
+        # images
+        if converted_image_name in self.listdir(os.path.split(sdir)[0]):
             return converted_image_should_be
-        if os.path.isdir(os.path.join(sdir, png_image)):
-            # try that, too!  we just do two levels, because that's all that's
-            # reasonable..
-            sub_dir = os.path.join(sdir, png_image)
-            for sub_dir_file in os.listdir(sub_dir):
-                if os.path.split(converted_image_should_be)[-1] == sub_dir_file:  # noqa
-                    return os.path.join(sub_dir, converted_image_should_be)
-
-    # maybe it's actually up a directory or two: this happens in nested
-    # tarballs where the TeX is stored in a different directory from the images
-    for png_image in os.listdir(os.path.split(sdir)[0]):
-        if os.path.split(converted_image_should_be)[-1] == png_image:
-            return converted_image_should_be
-    for png_image in os.listdir(os.path.split(os.path.split(sdir)[0])[0]):
-        if os.path.split(converted_image_should_be)[-1] == png_image:
+        if converted_image_name in self.listdir(
+                os.path.split(os.path.split(sdir)[0])[0]):
             return converted_image_should_be
 
-    if recurred:
-        return None
+        if recurred:
+            return None
 
-    # agh, this calls for drastic measures
-    for piece in image.split(' '):
-        res = get_image_location(piece, sdir, image_list, recurred=True)
-        if res is not None:
-            return res
+        # agh, this calls for drastic measures
+        pieces = itertools.chain(
+            image.split(' '), image.split(','), image.split('='))
+        for piece in itertools.islice(pieces, self.max_pieces):
+            res = self.locate(piece, recurred=True)
+            if res is not None:
+                return res
 
-    for piece in image.split(','):
-        res = get_image_location(piece, sdir, image_list, recurred=True)
-        if res is not None:
-            return res
-
-    for piece in image.split('='):
-        res = get_image_location(piece, sdir, image_list, recurred=True)
-        if res is not None:
-            return res
-
-    return None
+        return None
 
 
 def get_converted_image_name(image):
@@ -421,3 +547,63 @@ def get_name_from_path(full_path, root_path):
     relative_image_path = os.path.relpath(full_path, root_path)
     return "_".join(relative_image_path.split('.')[:-1]).replace('/', '_')\
         .replace(';', '').replace(':', '')
+
+
+def keep_figure_files(figures, working_directory, output_directory=None,
+                      originals=False):
+    """Remove everything but the files of the figures from a directory.
+
+    The files of the figures are the ``url`` and, with ``originals``, the
+    ``original_url`` of every figure. When ``output_directory`` is another
+    directory, they are moved there under the same relative paths, the
+    figures are updated to point to them and the working directory is
+    removed altogether.
+
+    :param: figures ([dict, ...]): as returned by
+        :func:`~plotextractor.api.process_tarball`, updated in place
+    :param: working_directory (string): where the tarball was extracted
+    :param: output_directory (string): where to move the figure files to
+        (optional)
+    :param: originals (bool): also keep the original of every figure
+    """
+    working_directory = os.path.abspath(working_directory)
+    if output_directory is not None:
+        output_directory = os.path.abspath(output_directory)
+        if output_directory == working_directory:
+            output_directory = None
+
+    keys = ('url', 'original_url') if originals else ('url',)
+    kept = set()
+    for figure in figures:
+        for key in keys:
+            if figure.get(key) and os.path.isfile(figure[key]):
+                kept.add(os.path.relpath(figure[key], working_directory))
+
+    if output_directory is None:
+        for dirpath, dirnames, filenames in os.walk(
+                working_directory, topdown=False):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                if os.path.relpath(path, working_directory) not in kept:
+                    os.remove(path)
+            if dirpath != working_directory and not os.listdir(dirpath):
+                os.rmdir(dirpath)
+        return
+
+    for relative_path in kept:
+        if relative_path.startswith(os.pardir):
+            continue
+        destination = os.path.join(output_directory, relative_path)
+        if not os.path.isdir(os.path.dirname(destination)):
+            os.makedirs(os.path.dirname(destination))
+        shutil.move(os.path.join(working_directory, relative_path),
+                    destination)
+    for figure in figures:
+        for key in ('url', 'original_url'):
+            if figure.get(key):
+                relative_path = os.path.relpath(
+                    figure[key], working_directory)
+                if not relative_path.startswith(os.pardir):
+                    figure[key] = os.path.join(
+                        output_directory, relative_path)
+    shutil.rmtree(working_directory, ignore_errors=True)
@@ -0,0 +1,448 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of plotextractor.
+# Copyright (C) 2020 CERN.
+#
+# plotextractor is free software; you can redistribute it
+# and/or modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# plotextractor is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with plotextractor; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+# MA 02111-1307, USA.
+#
+# In applying this license, CERN does not
+# waive the privileges and immunities granted to it by virtue of its status
+# as an Intergovernmental Organization or submit itself to any jurisdiction.
+
+
+"""Overlapped extraction, classification, conversion and TeX reading.
+
+Every member of the tarball is classified as soon as it is written.
+Rasters are converted right away and TeX files read, in their own threads,
+while the rest of the tarball is still being extracted; vector images wait
+for the TeX file that tells how they are included. The stages are linked
+by bounded queues, so a slow stage holds back the ones before it.
+
+Images can also be converted straight from the bytes of their member,
+without writing them to disk.
+"""
+
+import os
+import sys
+import tempfile
+import threading
+from time import time
+
+import six
+from six.moves.queue import Queue
+
+from .config import (
+    CFG_PLOTEXTRACTOR_CLASSIFICATION_WORKERS,
+    CFG_PLOTEXTRACTOR_PIPELINE_QUEUE_SIZE,
+    CFG_PLOTEXTRACTOR_PNG_PRESET,
+)
+from .archive import iter_archive_members
+from .converter import (
+    ALLOWED_IMAGE_TYPES,
+    FileClassifier,
+    can_convert_blob,
+    convert_image_file,
+    extract_member,
+    get_raster_format,
+    plan_conversions,
+)
+from .extractor import get_image_options, get_lines_from_file
+from .output_utils import get_converted_image_name
+from .profiling import profile_calls
+from .resources import get_resource_governor
+
+_STOP = object()
+
+
+class Stage(object):
+
+    """Threads applying a function to the items put in a bounded queue.
+
+    When the function raises, the stage keeps draining its queue without
+    processing the items, so that the stages feeding it never block, and
+    the error is raised again by ``close``.
+    """
+
+    def __init__(self, function, workers=1,
+                 queue_size=CFG_PLOTEXTRACTOR_PIPELINE_QUEUE_SIZE):
+        self.function = profile_calls(function)
+        self.queue = Queue(queue_size)
+        self.error = None
+        self.threads = [
+            threading.Thread(target=self._run) for _ in range(workers)
+        ]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is _STOP:
+                return
+            if self.error is not None:
+                continue
+            try:
+                self.function(item)
+            except Exception:
+                self.error = sys.exc_info()
+
+    def put(self, item):
+        """Queue an item, waiting while the queue is full."""
+        self.queue.put(item)
+
+    def close(self):
+        """Wait for the queued items to be processed.
+
+        :raises: the first error of the function, if any.
+        """
+        for _ in self.threads:
+            self.queue.put(_STOP)
+        for thread in self.threads:
+            thread.join()
+        if self.error is not None:
+            six.reraise(*self.error)
+
+
+def run_pipeline(tarball, output_directory, postprocess=None,
+                 image_metadata=None, parsed_tex_files=None, timings=None,
+                 conversion_workers=None, keep_originals=True,
+                 uploader=None, png_preset=CFG_PLOTEXTRACTOR_PNG_PRESET,
+                 vector_format=None, image_options=None):
+    """Extract a tarball and convert its images, overlapping the stages.
+
+    Rasters are converted as soon as they are extracted. Other images, like
+    PDF and PostScript, are converted with the page and for the size the
+    TeX includes them with: as soon as a TeX file read so far gives these
+    options, or else once all the TeX files have been read. They are only
+    converted right away while no other source of the same converted image
+    was found; otherwise they wait for the whole tarball, so that only the
+    best source is converted, see
+    :func:`~plotextractor.converter.plan_conversions`. An image converted
+    right away is converted again if a better source, or other options,
+    turn up later. The sources that come after a raster are only converted
+    once it turned out that the raster could not be served.
+
+    :param: tarball (string): the tarball to process
+    :param: output_directory (string): the directory to untar in
+    :param: postprocess ([string, ...]): see
+        :func:`~plotextractor.converter.convert_images` (optional)
+    :param: image_metadata (dict): filled with the info of every
+        post-processed image, by converted image file (optional)
+    :param: parsed_tex_files (dict): filled with the lines of the TeX
+        files, see :func:`~plotextractor.extractor.extract_captions`
+        (optional)
+    :param: timings (dict): filled with the time spent extracting the
+        tarball (``untar``) and then waiting for the other stages
+        (``convert``), in seconds (optional)
+    :param: conversion_workers (int): number of conversion threads (by
+        default, the concurrency of the resource governor)
+    :param: keep_originals (bool): if False, the images that have to be
+        converted are converted from the bytes of their member, and only
+        the converted image is written to disk. PDF files and the images
+        served as they are are still written, and the bytes of the other
+        images are spooled to an anonymous temporary file until they are
+        converted.
+    :param: uploader (Uploader): where to submit every image as soon as it
+        is converted, see :mod:`plotextractor.sinks` (optional)
+    :param: png_preset (string): how to encode the PNGs, see
+        :func:`~plotextractor.converter.set_png_preset`
+    :param: vector_format (string): see
+        :func:`~plotextractor.converter.convert_vector_image` (optional)
+    :param: image_options (dict): filled with the options the TeX includes
+        the images with, see
+        :func:`~plotextractor.extractor.get_image_options` (optional)
+
+    :return: (image_mapping, tex_files): the converted images, mapped to
+        their original, and the TeX files, in the order of the tarball
+    """
+    if parsed_tex_files is None:
+        parsed_tex_files = {}
+    if timings is None:
+        timings = {}
+    if conversion_workers is None:
+        conversion_workers = get_resource_governor().concurrency
+    if image_options is None:
+        image_options = {}
+
+    classifier = FileClassifier(ALLOWED_IMAGE_TYPES)
+    kinds = {}
+    conversions = {}
+    rasters = set()
+    # how many members of the tarball would be converted to every name
+    names = {}
+    # the TeX files read so far, and the images waiting for their options
+    tex_files_read = []
+    waiting = []
+    # the images converted before the whole tarball was seen, with the
+    # options they were converted with, and when their conversion is done
+    early_options = {}
+    early_done = {}
+    # the content of the images that are not on disk, and its first bytes
+    spools = {}
+    heads = {}
+    lock = threading.Lock()
+    # the images converted only if the rasters served for them fail
+    fallbacks = []
+
+    def read_blob(image_file):
+        spool = spools.get(image_file)
+        if spool is None:
+            return None
+        spool.seek(0)
+        return spool.read()
+
+    def convert(item):
+        # the sources of the same converted image, until one converts
+        job, early = item
+        try:
+            for image_file, graphics_options in job:
+                converted = conversions[image_file] = convert_image_file(
+                    image_file, postprocess=postprocess,
+                    blob=read_blob(image_file),
+                    page=(graphics_options or {}).get('page', 0),
+                    png_preset=png_preset, vector_format=vector_format,
+                    graphics_options=graphics_options)
+                if converted is not None:
+                    break
+            else:
+                return
+            # converted early, it is only uploaded once it is kept
+            if uploader is not None and not early:
+                uploader.submit(converted[0])
+        finally:
+            if early:
+                early_done[get_converted_image_name(job[0][0])].set()
+
+    def convert_early(image_file, graphics_options):
+        # called with the lock held
+        early_options[image_file] = graphics_options
+        early_done[get_converted_image_name(image_file)] = threading.Event()
+        return [(image_file, graphics_options)], True
+
+    def add_member(extracted_file):
+        # an image converted early may be written where the member goes
+        converted_image_file = get_converted_image_name(extracted_file)
+        with lock:
+            names[converted_image_file] = \
+                names.get(converted_image_file, 0) + 1
+            return early_done.get(converted_image_file)
+
+    def wait_for_conversion(done):
+        while done is not None and not done.wait(1):
+            if conversion_stage.error is not None:
+                return
+
+    def queue_image(extracted_file, blob=None):
+        if blob is not None:
+            spool = spools[extracted_file] = tempfile.TemporaryFile()
+            spool.write(blob)
+            heads[extracted_file] = blob[:12]
+        item = None
+        with lock:
+            kinds[extracted_file] = 'image'
+            if get_raster_format(extracted_file, blob) is not None:
+                rasters.add(extracted_file)
+                item = [(extracted_file, None)], False
+            elif names[get_converted_image_name(extracted_file)] == 1:
+                graphics_options = get_image_options(
+                    tex_files_read, [extracted_file], output_directory,
+                    parsed_tex_files=parsed_tex_files).get(extracted_file)
+                if graphics_options:
+                    item = convert_early(extracted_file, graphics_options)
+                else:
+                    waiting.append(extracted_file)
+        if item is not None:
+            conversion_stage.put(item)
+
+    def read_tex(tex_file):
+        parsed_tex = parsed_tex_files.setdefault(
+            os.path.realpath(tex_file), {'captions': {}})
+        if 'lines' not in parsed_tex:
+            parsed_tex['lines'] = get_lines_from_file(tex_file)
+        items = []
+        with lock:
+            tex_files_read.append(tex_file)
+            waiting[:] = [
+                image_file for image_file in waiting
+                if names[get_converted_image_name(image_file)] == 1
+            ]
+            new_options = get_image_options(
+                [tex_file], waiting, output_directory,
+                parsed_tex_files=parsed_tex_files)
+            for image_file in list(waiting):
+                if image_file in new_options:
+                    waiting.remove(image_file)
+                    items.append(convert_early(
+                        image_file, new_options[image_file]))
+        for item in items:
+            conversion_stage.put(item)
+
+    def route(extracted_file, kind):
+        kinds[extracted_file] = kind
+        if kind == 'image':
+            queue_image(extracted_file)
+        elif kind == 'tex':
+            tex_stage.put(extracted_file)
+
+    def classify(extracted_file):
+        route(extracted_file, classifier.classify(extracted_file))
+
+    conversion_stage = Stage(convert, workers=conversion_workers)
+    tex_stage = Stage(read_tex)
+    classification_stage = Stage(
+        classify, workers=CFG_PLOTEXTRACTOR_CLASSIFICATION_WORKERS)
+
+    file_list = []
+    plan = {}
+    extracted = False
+    start = time()
+    try:
+        try:
+            for member in iter_archive_members(tarball):
+                extracted_file = os.path.join(output_directory, member.name)
+                file_list.append(extracted_file)
+                if member.isdir:
+                    extract_member(member, extracted_file)
+                    if keep_originals:
+                        classification_stage.put(extracted_file)
+                    continue
+                done = add_member(extracted_file)
+                if keep_originals:
+                    wait_for_conversion(done)
+                    extract_member(member, extracted_file)
+                    classification_stage.put(extracted_file)
+                    continue
+                blob = member.fileobj.read()
+                kind = classifier.classify(extracted_file, blob)
+                if kind == 'image' and can_convert_blob(
+                        blob, vector_format=vector_format):
+                    queue_image(extracted_file, blob)
+                else:
+                    wait_for_conversion(done)
+                    extract_member(member, extracted_file, blob)
+                    route(extracted_file, kind)
+            timings['untar'] = time() - start
+            extracted = True
+        finally:
+            start = time()
+            # closed in order, so that the stages downstream get everything
+            try:
+                try:
+                    classification_stage.close()
+                finally:
+                    tex_stage.close()
+            finally:
+                conversion_stage.close()
+
+        image_files = get_files(file_list, kinds, 'image')
+        image_options.update(get_image_options(
+            get_files(file_list, kinds, 'tex'), image_files,
+            output_directory, parsed_tex_files=parsed_tex_files))
+        plan = plan_conversions(image_files, vector_format, heads)
+        members = set(file_list)
+        deferred_stage = Stage(convert, workers=conversion_workers)
+        try:
+            for sources in plan.values():
+                jobs = [[]]
+                for image_file in sources:
+                    if image_file not in rasters:
+                        jobs[-1].append(
+                            (image_file, image_options.get(image_file)))
+                    elif len(jobs) == 1:
+                        # a raster, served as it is, unless it fails
+                        jobs.append([])
+                for image_file in sources:
+                    if image_file in early_options:
+                        keep_early_conversion(
+                            image_file, early_options[image_file], jobs[0],
+                            conversions, members, uploader)
+                if jobs[0]:
+                    deferred_stage.put((jobs[0], False))
+                if jobs[-1] and len(jobs) > 1:
+                    fallbacks.append((sources, jobs[-1]))
+        finally:
+            deferred_stage.close()
+
+        jobs = [
+            job for sources, job in fallbacks
+            if all(conversions.get(image_file) is None
+                   for image_file in sources)
+        ]
+        if jobs:
+            fallback_stage = Stage(convert, workers=conversion_workers)
+            try:
+                for job in jobs:
+                    fallback_stage.put((job, False))
+            finally:
+                fallback_stage.close()
+    finally:
+        for spool in spools.values():
+            spool.close()
+
+    image_mapping = {}
+    for sources in plan.values():
+        for image_file in sources:
+            converted = conversions.get(image_file)
+            if converted is None:
+                continue
+            converted_image_file, image_info = converted
+            image_mapping[converted_image_file] = image_file
+            if image_info and image_metadata is not None:
+                image_metadata[converted_image_file] = image_info
+    timings['convert'] = time() - start
+
+    return image_mapping, get_files(file_list, kinds, 'tex')
+
+
+def keep_early_conversion(image_file, graphics_options, job, conversions,
+                          members, uploader=None):
+    """Keep an image converted before the whole tarball was seen, if it is
+    still the one to convert, or else undo its conversion.
+
+    :param: image_file (string): the image converted early
+    :param: graphics_options (dict): the options it was converted with
+    :param: job ([(image_file, graphics_options), ...]): the sources to
+        convert, until one converts; updated for what is kept
+    :param: conversions (dict): the result of every conversion, by image
+    :param: members (set): the files of the tarball
+    :param: uploader (Uploader): where to submit the image, if it is kept
+        (optional)
+    """
+    converted = conversions[image_file]
+    if job and job[0] == (image_file, graphics_options) and (
+            converted is None or converted[0] == image_file or
+            converted[0] not in members):
+        del job[0]
+        if converted is not None:
+            del job[:]
+            if uploader is not None:
+                uploader.submit(converted[0])
+        return
+    # a better source, or other options, turned up: convert again, and do
+    # not leave the image behind if another source is kept
+    del conversions[image_file]
+    if converted is not None and converted[0] not in members and \
+            os.path.exists(converted[0]):
+        os.remove(converted[0])
+
+
+def get_files(file_list, kinds, kind):
+    """Return the files of a kind, in the order of the tarball."""
+    return [
+        extracted_file for extracted_file in file_list
+        if kinds.get(extracted_file) == kind
+    ]
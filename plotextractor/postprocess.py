@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of plotextractor.
+# Copyright (C) 2015, 2020 CERN.
+#
+# plotextractor is free software; you can redistribute it
+# and/or modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# plotextractor is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with plotextractor; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+# MA 02111-1307, USA.
+#
+# In applying this license, CERN does not
+# waive the privileges and immunities granted to it by virtue of its status
+# as an Intergovernmental Organization or submit itself to any jurisdiction.
+
+"""Vectorized post-processing of converted images.
+
+Requires :mod:`numpy`, which is only imported when post-processing is
+asked for.
+"""
+
+
+import numpy
+
+from .config import (
+    CFG_PLOTEXTRACTOR_GRAYSCALE_TOLERANCE,
+    CFG_PLOTEXTRACTOR_TRIM_FUZZ,
+)
+
+POSTPROCESS_OPERATIONS = ('flatten', 'trim', 'grayscale')
+
+CHANNEL_MAPS = {1: 'gray', 2: 'graya', 3: 'rgb', 4: 'rgba'}
+
+
+def flatten(pixels):
+    """Flatten RGBA pixels over a white background.
+
+    :param: pixels (numpy.ndarray): ``(height, width, 4)`` array of RGBA
+        pixels
+
+    :return: pixels (numpy.ndarray): ``(height, width, 3)`` array of RGB
+        pixels
+    """
+    alpha = pixels[..., 3:].astype(numpy.uint32)
+    rgb = pixels[..., :3].astype(numpy.uint32)
+    flattened = (rgb * alpha + 255 * (255 - alpha) + 127) // 255
+    return flattened.astype(numpy.uint8)
+
+
+def get_bounding_box(pixels, fuzz=CFG_PLOTEXTRACTOR_TRIM_FUZZ):
+    """Return the bounding box of what is not background in the pixels.
+
+    Like ImageMagick, the color of the top left pixel is taken as the
+    background.
+
+    :param: pixels (numpy.ndarray): ``(height, width, channels)`` array
+    :param: fuzz (int): how far from the background (0-255) a channel can be
+        while still being background
+
+    :return: bbox (tuple): ``(x, y, width, height)`` of the content, or
+        None if everything is background
+    """
+    background = pixels[0, 0].astype(numpy.int16)
+    distance = numpy.abs(pixels.astype(numpy.int16) - background).max(axis=2)
+    content = distance > fuzz
+    rows = numpy.flatnonzero(content.any(axis=1))
+    if not rows.size:
+        return None
+    columns = numpy.flatnonzero(content.any(axis=0))
+    return (
+        int(columns[0]),
+        int(rows[0]),
+        int(columns[-1] - columns[0] + 1),
+        int(rows[-1] - rows[0] + 1),
+    )
+
+
+def is_grayscale(pixels, tolerance=CFG_PLOTEXTRACTOR_GRAYSCALE_TOLERANCE):
+    """Tell whether the RGB channels of the pixels are (almost) equal."""
+    rgb = pixels[..., :3]
+    spread = rgb.max(axis=2).astype(numpy.int16) - rgb.min(axis=2)
+    return bool((spread <= tolerance).all())
+
+
+def postprocess_pixels(pixels, operations):
+    """Apply the post-processing operations on RGBA pixels.
+
+    :param: pixels (numpy.ndarray): ``(height, width, 4)`` array of RGBA
+        pixels
+    :param: operations ([string, ...]): which of ``'flatten'``, ``'trim'``
+        and ``'grayscale'`` to apply
+
+    :return: (pixels, info) (numpy.ndarray, dict): the processed pixels, with
+        1 (gray), 2 (gray and alpha), 3 (RGB) or 4 (RGBA) channels, and their
+        ``width``, ``height``, the ``bbox`` kept out of the original and
+        whether they are ``grayscale``
+    """
+    unknown = set(operations) - set(POSTPROCESS_OPERATIONS)
+    if unknown:
+        raise ValueError(
+            'Unknown post-processing operations: {0}'.format(
+                ', '.join(sorted(unknown))))
+
+    height, width = pixels.shape[:2]
+    if 'flatten' in operations:
+        pixels = flatten(pixels)
+
+    bbox = (0, 0, width, height)
+    if 'trim' in operations:
+        bbox = get_bounding_box(pixels) or bbox
+        x, y, width, height = bbox
+        pixels = pixels[y:y + height, x:x + width]
+
+    grayscale = 'grayscale' in operations and is_grayscale(pixels)
+    if grayscale:
+        # keep a single color channel, and alpha if there is one
+        pixels = pixels[..., [0] + list(range(3, pixels.shape[2]))]
+
+    info = {
+        'width': width,
+        'height': height,
+        'bbox': bbox,
+        'grayscale': grayscale,
+    }
+    return numpy.ascontiguousarray(pixels), info
+
+
+def postprocess_image(image, operations, image_info=None):
+    """Post-process a Wand image through its raster.
+
+    :param: image (wand.image.Image): the image to post-process
+    :param: operations ([string, ...]): see :func:`postprocess_pixels`
+    :param: image_info (dict): filled with the info returned by
+        :func:`postprocess_pixels` (optional)
+
+    :return: image (wand.image.Image): a new image, to be closed by the
+        caller
+    """
+    from wand.image import Image
+
+    image.depth = 8
+    width, height = image.width, image.height
+    # only the first frame, if there are several
+    blob = image.make_blob('rgba')[:width * height * 4]
+    pixels = numpy.frombuffer(blob, dtype=numpy.uint8)
+    pixels, info = postprocess_pixels(
+        pixels.reshape(height, width, 4), operations)
+    if image_info is not None:
+        image_info.update(info)
+
+    return Image(
+        blob=pixels.tobytes(),
+        format=CHANNEL_MAPS[pixels.shape[2]],
+        width=info['width'],
+        height=info['height'],
+        depth=8,
+    )
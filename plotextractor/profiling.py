@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of plotextractor.
+# Copyright (C) 2020 CERN.
+#
+# plotextractor is free software; you can redistribute it
+# and/or modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# plotextractor is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with plotextractor; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+# MA 02111-1307, USA.
+#
+# In applying this license, CERN does not
+# waive the privileges and immunities granted to it by virtue of its status
+# as an Intergovernmental Organization or submit itself to any jurisdiction.
+
+
+"""Profiles of the tarballs that are slow to process.
+
+The profile of a tarball is only kept when processing it took longer than
+a threshold, so that profiling can be left on in production runs to catch
+the pathological inputs.
+
+cProfile only sees the thread it is enabled in, so the functions run in
+other threads, like the stages of the pipeline and the uploads, are
+profiled on their own with :func:`profile_calls` and merged into the
+profile of the tarball.
+"""
+
+import os
+import threading
+from contextlib import contextmanager
+from time import time
+
+from .config import CFG_PLOTEXTRACTOR_PROFILER
+
+PROFILE_EXTENSIONS = {
+    'cprofile': '.prof',
+    'pyinstrument': '.html',
+}
+
+
+# the profiles of the calls run in other threads, for the profiled block of
+# the current thread
+_session = threading.local()
+
+
+def profile_calls(function):
+    """Profile the calls of a function run in other threads.
+
+    The profiles go to the :func:`profiled` block of the thread that wraps
+    the function, if any, so wrap it before handing it to the threads. The
+    functions wrapped during the calls, for threads they start in turn, go
+    to the same block.
+
+    :param: function (callable): the function the threads run
+
+    :return: the function, profiled if the current thread is profiled
+        with cProfile
+    """
+    profiles = getattr(_session, 'profiles', None)
+    if profiles is None:
+        return function
+
+    def profiled_function(*args, **kwargs):
+        import cProfile
+        outer_profiles = getattr(_session, 'profiles', None)
+        _session.profiles = profiles
+        profile = cProfile.Profile()
+        try:
+            try:
+                profile.enable()
+            except ValueError:
+                # Python 3.12 profiles all threads at once, and only once
+                return function(*args, **kwargs)
+            try:
+                return function(*args, **kwargs)
+            finally:
+                profile.disable()
+                profiles.append(profile)
+        finally:
+            _session.profiles = outer_profiles
+    return profiled_function
+
+
+def get_profile_path(tarball, profile_directory, profiler):
+    """Return where to write the profile of a tarball."""
+    return os.path.join(
+        profile_directory,
+        os.path.basename(tarball) + PROFILE_EXTENSIONS[profiler])
+
+
+@contextmanager
+def profiled(tarball, profile_directory, threshold=None,
+             profiler=CFG_PLOTEXTRACTOR_PROFILER):
+    """Profile the block, and save the profile if it was slow.
+
+    The profile is also saved when the block raises, however fast. With
+    cProfile, it includes the calls wrapped by :func:`profile_calls` in other
+    threads; pyinstrument only profiles the current thread.
+
+    :param: tarball (string): the tarball being processed, which names the
+        profile (``<tarball name>.prof`` or ``.html``)
+    :param: profile_directory (string): where to write the profile
+    :param: threshold (float): only keep the profile if the block took at
+        least that many seconds; None disables profiling.
+    :param: profiler (string): ``'cprofile'``, or ``'pyinstrument'`` for an
+        HTML report (requires pyinstrument).
+    """
+    if threshold is None:
+        yield
+        return
+    if profiler not in PROFILE_EXTENSIONS:
+        raise ValueError('Unknown profiler: {0}'.format(profiler))
+
+    if profiler == 'pyinstrument':
+        from pyinstrument import Profiler
+        profile = Profiler()
+        profile.start()
+    else:
+        import cProfile
+        profile = cProfile.Profile()
+        outer_profiles = getattr(_session, 'profiles', None)
+        profiles = _session.profiles = []
+        profile.enable()
+
+    start = time()
+    failed = True
+    try:
+        yield
+        failed = False
+    finally:
+        if profiler == 'pyinstrument':
+            profile.stop()
+        else:
+            profile.disable()
+            _session.profiles = outer_profiles
+        if failed or time() - start >= threshold:
+            profile_path = get_profile_path(
+                tarball, profile_directory, profiler)
+            if profile_directory and not os.path.isdir(profile_directory):
+                os.makedirs(profile_directory)
+            if profiler == 'pyinstrument':
+                with open(profile_path, 'w') as f:
+                    f.write(profile.output_html())
+            else:
+                import pstats
+                stats = pstats.Stats(profile)
+                for thread_profile in profiles:
+                    stats.add(thread_profile)
+                stats.dump_stats(profile_path)
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of plotextractor.
+# Copyright (C) 2015, 2020 CERN.
+#
+# plotextractor is free software; you can redistribute it
+# and/or modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# plotextractor is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with plotextractor; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+# MA 02111-1307, USA.
+#
+# In applying this license, CERN does not
+# waive the privileges and immunities granted to it by virtue of its status
+# as an Intergovernmental Organization or submit itself to any jurisdiction.
+
+"""ImageMagick resource limits shared between conversions."""
+
+
+import os
+import threading
+from contextlib import contextmanager
+
+from .config import (
+    CFG_PLOTEXTRACTOR_CONVERSION_WORKERS,
+    CFG_PLOTEXTRACTOR_RESOURCE_BUDGET,
+)
+
+# resources used by all the conversions of a process together, as opposed to
+# the thread limit which applies to every single conversion
+SHARED_RESOURCES = ('memory', 'map', 'disk', 'area')
+
+
+class ResourceGovernor(object):
+
+    """Divide a global ImageMagick budget between concurrent conversions.
+
+    ImageMagick limits are per process, so every worker process owns its
+    governor, built with the total number of workers sharing the budget
+    (on the node), and ``concurrency`` the number of conversions this process
+    runs at the same time.
+
+    Limits missing from the budget are left to ImageMagick, but they are
+    still restored around every conversion since they sometimes
+    (usually on the first file of a record) reset to their default value
+    inside the ``Image`` blocks.
+    """
+
+    def __init__(self, budget=None, workers=None, concurrency=1):
+        self.budget = dict(CFG_PLOTEXTRACTOR_RESOURCE_BUDGET)
+        if budget:
+            self.budget.update(budget)
+        self.workers = workers or CFG_PLOTEXTRACTOR_CONVERSION_WORKERS
+        self.concurrency = concurrency
+        self._slots = threading.BoundedSemaphore(concurrency)
+        self._lock = threading.Lock()
+        self._active = 0
+        self._limits = None
+        self._pid = None
+
+    def worker_limits(self):
+        """Return the limits of one conversion worker.
+
+        :return: limits (dict): ImageMagick limits by resource, for the
+            resources in the budget
+        """
+        worker_limits = {}
+        for resource, value in self.budget.items():
+            if value is not None:
+                worker_limits[resource] = max(int(value) // self.workers, 1)
+        return worker_limits
+
+    def process_limits(self):
+        """Return the limits to set in this process.
+
+        :return: limits (dict): ImageMagick limits by resource
+        """
+        process_limits = self.worker_limits()
+        for resource in SHARED_RESOURCES:
+            if resource in process_limits:
+                process_limits[resource] *= self.concurrency
+        return process_limits
+
+    def apply(self):
+        """Set the ImageMagick limits of this process."""
+        from wand.resource import limits
+
+        if self._limits is None or self._pid != os.getpid():
+            # first use in this process, snapshot what is not configured
+            process_limits = dict(
+                (resource, limits[resource])
+                for resource in SHARED_RESOURCES
+            )
+            process_limits.update(self.process_limits())
+            self._limits = process_limits
+            self._pid = os.getpid()
+        for resource, value in self._limits.items():
+            limits[resource] = value
+
+    @contextmanager
+    def conversion(self):
+        """Run a conversion in one of the slots of this process."""
+        with self._slots:
+            with self._lock:
+                self._active += 1
+            try:
+                self.apply()
+                yield self
+            finally:
+                with self._lock:
+                    self._active -= 1
+
+    def usage(self):
+        """Return the current ImageMagick resource usage of this process.
+
+        :return: usage (dict): ``active`` conversions, and the ``used``
+            amount and ``limit`` of every resource
+        """
+        from wand.resource import limits
+
+        usage = {'active': self._active, 'workers': self.workers}
+        for resource in SHARED_RESOURCES + ('thread',):
+            usage[resource] = {
+                'used': limits.resource(resource),
+                'limit': limits[resource],
+            }
+        return usage
+
+
+_governor = None
+
+
+def get_resource_governor():
+    """Return the resource governor of this process, built from config."""
+    global _governor
+    if _governor is None:
+        _governor = ResourceGovernor()
+    return _governor
+
+
+def set_resource_governor(governor):
+    """Replace the resource governor used by the conversions."""
+    global _governor
+    _governor = governor
@@ -0,0 +1,316 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of plotextractor.
+# Copyright (C) 2015, 2020 CERN.
+#
+# plotextractor is free software; you can redistribute it
+# and/or modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# plotextractor is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with plotextractor; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+# MA 02111-1307, USA.
+#
+# In applying this license, CERN does not
+# waive the privileges and immunities granted to it by virtue of its status
+# as an Intergovernmental Organization or submit itself to any jurisdiction.
+
+"""HTTP extraction service with warm workers.
+
+Run it with ``plotextractor-service``, then ``POST /extract`` a JSON object
+with the ``tarball`` to process (and optionally its ``output_directory`` and
+``context``). The response is the record the batch runner writes for the
+tarball. ``GET /health`` and ``GET /metrics`` report on the service.
+"""
+
+
+import argparse
+import json
+import threading
+from multiprocessing import Pipe, Process
+from time import time
+
+from six.moves import BaseHTTPServer, socketserver
+from six.moves.queue import Empty, Queue
+
+from .cli import process_one
+
+
+def warm_up():
+    """Load the native libraries in a worker before it gets any job.
+
+    A library failing to load is left for the jobs needing it to report,
+    rather than killing the worker.
+    """
+    try:
+        import magic
+        import wand.image  # noqa: F401
+
+        magic.Magic(mime=True)
+    except ImportError:
+        pass
+
+
+def serve_jobs(connection):
+    """Process the jobs sent to a worker process, one at a time."""
+    warm_up()
+    while True:
+        try:
+            job = connection.recv()
+        except EOFError:
+            return
+        connection.send(process_one(job))
+
+
+class Worker(object):
+
+    """A warm worker process, which can be stopped in the middle of a job.
+
+    :param: max_tasks (int): tarballs after which the worker is spent
+    """
+
+    def __init__(self, max_tasks=None):
+        self.connection, worker_connection = Pipe()
+        self.process = Process(target=serve_jobs, args=(worker_connection,))
+        self.process.daemon = True
+        self.process.start()
+        worker_connection.close()
+        self.max_tasks = max_tasks
+        self.tasks = 0
+
+    @property
+    def spent(self):
+        return self.max_tasks is not None and self.tasks >= self.max_tasks
+
+    def run(self, job, timeout):
+        """Process a job.
+
+        :return: record (dict): see :func:`~plotextractor.cli.process_one`,
+            or None if the job took longer than timeout seconds
+
+        :raises: EOFError if the worker died.
+        """
+        self.tasks += 1
+        self.connection.send(job)
+        if not self.connection.poll(timeout):
+            return None
+        return self.connection.recv()
+
+    def stop(self):
+        """Kill the worker, whatever it is doing."""
+        self.connection.close()
+        self.process.terminate()
+        self.process.join()
+
+
+class ExtractionService(object):
+
+    """Warm worker processes processing tarballs, with bounded queueing.
+
+    A worker still processing a tarball when it times out is killed and
+    replaced, so a tarball that hangs does not hold a worker forever.
+
+    :param: workers (int): number of worker processes
+    :param: max_pending (int): how many tarballs can be queued or processed
+        at once; more are rejected
+    :param: timeout (int): how long to wait for a tarball, in seconds
+    :param: max_tasks_per_worker (int): tarballs after which a worker is
+        replaced (by default never)
+    """
+
+    def __init__(self, workers=1, max_pending=None, timeout=300,
+                 max_tasks_per_worker=None):
+        self.workers = workers
+        self.max_pending = max_pending or 2 * workers
+        self.timeout = timeout
+        self.max_tasks_per_worker = max_tasks_per_worker
+        self._idle_workers = Queue()
+        for _ in range(workers):
+            self._idle_workers.put(Worker(max_tasks_per_worker))
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        self._lock = threading.Lock()
+        self.counters = dict(
+            (counter, 0) for counter in (
+                'requests', 'rejected', 'pending', 'completed', 'failed',
+                'timeouts')
+        )
+        self.total_time = 0.0
+
+    def _count(self, counter, increment=1):
+        with self._lock:
+            self.counters[counter] += increment
+
+    def _done(self, record):
+        with self._lock:
+            self.counters['completed'] += 1
+            self.counters['failed'] += 'error' in record
+            self.total_time += record['timings']['total']
+
+    def extract(self, tarball, options):
+        """Process a tarball in a worker, unless too many are pending.
+
+        :return: (status, record) (int, dict): the HTTP status and the
+            record of the tarball, or an error
+        """
+        self._count('requests')
+        if not self._slots.acquire(False):
+            self._count('rejected')
+            return 503, {'error': 'too many pending tarballs'}
+        self._count('pending')
+        try:
+            return self._extract(tarball, options)
+        finally:
+            self._count('pending', -1)
+            self._slots.release()
+
+    def _extract(self, tarball, options):
+        deadline = time() + self.timeout
+        try:
+            worker = self._idle_workers.get(timeout=self.timeout)
+        except Empty:
+            return self._timed_out()
+        record = None
+        try:
+            record = worker.run(
+                (tarball, options), max(deadline - time(), 0))
+        except (EOFError, IOError, OSError):
+            self._count('failed')
+            return 500, {'error': 'the worker died'}
+        finally:
+            if record is None or worker.spent:
+                worker.stop()
+                worker = Worker(self.max_tasks_per_worker)
+            self._idle_workers.put(worker)
+        if record is None:
+            return self._timed_out()
+        self._done(record)
+        return 200, record
+
+    def _timed_out(self):
+        self._count('timeouts')
+        return 504, {'error': 'timed out after {0} seconds'.format(
+            self.timeout)}
+
+    def metrics(self):
+        """Return the counters of the service."""
+        with self._lock:
+            metrics = dict(self.counters)
+            completed = metrics['completed']
+            metrics['mean_time'] = (
+                self.total_time / completed if completed else None)
+        metrics['workers'] = self.workers
+        metrics['max_pending'] = self.max_pending
+        return metrics
+
+    def close(self):
+        """Stop the workers."""
+        for _ in range(self.workers):
+            self._idle_workers.get().stop()
+
+
+class ExtractionRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    """HTTP front of an :class:`ExtractionService`."""
+
+    def send_json(self, status, body):
+        payload = json.dumps(body, sort_keys=True).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        if status == 503:
+            self.send_header('Retry-After', '1')
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        if self.path == '/health':
+            self.send_json(200, {'status': 'ok'})
+        elif self.path == '/metrics':
+            self.send_json(200, self.server.service.metrics())
+        else:
+            self.send_json(404, {'error': 'not found'})
+
+    def do_POST(self):
+        if self.path != '/extract':
+            self.send_json(404, {'error': 'not found'})
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            job = json.loads(self.rfile.read(length).decode('utf-8'))
+            tarball = job['tarball']
+        except (ValueError, KeyError, TypeError):
+            self.send_json(400, {'error': 'expected {"tarball": "..."}'})
+            return
+
+        options = {'context': bool(job.get('context'))}
+        if job.get('output_directory'):
+            options['output_directory'] = job['output_directory']
+        self.send_json(*self.server.service.extract(tarball, options))
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ExtractionServer(socketserver.ThreadingMixIn,
+                       BaseHTTPServer.HTTPServer):
+
+    """Threaded HTTP server of an :class:`ExtractionService`."""
+
+    daemon_threads = True
+
+    def __init__(self, address, service):
+        BaseHTTPServer.HTTPServer.__init__(
+            self, address, ExtractionRequestHandler)
+        self.service = service
+
+
+def get_parser():
+    """Return the parser of the command-line arguments."""
+    parser = argparse.ArgumentParser(
+        prog='plotextractor-service',
+        description='Serve tarball extraction over HTTP.',
+    )
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument(
+        '-j', '--workers', type=int, default=1,
+        help='number of worker processes (default: %(default)s)')
+    parser.add_argument(
+        '--max-pending', type=int,
+        help='tarballs queued or processed at once before rejecting new '
+             'ones (default: twice the workers)')
+    parser.add_argument(
+        '--timeout', type=int, default=300,
+        help='seconds after which a tarball is stopped '
+             '(default: %(default)s)')
+    parser.add_argument(
+        '--max-tasks-per-worker', type=int,
+        help='tarballs after which a worker is replaced')
+    return parser
+
+
+def main(argv=None):
+    """Run the extraction service from the command line."""
+    args = get_parser().parse_args(argv)
+    service = ExtractionService(
+        workers=args.workers,
+        max_pending=args.max_pending,
+        timeout=args.timeout,
+        max_tasks_per_worker=args.max_tasks_per_worker,
+    )
+    server = ExtractionServer((args.host, args.port), service)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+    return 0
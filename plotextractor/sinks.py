@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of plotextractor.
+# Copyright (C) 2020 CERN.
+#
+# plotextractor is free software; you can redistribute it
+# and/or modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# plotextractor is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with plotextractor; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+# MA 02111-1307, USA.
+#
+# In applying this license, CERN does not
+# waive the privileges and immunities granted to it by virtue of its status
+# as an Intergovernmental Organization or submit itself to any jurisdiction.
+
+"""Where the converted images go once they are written.
+
+A sink is anything with a ``put(path, key)`` method that stores the image
+written at ``path`` under ``key`` (its path relative to the output
+directory, with ``/`` separators) and returns its url. The images are
+handed to the sink by an ``Uploader`` as soon as they are converted, from
+a few threads, so that uploading overlaps with converting the next ones.
+"""
+
+import mimetypes
+import os
+import posixpath
+import shutil
+import threading
+
+from .config import CFG_PLOTEXTRACTOR_UPLOAD_WORKERS
+from .pipeline import Stage
+
+
+class LocalSink(object):
+
+    """Keep the images where they are, or copy them to another directory."""
+
+    def __init__(self, directory=None):
+        self.directory = directory
+
+    def put(self, path, key):
+        if self.directory is None:
+            return path
+        destination = os.path.join(self.directory, *key.split('/'))
+        if not os.path.isdir(os.path.dirname(destination)):
+            os.makedirs(os.path.dirname(destination))
+        shutil.copyfile(path, destination)
+        return destination
+
+
+class CallableSink(object):
+
+    """Hand the images to a function of ``(path, key)`` returning the url."""
+
+    def __init__(self, function):
+        self.function = function
+
+    def put(self, path, key):
+        return self.function(path, key)
+
+
+class S3Sink(object):
+
+    """Upload the images to an S3-compatible object storage.
+
+    :param: client: a client with the ``upload_file`` method of boto3
+    :param: bucket (string): the bucket to upload to
+    :param: prefix (string): prepended to the keys (optional)
+    :param: url (string): the url of the uploaded images, formatted with
+        their ``bucket`` and ``key`` (by default ``s3://{bucket}/{key}``)
+    """
+
+    def __init__(self, client, bucket, prefix='', url='s3://{bucket}/{key}'):
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix
+        self.url = url
+
+    def put(self, path, key):
+        key = posixpath.join(self.prefix, key)
+        extra_args = {}
+        content_type = mimetypes.guess_type(path)[0]
+        if content_type:
+            extra_args['ContentType'] = content_type
+        self.client.upload_file(path, self.bucket, key, ExtraArgs=extra_args)
+        return self.url.format(bucket=self.bucket, key=key)
+
+
+def get_sink(sink):
+    """Return the sink for a sink, a callable, or None for a ``LocalSink``."""
+    if sink is None:
+        return LocalSink()
+    if hasattr(sink, 'put'):
+        return sink
+    if callable(sink):
+        return CallableSink(sink)
+    raise TypeError('Not a sink: {0!r}'.format(sink))
+
+
+class Uploader(object):
+
+    """Upload images to a sink from a bounded pool of threads.
+
+    :param: sink: see :func:`get_sink`
+    :param: root (string): the directory the keys are relative to
+    :param: workers (int): how many images are uploaded at the same time
+    """
+
+    def __init__(self, sink, root, workers=CFG_PLOTEXTRACTOR_UPLOAD_WORKERS):
+        self.sink = get_sink(sink)
+        self.root = root
+        self.workers = workers
+        self.urls = {}
+        self.stage = None
+        # the images are submitted from the conversion threads
+        self.lock = threading.Lock()
+
+    def _upload(self, path):
+        key = os.path.relpath(path, self.root).replace(os.sep, '/')
+        self.urls[path] = self.sink.put(path, key)
+
+    def submit(self, path):
+        """Upload an image, waiting while too many are queued already."""
+        with self.lock:
+            if self.stage is None:
+                self.stage = Stage(self._upload, workers=self.workers)
+            stage = self.stage
+        stage.put(path)
+
+    def wait(self):
+        """Wait for the images submitted so far to be uploaded.
+
+        :return: urls ({path: url, ...}): the urls of all the uploaded images
+        :raises: the first error of the sink, if any.
+        """
+        with self.lock:
+            stage, self.stage = self.stage, None
+        if stage is not None:
+            stage.close()
+        return self.urls
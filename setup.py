@@ -32,9 +32,8 @@ readme = open('README.md').read()
 
 requirements = [
     'Wand>=0.4.1,<=0.5.9',
-    'subprocess32>=3.2.6',
     'python-magic',
-    'six>=1.7.2',
+    'six>=1.12.0',
 ]
 
 test_requirements = [
@@ -57,12 +56,20 @@ setup(
     packages=[
         'plotextractor',
     ],
+    entry_points={
+        'console_scripts': [
+            'plotextractor = plotextractor.cli:main',
+            'plotextractor-service = plotextractor.service:main',
+        ],
+    },
     zip_safe=False,
     include_package_data=True,
     platforms='any',
     install_requires=requirements,
     extras_require={
-        'tests': test_requirements
+        'numpy': ['numpy'],
+        'profiling': ['pyinstrument'],
+        'tests': test_requirements,
     },
     classifiers=[
         'Intended Audience :: Developers',
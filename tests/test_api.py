@@ -23,7 +23,9 @@
 # as an Intergovernmental Organization or submit itself to any jurisdiction.
 
 
+import json
 import os
+import subprocess
 import tempfile
 import sys
 import six
@@ -247,3 +249,23 @@ def test_process_api_with_include(tarball_test_for_include):
     assert "original_url" in plots[0]
     assert "captions" in plots[0]
     assert "name" in plots[0]
+
+
+IMPORT_TIME_BUDGET = 0.5
+
+
+def test_import_is_fast_and_does_not_load_native_libraries():
+    """Importing plotextractor leaves Wand and libmagic for their first use."""
+    code = (
+        "import json, sys, time\n"
+        "start = time.time()\n"
+        "import plotextractor\n"
+        "print(json.dumps({'time': time.time() - start, 'modules': ["
+        "name for name in ('wand', 'magic', 'numpy') "
+        "if name in sys.modules]}))\n"
+    )
+    output = subprocess.check_output([sys.executable, '-c', code])
+    result = json.loads(output.decode('utf-8'))
+
+    assert result['modules'] == []
+    assert result['time'] < IMPORT_TIME_BUDGET
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of plotextractor.
+# Copyright (C) 2020 CERN.
+#
+# plotextractor is free software; you can redistribute it
+# and/or modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# plotextractor is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with plotextractor; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+# MA 02111-1307, USA.
+#
+# In applying this license, CERN does not
+# waive the privileges and immunities granted to it by virtue of its status
+# as an Intergovernmental Organization or submit itself to any jurisdiction.
+
+
+from collections import OrderedDict
+
+from plotextractor.benchmark import format_report
+
+
+def test_format_report_per_figure():
+    results = OrderedDict([
+        ('fast', {'figures': 4, 'bytes': 4000, 'seconds': 0.1}),
+        ('small', {'figures': 0, 'bytes': 0, 'seconds': 0.0}),
+    ])
+
+    assert format_report(results).splitlines() == [
+        'preset      figures   bytes/figure   ms/figure',
+        'fast              4           1000        25.0',
+        'small             0              0         0.0',
+    ]
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of plotextractor.
+# Copyright (C) 2015, 2016, 2020 CERN.
+#
+# plotextractor is free software; you can redistribute it
+# and/or modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# plotextractor is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with plotextractor; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+# MA 02111-1307, USA.
+#
+# In applying this license, CERN does not
+# waive the privileges and immunities granted to it by virtue of its status
+# as an Intergovernmental Organization or submit itself to any jurisdiction.
+
+
+import json
+
+from plotextractor.cli import find_tarballs, in_shard, main, read_checkpoint
+
+
+def test_find_tarballs_looks_into_directories(tmpdir):
+    tmpdir.join('b.tar.gz').write('')
+    tmpdir.join('a.tgz').write('')
+    tmpdir.join('d.zip').write('')
+    tmpdir.join('1234.5678.gz').write('')
+    tmpdir.join('notes.txt').write('')
+
+    assert find_tarballs([str(tmpdir), str(tmpdir.join('c.tar'))]) == [
+        str(tmpdir.join('1234.5678.gz')),
+        str(tmpdir.join('a.tgz')),
+        str(tmpdir.join('b.tar.gz')),
+        str(tmpdir.join('d.zip')),
+        str(tmpdir.join('c.tar')),
+    ]
+
+
+def test_in_shard_puts_every_tarball_in_one_shard():
+    tarballs = ['/data/{0}.tar.gz'.format(index) for index in range(100)]
+
+    shards = [
+        [tarball for tarball in tarballs if in_shard(tarball, shard, 3)]
+        for shard in range(3)
+    ]
+
+    assert sorted(sum(shards, [])) == sorted(tarballs)
+    assert all(shards)
+    assert in_shard('/data/1.tar.gz', 0, 3) == \
+        in_shard('/elsewhere/1.tar.gz', 0, 3)
+
+
+def test_read_checkpoint_drops_half_written_line(tmpdir):
+    output = tmpdir.join('out.jsonl')
+    output.write('{"tarball": "/a.tar.gz"}\n{"tarball": "/b.ta')
+
+    assert read_checkpoint(str(output)) == set(['/a.tar.gz'])
+    assert output.read() == '{"tarball": "/a.tar.gz"}\n'
+
+
+def test_main_records_errors_and_resumes(tmpdir):
+    tarball = tmpdir.join('broken.tar.gz')
+    tarball.write('not a tarball')
+    output = tmpdir.join('out.jsonl')
+
+    assert main([str(tarball), '-o', str(output)]) == 1
+    assert main([str(tarball), '-o', str(output)]) == 0
+
+    records = [json.loads(line) for line in output.readlines()]
+    assert len(records) == 1
+    assert records[0]['tarball'] == str(tarball)
+    assert records[0]['error']['type'] == 'InvalidTarball'
+    assert 'untar' in records[0]['timings']
+
+
+def test_main_profiles_slow_tarballs(tmpdir):
+    tarball = tmpdir.join('broken.tar.gz')
+    tarball.write('not a tarball')
+    profiles = tmpdir.join('profiles')
+
+    main([str(tarball), '-o', str(tmpdir.join('out.jsonl')),
+          '--profile', '0', '--profile-directory', str(profiles)])
+
+    assert profiles.join('broken.tar.gz.prof').check()
@@ -23,13 +23,63 @@
 # as an Intergovernmental Organization or submit itself to any jurisdiction.
 
 
+import gzip
+import io
 import magic
 import os
 import pkg_resources
+import pytest
+import struct
+import tarfile
+import zipfile
 from shutil import rmtree
 from tempfile import mkdtemp
 
-from plotextractor.converter import detect_images_and_tex, untar
+from plotextractor.converter import (
+    convert_images,
+    detect_images_and_tex,
+    get_density,
+    get_display_size,
+    is_oversized,
+    keep_first_frame,
+    convert_vector_image,
+    plan_conversions,
+    preflight,
+    rotate_image,
+    set_png_preset,
+    untar,
+)
+from plotextractor import converter
+from plotextractor import archive
+from plotextractor.errors import ArchiveLimitExceeded, InvalidTarball
+
+
+def make_tarball(members, mode='w:gz'):
+    output = io.BytesIO()
+    with tarfile.open(fileobj=output, mode=mode) as tarball:
+        for name, data in members:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tarball.addfile(info, io.BytesIO(data))
+    return output.getvalue()
+
+
+def make_zip(members):
+    output = io.BytesIO()
+    with zipfile.ZipFile(output, 'w') as archive:
+        for name, data in members:
+            archive.writestr(name, data)
+    return output.getvalue()
+
+
+def extract(tmpdir, data, limits=None):
+    archive_file = tmpdir.join('archive')
+    archive_file.write(data, mode='wb')
+    output_directory = tmpdir.mkdir('output')
+    file_list = untar(str(archive_file), str(output_directory), limits)
+    return [
+        os.path.relpath(path, str(output_directory)) for path in file_list
+    ], output_directory
 
 
 def test_detect_images_and_tex_ignores_hidden_metadata_files():
@@ -46,3 +96,398 @@ def test_detect_images_and_tex_ignores_hidden_metadata_files():
                 or 'Postscript' in magic.from_file(f)
     finally:
         rmtree(temporary_dir)
+
+
+def test_detect_images_and_tex_threaded_keeps_order():
+    tarball_filename = pkg_resources.resource_filename(
+        __name__, os.path.join('data', '1603.04438v1.tar.gz'))
+    try:
+        temporary_dir = mkdtemp()
+        file_list = untar(tarball_filename, temporary_dir)
+
+        assert detect_images_and_tex(file_list, workers=4) == \
+            detect_images_and_tex(file_list, workers=1)
+    finally:
+        rmtree(temporary_dir)
+
+
+def test_detect_images_and_tex_classifies_by_extension_first(
+        tmpdir, monkeypatch):
+    def fail(*args, **kwargs):
+        raise AssertionError('libmagic should not be used')
+    monkeypatch.setattr(magic, 'Magic', fail)
+    file_list = [
+        str(tmpdir.join(name)) for name in ('main.tex', 'fig.png', 'fig.pdf')
+    ]
+    for file_name in file_list:
+        open(file_name, 'w').close()
+
+    assert detect_images_and_tex(file_list) == (file_list[1:], file_list[:1])
+
+
+def test_untar_zip(tmpdir):
+    data = make_zip([('main.tex', b'\\begin{document}'), ('fig.png', b'png')])
+
+    names, output_directory = extract(tmpdir, data)
+
+    assert names == ['main.tex', 'fig.png']
+    assert output_directory.join('fig.png').read() == 'png'
+
+
+def test_untar_single_gzipped_file(tmpdir):
+    archive = tmpdir.join('1234.5678.gz')
+    with gzip.open(str(archive), 'wb') as f:
+        f.write(b'\\documentclass{article}')
+    output_directory = tmpdir.mkdir('output')
+
+    file_list = untar(str(archive), str(output_directory))
+
+    assert file_list == [str(output_directory.join('1234.5678'))]
+    assert output_directory.join('1234.5678').read() == \
+        '\\documentclass{article}'
+
+
+def test_untar_rejects_truncated_gzipped_files(tmpdir):
+    output = io.BytesIO()
+    with gzip.GzipFile(fileobj=output, mode='wb') as f:
+        f.write(os.urandom(64 * 1024))
+    data = output.getvalue()
+
+    with pytest.raises(InvalidTarball):
+        extract(tmpdir, data[:len(data) // 2])
+
+
+def test_untar_nested_archives(tmpdir):
+    figures = make_zip([('a.png', b'a')])
+    sources = make_tarball([('main.tex', b'tex'), ('figures.zip', figures)])
+    data = make_tarball([
+        ('src/sources.tar.gz', sources), ('README', b'readme'),
+    ], mode='w')
+
+    names, output_directory = extract(tmpdir, data)
+
+    assert names == ['src/main.tex', 'src/a.png', 'README']
+    assert output_directory.join('src', 'a.png').read() == 'a'
+    assert not output_directory.join('src', 'sources.tar.gz').check()
+
+
+def test_untar_keeps_files_that_only_look_like_archives(tmpdir):
+    data = make_tarball([('notes.gz', b'not compressed')])
+
+    names, output_directory = extract(tmpdir, data)
+
+    assert names == ['notes.gz']
+    assert output_directory.join('notes.gz').read() == 'not compressed'
+
+
+def test_untar_skips_members_outside_of_the_output_directory(tmpdir):
+    data = make_tarball([('../evil.tex', b'x'), ('/abs.tex', b'x'),
+                         ('./ok.tex', b'x')])
+
+    names, _ = extract(tmpdir, data)
+
+    assert names == ['ok.tex']
+    assert not tmpdir.join('evil.tex').check()
+
+
+def test_untar_rejects_other_files(tmpdir):
+    with pytest.raises(InvalidTarball):
+        extract(tmpdir, b'just some text')
+
+
+def test_untar_skips_the_padding_of_gzip_files(tmpdir):
+    data = make_tarball([('main.tex', b'\\begin{document}')])
+
+    names, _ = extract(tmpdir, data + b'\x00' * 1024)
+
+    assert names == ['main.tex']
+
+
+def test_untar_rejects_truncated_tarballs(tmpdir):
+    data = make_tarball([('fig.png', os.urandom(256 * 1024))])
+
+    with pytest.raises(InvalidTarball):
+        extract(tmpdir, data[:len(data) // 2])
+
+
+def test_convert_images_keeps_web_rasters(tmpdir):
+    png = tmpdir.join('plot.png')
+    png.write(b'\x89PNG\r\n\x1a\n', mode='wb')
+    jpeg = tmpdir.join('photo.jpg')
+    jpeg.write(b'\xff\xd8\xff\xe0', mode='wb')
+    webp = tmpdir.join('photo.webp')
+    webp.write(b'RIFF\x00\x00\x00\x00WEBPVP8 ', mode='wb')
+    image_list = [str(png), str(jpeg), str(webp)]
+
+    assert convert_images(image_list) == dict(
+        (image, image) for image in image_list)
+
+
+def test_get_density_fits_large_vector_images():
+    assert get_density(('pdf', 595, 842), 4096) is None
+    assert get_density(('pdf', 8192, 4096), 4096) == (36.0, 36.0)
+    assert get_density(('png', 8192, 4096), 4096) is None
+    assert get_density(None, 4096) is None
+
+
+def test_get_density_for_the_display_size():
+    # a 6in wide plot shown 3in wide, at 150 pixels per inch
+    assert get_density(('pdf', 432, 288), 4096, (216, 144)) == (75.0, 75.0)
+    assert get_density(('pdf', 72, 72), 4096, (432, 432)) == (900.0, 900.0)
+    assert get_density(('pdf', 72, 72), 450, (432, 432)) == (450.0, 450.0)
+    assert get_density(('png', 72, 72), 4096, (432, 432)) is None
+
+
+def test_get_display_size_from_graphics_options():
+    image_size = ('pdf', 400, 200)
+
+    assert get_display_size(image_size, {'width': 100}) == (100, 50)
+    assert get_display_size(image_size, {'height': 100}) == (200, 100)
+    assert get_display_size(image_size, {'width': 10, 'height': 20}) == (
+        10, 20)
+    assert get_display_size(image_size, {'scale': 0.5}) == (200, 100)
+    assert get_display_size(image_size, {'page': 1}) is None
+    assert get_display_size(('png', 400, 200), {'width': 100}) is None
+
+
+def test_is_oversized_only_rejects_large_rasters():
+    assert is_oversized(('png', 20000, 20000), max_pixels=10 ** 8)
+    assert not is_oversized(('png', 2000, 2000), max_pixels=10 ** 8)
+    assert not is_oversized(('pdf', 20000, 20000), max_pixels=10 ** 8)
+    assert not is_oversized(None)
+
+
+def test_keep_first_frame(tmpdir):
+    for frame in range(3):
+        tmpdir.join('slides-%d.png' % frame).write(str(frame))
+
+    keep_first_frame(str(tmpdir.join('slides.png')))
+
+    assert tmpdir.join('slides.png').read() == '0'
+    assert not tmpdir.join('slides-1.png').check()
+    assert not tmpdir.join('slides-2.png').check()
+
+
+def test_preflight(tmpdir):
+    def png(width, height):
+        return b'\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR' + \
+            struct.pack('>II', width, height)
+    eps = b'%!PS-Adobe-3.0 EPSF-3.0\n%%BoundingBox: 0 0 1000 500\n'
+    figures = make_tarball([('poster.eps', eps)])
+    tarball = tmpdir.join('paper.tar')
+    tarball.write(make_tarball([
+        ('main.tex', b'\\documentclass{article}'),
+        ('plot.png', png(10, 10)),
+        ('huge.gif', b'GIF89a' + struct.pack('<HH', 60000, 60000)),
+        ('figures.tar.gz', figures),
+    ], mode='w'), mode='wb')
+
+    report = preflight(str(tarball))
+
+    assert report['files'] == 4
+    assert report['size'] == 23 + len(png(10, 10)) + 10 + len(eps)
+    assert report['tex'] == 1
+    assert report['images'] == {'png': 1, 'gif': 1, 'ps': 1}
+    assert report['conversions'] == 1
+    assert report['oversized'] == 1
+    assert report['cost'] == pytest.approx(0.5)
+
+
+@pytest.mark.parametrize('limits, members', [
+    ({'members': 2}, [('a', b''), ('b', b''), ('c', b'')]),
+    ({'member_size': 10}, [('a', b'x' * 11)]),
+    ({'size': 10}, [('a', b'x' * 6), ('b', b'x' * 6)]),
+    ({'depth': 2}, [('a/b/c.tex', b'')]),
+])
+def test_untar_limits(tmpdir, limits, members):
+    limit, = limits
+
+    with pytest.raises(ArchiveLimitExceeded) as excinfo:
+        extract(tmpdir, make_tarball(members), limits)
+
+    assert excinfo.value.limit == limit
+    assert isinstance(excinfo.value, InvalidTarball)
+
+
+def test_untar_limits_nested_archives(tmpdir):
+    nested = make_tarball([('a', b''), ('b', b'')])
+
+    with pytest.raises(ArchiveLimitExceeded):
+        extract(tmpdir, make_tarball([('figures.tar.gz', nested)]),
+                {'members': 2})
+
+
+def test_untar_limits_count_buffered_nested_zips(tmpdir):
+    nested = make_zip([('a.png', b'a' * 1000)])
+
+    with pytest.raises(ArchiveLimitExceeded):
+        extract(tmpdir, make_tarball([('figures.zip', nested)]),
+                {'size': 1500})
+
+
+def test_untar_aborts_on_compression_bombs(tmpdir, monkeypatch):
+    monkeypatch.setattr(
+        archive, 'CFG_PLOTEXTRACTOR_ARCHIVE_RATIO_MIN_SIZE', 1024 ** 2)
+    bomb = tmpdir.join('bomb.gz')
+    with gzip.open(str(bomb), 'wb') as f:
+        f.write(b'\0' * 4 * 1024 ** 2)
+    output_directory = tmpdir.mkdir('output')
+
+    with pytest.raises(ArchiveLimitExceeded) as excinfo:
+        untar(str(bomb), str(output_directory))
+
+    assert excinfo.value.limit == 'ratio'
+
+
+class FakeImage(object):
+
+    colorspace = 'srgb'
+
+    def __init__(self):
+        self.options = {}
+        self.quantized = None
+
+    def quantize(self, number_colors, colorspace_type, treedepth, dither,
+                 measure_error):
+        self.quantized = (number_colors, colorspace_type, dither)
+
+
+def test_set_png_preset_sets_the_encoder_options():
+    image = FakeImage()
+
+    set_png_preset(image, 'fast')
+
+    assert image.options == {
+        'png:compression-level': '1',
+        'png:compression-filter': '0',
+        'png:compression-strategy': '0',
+        'png:bit-depth': '8',
+    }
+    assert image.quantized is None
+
+
+def test_set_png_preset_quantizes_small_pngs():
+    image = FakeImage()
+
+    set_png_preset(image, 'small')
+
+    assert image.quantized == (256, 'srgb', False)
+    assert 'png:bit-depth' not in image.options
+
+
+def test_set_png_preset_none_keeps_the_defaults():
+    image = FakeImage()
+
+    set_png_preset(image, None)
+
+    assert image.options == {}
+
+
+PDF_IMAGE = b'%PDF-1.4\n1 0 obj << /MediaBox [0 0 300 200] >> endobj\n'
+EPS_IMAGE = b'%!PS-Adobe-3.0 EPSF-3.0\n%%BoundingBox: 0 0 300 200\n'
+
+
+def fake_vector_tool(commands):
+    def run_command(arguments, timeout=None):
+        commands.append(arguments)
+        target = [argument for argument in arguments
+                  if argument.endswith(('.svg', '.pdf'))][-1]
+        with open(target.split('=')[-1], 'w') as f:
+            f.write('vector')
+        return 0
+    return run_command
+
+
+def test_convert_images_to_svg(tmpdir, monkeypatch):
+    commands = []
+    monkeypatch.setattr(converter, 'run_command', fake_vector_tool(commands))
+    tmpdir.join('plot.pdf').write(PDF_IMAGE, mode='wb')
+    tmpdir.join('fit.eps').write(EPS_IMAGE, mode='wb')
+    image_list = [str(tmpdir.join('plot.pdf')), str(tmpdir.join('fit.eps'))]
+
+    image_mapping = convert_images(
+        image_list, vector_format='svg',
+        pages={str(tmpdir.join('plot.pdf')): 1})
+
+    assert image_mapping == {
+        str(tmpdir.join('plot.svg')): str(tmpdir.join('plot.pdf')),
+        str(tmpdir.join('fit.svg')): str(tmpdir.join('fit.eps')),
+    }
+    assert commands[0][:6] == ['pdftocairo', '-svg', '-f', '2', '-l', '2']
+    assert commands[1][0] == 'dvisvgm'
+
+
+def test_convert_vector_image_keeps_pdfs(tmpdir, monkeypatch):
+    commands = []
+    monkeypatch.setattr(converter, 'run_command', fake_vector_tool(commands))
+    pdf_image = str(tmpdir.join('plot.pdf'))
+    eps_image = str(tmpdir.join('fit.eps'))
+
+    assert convert_vector_image(pdf_image, 'pdf', 'pdf') == pdf_image
+    assert convert_vector_image(pdf_image, 'pdf', 'pdf', page=1) is None
+    assert convert_vector_image(eps_image, 'ps', 'pdf') == \
+        str(tmpdir.join('fit.pdf'))
+    assert convert_vector_image(eps_image, 'ps', 'svg', page=1) is None
+    assert [command[0] for command in commands] == ['gs']
+
+
+def test_convert_vector_image_without_the_tool(tmpdir, monkeypatch):
+    monkeypatch.setitem(
+        converter.VECTOR_COMMANDS, ('pdf', 'svg'), ['no-such-pdftocairo'])
+    tmpdir.join('plot.pdf').write(PDF_IMAGE, mode='wb')
+
+    assert convert_vector_image(
+        str(tmpdir.join('plot.pdf')), 'pdf', 'svg') is None
+    assert not tmpdir.join('plot.svg').check()
+
+
+def test_plan_conversions_prefers_the_cheapest_source():
+    image_list = ['fig1.eps', 'fig2.eps', 'fig1.pdf', 'fig1.png']
+
+    assert list(plan_conversions(image_list).items()) == [
+        ('fig1.png', ['fig1.png', 'fig1.pdf', 'fig1.eps']),
+        ('fig2.png', ['fig2.eps']),
+    ]
+    assert plan_conversions(image_list, vector_format='svg')['fig1.png'] == \
+        ['fig1.pdf', 'fig1.eps', 'fig1.png']
+
+
+def test_convert_images_converts_one_source_per_image(tmpdir, monkeypatch):
+    converted = []
+
+    def convert_image(from_file, to_file, image_format, **kwargs):
+        converted.append(os.path.basename(from_file))
+        if not from_file.endswith('broken.pdf'):
+            open(to_file, 'w').close()
+    monkeypatch.setattr(converter, 'convert_image', convert_image)
+    for name in ('fig1.eps', 'broken.eps'):
+        tmpdir.join(name).write(EPS_IMAGE, mode='wb')
+    for name in ('fig1.pdf', 'broken.pdf'):
+        tmpdir.join(name).write(PDF_IMAGE, mode='wb')
+    tmpdir.join('fig2.eps').write(EPS_IMAGE, mode='wb')
+    tmpdir.join('fig2.png').write(b'\x89PNG\r\n\x1a\n', mode='wb')
+    image_list = [
+        str(tmpdir.join(name)) for name in (
+            'fig1.eps', 'fig1.pdf', 'fig2.eps', 'fig2.png', 'broken.eps',
+            'broken.pdf')
+    ]
+
+    assert convert_images(image_list) == {
+        str(tmpdir.join('fig1.png')): str(tmpdir.join('fig1.pdf')),
+        str(tmpdir.join('fig2.png')): str(tmpdir.join('fig2.png')),
+        str(tmpdir.join('broken.png')): str(tmpdir.join('broken.eps')),
+    }
+    assert converted == ['fig1.pdf', 'broken.pdf', 'broken.eps']
+
+
+@pytest.mark.parametrize('name,data', [
+    ('plot.svg', b'<svg xmlns="http://www.w3.org/2000/svg"/>'),
+    ('plot.pdf', PDF_IMAGE),
+])
+def test_rotate_image_leaves_vector_images_alone(tmpdir, name, data):
+    tmpdir.join(name).write(data, mode='wb')
+
+    assert not rotate_image(
+        'plot', '\\includegraphics[angle=90]{plot}', str(tmpdir),
+        [str(tmpdir.join(name))])
+    assert tmpdir.join(name).read(mode='rb') == data
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of plotextractor.
+# Copyright (C) 2015, 2016, 2020 CERN.
+#
+# plotextractor is free software; you can redistribute it
+# and/or modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# plotextractor is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with plotextractor; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+# MA 02111-1307, USA.
+#
+# In applying this license, CERN does not
+# waive the privileges and immunities granted to it by virtue of its status
+# as an Intergovernmental Organization or submit itself to any jurisdiction.
+
+
+import os
+
+import six
+
+from plotextractor.api import map_images_in_tex
+from plotextractor.extractor import (
+    extract_captions,
+    get_context,
+    get_image_options,
+    get_image_pages,
+    get_length,
+)
+
+
+CHAPTER = u"""\\begin{figure}
+\\includegraphics[width=0.5\\textwidth]{plot}
+\\caption{A plot.}
+\\label{fig:plot}
+\\end{figure}
+"""
+
+
+def _make_document(tmpdir, name):
+    tex_file = tmpdir.join(name)
+    tex_file.write(
+        u"\\begin{document}\n\\input{chapter}\n\\end{document}\n")
+    return six.text_type(tex_file)
+
+
+def test_map_images_in_tex_parses_shared_input_once(tmpdir):
+    tmpdir.join('chapter.tex').write(CHAPTER)
+    image = six.text_type(tmpdir.join('plot.png'))
+    tmpdir.join('plot.png').write('png')
+    tex_files = [
+        _make_document(tmpdir, 'main.tex'),
+        _make_document(tmpdir, 'supplementary.tex'),
+        six.text_type(tmpdir.join('chapter.tex')),
+    ]
+
+    plots = map_images_in_tex(
+        tex_files, {image: image}, six.text_type(tmpdir))
+
+    assert len(plots) == 1
+    assert plots[0]['url'] == image
+    assert plots[0]['captions'] == [u'A plot.']
+    assert plots[0]['label'] == u'fig:plot'
+
+
+def test_extract_captions_reuses_parsed_tex_files(tmpdir):
+    tmpdir.join('chapter.tex').write(CHAPTER)
+    image = six.text_type(tmpdir.join('plot.png'))
+    parsed_tex_files = {}
+
+    first = extract_captions(
+        _make_document(tmpdir, 'main.tex'), six.text_type(tmpdir),
+        [image], parsed_tex_files=parsed_tex_files)
+    second = extract_captions(
+        _make_document(tmpdir, 'supplementary.tex'), six.text_type(tmpdir),
+        [image], parsed_tex_files=parsed_tex_files)
+
+    chapter = os.path.realpath(six.text_type(tmpdir.join('chapter.tex')))
+    assert list(parsed_tex_files[chapter]['captions']) == [False]
+    assert first == second
+
+
+def test_extract_captions_keeps_subfigures_in_their_figure(tmpdir):
+    tex_file = tmpdir.join('main.tex')
+    tex_file.write(u"""\\begin{document}
+\\begin{figure}
+\\includegraphics{left}
+\\includegraphics{right}
+\\caption{Both.}
+\\label{fig:both}
+\\end{figure}
+\\end{document}
+""")
+
+    figures = extract_captions(
+        six.text_type(tex_file), six.text_type(tmpdir), [])
+
+    assert len(figures) == 1
+    assert [
+        (figure.image, figure.caption, figure.label)
+        for figure in figures[0].subfigures
+    ] == [
+        (u'left', u'Both.', u'fig:both'),
+        (u'right', u'Both.', u'fig:both'),
+    ]
+    assert figures[0].subfigures[0].tex_file == six.text_type(tex_file)
+
+
+def test_get_context_scans_from_the_reference_outward():
+    text = (u"Some text. The mass is shown. As we see in "
+            u"\\ref{fig:mass} the peak is clear. \\begin{table}")
+    ref = text.index(u'\\ref')
+    ref_end = text.index(u' the peak')
+
+    assert get_context(text, backwards=True, end=ref) == \
+        u'As we see in The mass is shown.'
+    assert get_context(text, backwards=True, end=ref) == \
+        get_context(text[:ref], backwards=True)
+    assert get_context(text, start=ref_end) == u'the peak is clear.'
+
+
+def test_get_image_pages(tmpdir):
+    tex_file = tmpdir.join('main.tex')
+    tex_file.write(
+        u'\\includegraphics[width=3cm,page=2]{figs/slides}\n'
+        u'\\includegraphics[page=4]{figs/slides.pdf}\n'
+        u'% \\includegraphics[page=3]{poster}\n'
+        u'\\includegraphics[pagebox=cropbox]{poster}\n'
+    )
+    slides = six.text_type(tmpdir.mkdir('figs').join('slides.pdf'))
+    poster = six.text_type(tmpdir.join('poster.pdf'))
+    parsed_tex_files = {}
+
+    assert get_image_pages(
+        [six.text_type(tex_file)], [slides, poster], six.text_type(tmpdir),
+        parsed_tex_files=parsed_tex_files) == {slides: 1}
+    assert len(parsed_tex_files) == 1
+
+
+def test_get_image_options(tmpdir):
+    tex_file = tmpdir.join('main.tex')
+    tex_file.write(
+        u'\\includegraphics[width=.5\\linewidth]{figs/a}\n'
+        u'\\includegraphics[width=2in,height=2.54cm]{b.eps}\n'
+        u'\\epsfig{file=c.eps,scale=0.4}\n'
+        u'\\includegraphics[totalheight=72bp,page=2]{figs/a.pdf}\n'
+        u'\\includegraphics[width=\\unknownwidth]{b}\n'
+    )
+    a = six.text_type(tmpdir.mkdir('figs').join('a.pdf'))
+    b = six.text_type(tmpdir.join('b.eps'))
+    c = six.text_type(tmpdir.join('figs', 'c.eps'))
+
+    assert get_image_options(
+        [six.text_type(tex_file)], [a, b, c], six.text_type(tmpdir)) == {
+        a: {'width': 235.0, 'height': 72.0, 'page': 1},
+        b: {'width': 144.0, 'height': 72.0},
+        c: {'scale': 0.4},
+    }
+
+
+def test_get_length():
+    assert get_length(u'2in') == 144.0
+    assert get_length(u'7.5 cm') == 7.5 * 72 / 2.54
+    assert get_length(u'\\textwidth') == 470.0
+    assert get_length(u'0.5\\columnwidth') == 235.0
+    assert get_length(u'3furlongs') is None
+    assert get_length(u'-1cm') is None
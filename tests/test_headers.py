@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of plotextractor.
+# Copyright (C) 2015, 2016, 2020 CERN.
+#
+# plotextractor is free software; you can redistribute it
+# and/or modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# plotextractor is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with plotextractor; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+# MA 02111-1307, USA.
+#
+# In applying this license, CERN does not
+# waive the privileges and immunities granted to it by virtue of its status
+# as an Intergovernmental Organization or submit itself to any jurisdiction.
+
+
+import struct
+
+from plotextractor.headers import get_image_size, is_vector
+
+
+def test_get_image_size_png(tmpdir):
+    image = tmpdir.join('plot.png')
+    image.write(b'\x89PNG\r\n\x1a\n' + b'\x00\x00\x00\rIHDR' +
+                struct.pack('>II', 640, 480) + b'\x08\x06', mode='wb')
+
+    assert get_image_size(str(image)) == ('png', 640, 480)
+
+
+def test_get_image_size_gif(tmpdir):
+    image = tmpdir.join('plot.gif')
+    image.write(b'GIF89a' + struct.pack('<HH', 20, 10) + b'\x00' * 8,
+                mode='wb')
+
+    assert get_image_size(str(image)) == ('gif', 20, 10)
+
+
+def test_get_image_size_jpeg_skips_to_the_frame_header(tmpdir):
+    image = tmpdir.join('photo.jpg')
+    app0 = b'\xff\xe0' + struct.pack('>H', 16) + b'JFIF\x00' + b'\x00' * 9
+    sof0 = b'\xff\xc0' + struct.pack('>HBHH', 17, 8, 1080, 1920)
+    image.write(b'\xff\xd8' + app0 + sof0 + b'\x03', mode='wb')
+
+    assert get_image_size(str(image)) == ('jpeg', 1920, 1080)
+
+
+def test_get_image_size_pdf_media_box(tmpdir):
+    image = tmpdir.join('poster.pdf')
+    image.write(b'%PDF-1.4\n1 0 obj << /Type /Page '
+                b'/MediaBox [0 0 2384 3370] >> endobj\n', mode='wb')
+
+    size = get_image_size(str(image))
+
+    assert size == ('pdf', 2384, 3370)
+    assert is_vector(size)
+
+
+def test_get_image_size_eps_bounding_box(tmpdir):
+    image = tmpdir.join('plot.eps')
+    image.write(b'%!PS-Adobe-3.0 EPSF-3.0\n%%BoundingBox: 50 50 410 302\n',
+                mode='wb')
+
+    assert get_image_size(str(image)) == ('ps', 360, 252)
+
+
+def test_get_image_size_unknown(tmpdir):
+    image = tmpdir.join('plot.fig')
+    image.write('#FIG 3.2')
+
+    assert get_image_size(str(image)) is None
+    assert not is_vector(None)
@@ -0,0 +1,342 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of plotextractor.
+# Copyright (C) 2020 CERN.
+#
+# plotextractor is free software; you can redistribute it
+# and/or modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# plotextractor is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with plotextractor; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+# MA 02111-1307, USA.
+#
+# In applying this license, CERN does not
+# waive the privileges and immunities granted to it by virtue of its status
+# as an Intergovernmental Organization or submit itself to any jurisdiction.
+
+
+import io
+import os
+import struct
+import tarfile
+import threading
+
+import pytest
+
+from plotextractor import converter, extractor, pipeline
+from plotextractor.api import process_tarball
+from plotextractor.errors import NoTexFilesFound
+from plotextractor.pipeline import Stage, run_pipeline
+
+MAIN_TEX = b"""\\documentclass{article}
+\\begin{document}
+\\begin{figure}
+\\includegraphics{plot}
+\\caption{A plot.}
+\\label{fig:plot}
+\\end{figure}
+\\begin{figure}
+\\includegraphics{figures/photo.jpg}
+\\caption{A photo.}
+\\end{figure}
+\\end{document}
+"""
+
+
+def make_tarball(path, members):
+    with tarfile.open(path, 'w:gz') as tarball:
+        for name, data in members:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tarball.addfile(info, io.BytesIO(data))
+
+
+def test_process_tarball_pipeline_matches_sequential(tmpdir):
+    tarball = str(tmpdir.join('paper.tar.gz'))
+    make_tarball(tarball, [
+        ('plot.png', b'\x89PNG\r\n\x1a\n'),
+        ('main.tex', MAIN_TEX),
+        ('figures/photo.jpg', b'\xff\xd8\xff\xe0'),
+    ])
+
+    def figures(pipeline):
+        output_directory = str(tmpdir.join(str(pipeline)))
+        timings = {}
+        plots = process_tarball(
+            tarball, output_directory, pipeline=pipeline, timings=timings)
+        assert 'untar' in timings and 'convert' in timings
+        return [
+            (plot['name'], plot['captions'], plot['label'])
+            for plot in plots
+        ]
+
+    assert figures(True) == figures(False) == [
+        ('plot', ['A plot.'], 'fig:plot'),
+        ('figures_photo', ['A photo.'], 'fig:plot'),
+    ]
+
+
+def test_process_tarball_pipeline_without_tex(tmpdir):
+    tarball = str(tmpdir.join('paper.tar.gz'))
+    make_tarball(tarball, [('plot.png', b'\x89PNG\r\n\x1a\n')])
+
+    with pytest.raises(NoTexFilesFound):
+        process_tarball(tarball, str(tmpdir.join('out')), pipeline=True)
+
+
+def test_process_tarball_raises_the_conversion_error_before_uploads(tmpdir):
+    tarball = str(tmpdir.join('paper.tar.gz'))
+    make_tarball(tarball, [('plot.png', b'\x89PNG\r\n\x1a\n')])
+
+    def put(path, key):
+        raise IOError('no space left')
+
+    with pytest.raises(NoTexFilesFound):
+        process_tarball(tarball, str(tmpdir.join('out')), pipeline=True,
+                        sink=put)
+
+
+def test_process_tarball_uploads_rotated_images_again(tmpdir, monkeypatch):
+    tarball = str(tmpdir.join('paper.tar.gz'))
+    make_tarball(tarball, [
+        ('plot.png', b'\x89PNG\r\n\x1a\n'),
+        ('main.tex', MAIN_TEX.replace(
+            b'\\includegraphics{plot}', b'\\includegraphics[angle=90]{plot}')),
+    ])
+    output_directory = tmpdir.join('out')
+
+    def rotate_image(filename, line, sdir, image_list):
+        return filename == 'plot' and os.path.join(sdir, 'plot.png')
+    monkeypatch.setattr(extractor, 'rotate_image', rotate_image)
+    keys = []
+
+    def put(path, key):
+        keys.append(key)
+        return 'sink://' + key
+
+    plots = process_tarball(tarball, str(output_directory), sink=put)
+
+    assert [plot['url'] for plot in plots] == ['sink://plot.png']
+    assert keys == ['plot.png', 'plot.png']
+
+
+def test_run_pipeline_converts_from_the_tarball_bytes(tmpdir, monkeypatch):
+    eps = b'%!PS-Adobe-3.0 EPSF-3.0\n%%BoundingBox: 0 0 10 10\n'
+    tarball = str(tmpdir.join('paper.tar.gz'))
+    make_tarball(tarball, [
+        ('main.tex', MAIN_TEX),
+        ('plot.eps', eps),
+        ('slides.pdf', b'%PDF-1.4\n'),
+    ])
+    blobs = {}
+
+    def convert_image(from_file, to_file, image_format, blob=None, **kwargs):
+        blobs[from_file] = blob
+        open(to_file, 'w').close()
+    monkeypatch.setattr(converter, 'convert_image', convert_image)
+    output_directory = tmpdir.join('out')
+
+    image_mapping, tex_files = run_pipeline(
+        tarball, str(output_directory), keep_originals=False)
+
+    assert tex_files == [str(output_directory.join('main.tex'))]
+    assert image_mapping == {
+        str(output_directory.join('plot.png')):
+            str(output_directory.join('plot.eps')),
+        str(output_directory.join('slides.png')):
+            str(output_directory.join('slides.pdf')),
+    }
+    assert blobs == {
+        str(output_directory.join('plot.eps')): eps,
+        str(output_directory.join('slides.pdf')): None,
+    }
+    assert not output_directory.join('plot.eps').check()
+    assert output_directory.join('slides.pdf').check()
+
+
+def test_run_pipeline_converts_vector_images_for_their_size(
+        tmpdir, monkeypatch):
+    tarball = str(tmpdir.join('paper.tar.gz'))
+    make_tarball(tarball, [
+        ('plot.eps', b'%!PS-Adobe-3.0 EPSF-3.0\n%%BoundingBox: 0 0 72 36\n'),
+        ('photo.png', b'\x89PNG\r\n\x1a\n'),
+        ('main.tex', b'\\includegraphics[width=2in]{plot}\n'
+                     b'\\includegraphics[width=1in]{photo}\n'),
+    ])
+    display_sizes = {}
+
+    def convert_image(from_file, to_file, image_format, display_size=None,
+                      **kwargs):
+        display_sizes[os.path.basename(from_file)] = display_size
+        open(to_file, 'w').close()
+    monkeypatch.setattr(converter, 'convert_image', convert_image)
+    image_options = {}
+
+    run_pipeline(tarball, str(tmpdir.join('out')), image_options=image_options,
+                 keep_originals=False)
+
+    assert display_sizes == {'plot.eps': (144.0, 72.0)}
+    assert image_options[str(tmpdir.join('out', 'plot.eps'))] == {
+        'width': 144.0}
+
+
+def test_run_pipeline_converts_one_source_per_image(tmpdir, monkeypatch):
+    tarball = str(tmpdir.join('paper.tar.gz'))
+    make_tarball(tarball, [
+        ('plot.eps', b'%!PS-Adobe-3.0 EPSF-3.0\n%%BoundingBox: 0 0 72 36\n'),
+        ('plot.png', b'\x89PNG\r\n\x1a\n'),
+        ('fit.eps', b'%!PS-Adobe-3.0 EPSF-3.0\n%%BoundingBox: 0 0 72 36\n'),
+        ('fit.pdf', b'%PDF-1.4\n'),
+        ('main.tex', MAIN_TEX),
+    ])
+    converted = []
+
+    def convert_image(from_file, to_file, image_format, **kwargs):
+        converted.append(os.path.basename(from_file))
+        open(to_file, 'w').close()
+    monkeypatch.setattr(converter, 'convert_image', convert_image)
+    output_directory = tmpdir.join('out')
+
+    image_mapping, _ = run_pipeline(tarball, str(output_directory))
+
+    assert image_mapping == {
+        str(output_directory.join('plot.png')):
+            str(output_directory.join('plot.png')),
+        str(output_directory.join('fit.png')):
+            str(output_directory.join('fit.pdf')),
+    }
+    assert converted == ['fit.pdf']
+
+
+def test_run_pipeline_falls_back_when_the_raster_fails(tmpdir, monkeypatch):
+    oversized_png = b'\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR' + \
+        struct.pack('>II', 20000, 20000)
+    tarball = str(tmpdir.join('paper.tar.gz'))
+    make_tarball(tarball, [
+        ('plot.png', oversized_png),
+        ('plot.eps', b'%!PS-Adobe-3.0 EPSF-3.0\n%%BoundingBox: 0 0 72 36\n'),
+        ('main.tex', MAIN_TEX),
+    ])
+    converted = []
+
+    def convert_image(from_file, to_file, image_format, **kwargs):
+        converted.append(os.path.basename(from_file))
+        open(to_file, 'w').close()
+    monkeypatch.setattr(converter, 'convert_image', convert_image)
+    output_directory = tmpdir.join('out')
+
+    image_mapping, _ = run_pipeline(
+        tarball, str(output_directory), postprocess=['trim'])
+
+    assert image_mapping == {
+        str(output_directory.join('plot.png')):
+            str(output_directory.join('plot.eps')),
+    }
+    assert converted == ['plot.eps']
+
+
+@pytest.mark.parametrize('keep_originals', [True, False])
+def test_run_pipeline_converts_vector_images_once_their_tex_is_read(
+        tmpdir, monkeypatch, keep_originals):
+    tarball = str(tmpdir.join('paper.tar.gz'))
+    make_tarball(tarball, [
+        ('main.tex', b'\\includegraphics[width=2in]{plot}\n'),
+        ('plot.eps', b'%!PS-Adobe-3.0 EPSF-3.0\n%%BoundingBox: 0 0 72 36\n'),
+        ('notes.txt', b'The end.\n'),
+    ])
+    converted = threading.Event()
+    converted_before_the_end = []
+
+    def convert_image(from_file, to_file, image_format, **kwargs):
+        open(to_file, 'w').close()
+        converted.set()
+    monkeypatch.setattr(converter, 'convert_image', convert_image)
+
+    def iter_archive_members(tarball):
+        for member in converter.iter_archive_members(tarball):
+            if member.name == 'notes.txt':
+                converted_before_the_end.append(converted.wait(5))
+            yield member
+    monkeypatch.setattr(pipeline, 'iter_archive_members', iter_archive_members)
+    output_directory = tmpdir.join('out')
+
+    image_mapping, _ = run_pipeline(
+        tarball, str(output_directory), keep_originals=keep_originals)
+
+    assert converted_before_the_end == [True]
+    assert image_mapping == {
+        str(output_directory.join('plot.png')):
+            str(output_directory.join('plot.eps')),
+    }
+
+
+def test_run_pipeline_converts_again_when_a_better_source_turns_up(
+        tmpdir, monkeypatch):
+    tarball = str(tmpdir.join('paper.tar.gz'))
+    make_tarball(tarball, [
+        ('main.tex', b'\\includegraphics[width=2in]{plot}\n'
+                     b'\\includegraphics[width=2in]{fit}\n'),
+        ('plot.eps', b'%!PS-Adobe-3.0 EPSF-3.0\n%%BoundingBox: 0 0 72 36\n'),
+        ('plot.pdf', b'%PDF-1.4\n'),
+        ('fit.eps', b'%!PS-Adobe-3.0 EPSF-3.0\n%%BoundingBox: 0 0 72 36\n'),
+        ('fit.png', b'\x89PNG\r\n\x1a\n'),
+    ])
+    converted = []
+    eps_converted = {'plot': threading.Event(), 'fit': threading.Event()}
+
+    def convert_image(from_file, to_file, image_format, **kwargs):
+        converted.append(os.path.basename(from_file))
+        with open(to_file, 'w') as f:
+            f.write(from_file)
+        if from_file.endswith('.eps'):
+            eps_converted[os.path.basename(from_file)[:-4]].set()
+    monkeypatch.setattr(converter, 'convert_image', convert_image)
+
+    def iter_archive_members(tarball):
+        # the better sources only turn up once the EPS are converted
+        for member in converter.iter_archive_members(tarball):
+            if member.name in ('plot.pdf', 'fit.png'):
+                eps_converted[member.name[:-4]].wait(5)
+            yield member
+    monkeypatch.setattr(pipeline, 'iter_archive_members', iter_archive_members)
+    output_directory = tmpdir.join('out')
+
+    image_mapping, _ = run_pipeline(tarball, str(output_directory))
+
+    assert image_mapping == {
+        str(output_directory.join('plot.png')):
+            str(output_directory.join('plot.pdf')),
+        str(output_directory.join('fit.png')):
+            str(output_directory.join('fit.png')),
+    }
+    assert sorted(converted) == ['fit.eps', 'plot.eps', 'plot.pdf']
+    assert output_directory.join('plot.png').read() == \
+        str(output_directory.join('plot.pdf'))
+    assert output_directory.join('fit.png').read_binary() == \
+        b'\x89PNG\r\n\x1a\n'
+
+
+def test_stage_drains_after_an_error_and_raises_it():
+    processed = []
+    lock = threading.Lock()
+
+    def process(item):
+        if item == 2:
+            raise ValueError(item)
+        with lock:
+            processed.append(item)
+    stage = Stage(process, workers=2, queue_size=1)
+
+    for item in range(20):
+        stage.put(item)
+    with pytest.raises(ValueError):
+        stage.close()
+    assert 2 not in processed
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of plotextractor.
+# Copyright (C) 2015, 2016, 2020 CERN.
+#
+# plotextractor is free software; you can redistribute it
+# and/or modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# plotextractor is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with plotextractor; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+# MA 02111-1307, USA.
+#
+# In applying this license, CERN does not
+# waive the privileges and immunities granted to it by virtue of its status
+# as an Intergovernmental Organization or submit itself to any jurisdiction.
+
+
+import pytest
+
+numpy = pytest.importorskip('numpy')
+
+from plotextractor.postprocess import postprocess_pixels  # noqa: E402
+
+
+def _white_rgba(height, width):
+    return numpy.full((height, width, 4), 255, dtype=numpy.uint8)
+
+
+def test_postprocess_pixels_trims_borders():
+    pixels = _white_rgba(10, 20)
+    pixels[2:5, 3:9, :3] = 0
+
+    trimmed, info = postprocess_pixels(pixels, ['trim'])
+
+    assert trimmed.shape == (3, 6, 4)
+    assert info['bbox'] == (3, 2, 6, 3)
+    assert (info['width'], info['height']) == (6, 3)
+
+
+def test_postprocess_pixels_flattens_transparency_on_white():
+    pixels = numpy.zeros((2, 2, 4), dtype=numpy.uint8)
+    pixels[0, 0] = (0, 0, 0, 255)
+
+    flattened, info = postprocess_pixels(pixels, ['flatten'])
+
+    assert flattened.shape == (2, 2, 3)
+    assert flattened[0, 0].tolist() == [0, 0, 0]
+    assert flattened[1, 1].tolist() == [255, 255, 255]
+    assert info['bbox'] == (0, 0, 2, 2)
+
+
+def test_postprocess_pixels_detects_grayscale():
+    pixels = _white_rgba(4, 4)
+    pixels[1, 1, :3] = 100
+
+    gray, info = postprocess_pixels(pixels, ['flatten', 'grayscale'])
+
+    assert info['grayscale']
+    assert gray.shape == (4, 4, 1)
+
+    pixels[1, 1, :3] = (255, 0, 0)
+    color, info = postprocess_pixels(pixels, ['flatten', 'grayscale'])
+
+    assert not info['grayscale']
+    assert color.shape == (4, 4, 3)
+
+
+def test_postprocess_pixels_rejects_unknown_operations():
+    with pytest.raises(ValueError):
+        postprocess_pixels(_white_rgba(1, 1), ['sharpen'])
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of plotextractor.
+# Copyright (C) 2020 CERN.
+#
+# plotextractor is free software; you can redistribute it
+# and/or modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# plotextractor is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with plotextractor; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+# MA 02111-1307, USA.
+#
+# In applying this license, CERN does not
+# waive the privileges and immunities granted to it by virtue of its status
+# as an Intergovernmental Organization or submit itself to any jurisdiction.
+
+
+import pstats
+
+import pytest
+
+from plotextractor.pipeline import Stage
+from plotextractor.profiling import profiled
+from plotextractor.sinks import Uploader
+
+
+def test_profiled_keeps_slow_profiles(tmpdir):
+    with profiled('/data/1234.tar.gz', str(tmpdir), threshold=0):
+        sorted(range(1000))
+
+    stats = pstats.Stats(str(tmpdir.join('1234.tar.gz.prof')))
+    assert stats.total_calls > 0
+
+
+def test_profiled_includes_the_pipeline_and_upload_threads(tmpdir):
+    def convert_in_thread(item):
+        sorted(range(1000))
+
+    def upload_in_thread(path, key):
+        return key
+
+    def submit_in_thread(item):
+        convert_in_thread(item)
+        uploader.submit(str(tmpdir.join('{0}.png'.format(item))))
+
+    uploader = Uploader(upload_in_thread, str(tmpdir))
+    with profiled('/data/1234.tar.gz', str(tmpdir), threshold=0):
+        stage = Stage(submit_in_thread, workers=2)
+        stage.put(1)
+        stage.put(2)
+        stage.close()
+        uploader.wait()
+
+    stats = pstats.Stats(str(tmpdir.join('1234.tar.gz.prof')))
+    calls = dict((function[2], counts[1])
+                 for function, counts in stats.stats.items())
+    assert calls['convert_in_thread'] == 2
+    assert calls['upload_in_thread'] == 2
+
+
+def test_profiled_drops_fast_profiles(tmpdir):
+    with profiled('/data/1234.tar.gz', str(tmpdir), threshold=60):
+        pass
+
+    assert tmpdir.listdir() == []
+
+
+def test_profiled_keeps_profile_of_failures(tmpdir):
+    with pytest.raises(ValueError):
+        with profiled('/data/1234.tar.gz', str(tmpdir), threshold=60):
+            raise ValueError
+
+    assert tmpdir.join('1234.tar.gz.prof').check()
+
+
+def test_profiled_rejects_unknown_profiler(tmpdir):
+    with pytest.raises(ValueError):
+        with profiled('/data/1234.tar.gz', str(tmpdir), threshold=0,
+                      profiler='yappi'):
+            pass
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of plotextractor.
+# Copyright (C) 2015, 2016, 2020 CERN.
+#
+# plotextractor is free software; you can redistribute it
+# and/or modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# plotextractor is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with plotextractor; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+# MA 02111-1307, USA.
+#
+# In applying this license, CERN does not
+# waive the privileges and immunities granted to it by virtue of its status
+# as an Intergovernmental Organization or submit itself to any jurisdiction.
+
+
+from plotextractor.resources import ResourceGovernor
+
+
+def test_worker_limits_divide_budget_between_workers():
+    governor = ResourceGovernor(
+        budget={'memory': 8 * 1024 ** 3, 'thread': 16}, workers=4)
+
+    worker_limits = governor.worker_limits()
+
+    assert worker_limits['memory'] == 2 * 1024 ** 3
+    assert worker_limits['thread'] == 4
+    assert 'disk' not in worker_limits
+
+
+def test_process_limits_account_for_concurrent_conversions():
+    governor = ResourceGovernor(
+        budget={'memory': 8 * 1024 ** 3, 'thread': 16},
+        workers=4,
+        concurrency=2,
+    )
+
+    process_limits = governor.process_limits()
+
+    assert process_limits['memory'] == 4 * 1024 ** 3
+    assert process_limits['thread'] == 4
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of plotextractor.
+# Copyright (C) 2015, 2016, 2020 CERN.
+#
+# plotextractor is free software; you can redistribute it
+# and/or modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# plotextractor is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with plotextractor; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+# MA 02111-1307, USA.
+#
+# In applying this license, CERN does not
+# waive the privileges and immunities granted to it by virtue of its status
+# as an Intergovernmental Organization or submit itself to any jurisdiction.
+
+
+import json
+import os
+import threading
+
+import pytest
+from six.moves.urllib.error import HTTPError
+from six.moves.urllib.request import Request, urlopen
+
+from plotextractor.service import ExtractionServer, ExtractionService
+
+
+@pytest.fixture
+def service_url():
+    service = ExtractionService(workers=1, timeout=60)
+    server = ExtractionServer(('127.0.0.1', 0), service)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        yield 'http://127.0.0.1:{0}'.format(server.server_address[1])
+    finally:
+        server.shutdown()
+        server.server_close()
+        service.close()
+
+
+def _post(url, body):
+    request = Request(url, data=json.dumps(body).encode('utf-8'),
+                      headers={'Content-Type': 'application/json'})
+    return json.loads(urlopen(request).read().decode('utf-8'))
+
+
+def test_service_extracts_tarball(service_url, tmpdir):
+    tarball = tmpdir.join('broken.tar.gz')
+    tarball.write('not a tarball')
+
+    record = _post(service_url + '/extract', {'tarball': str(tarball)})
+
+    assert record['tarball'] == str(tarball)
+    assert record['error']['type'] == 'InvalidTarball'
+
+    metrics = json.loads(
+        urlopen(service_url + '/metrics').read().decode('utf-8'))
+    assert metrics['completed'] == 1
+    assert metrics['failed'] == 1
+    assert metrics['pending'] == 0
+
+
+def test_service_health(service_url):
+    health = json.loads(
+        urlopen(service_url + '/health').read().decode('utf-8'))
+
+    assert health == {'status': 'ok'}
+
+
+def test_service_rejects_bad_requests(service_url):
+    with pytest.raises(HTTPError) as excinfo:
+        _post(service_url + '/extract', {'tar': 'ball'})
+
+    assert excinfo.value.code == 400
+
+
+def test_service_rejects_when_queue_is_full(tmpdir):
+    service = ExtractionService(workers=1, max_pending=1)
+    try:
+        service._slots.acquire()
+
+        status, body = service.extract(str(tmpdir.join('a.tar.gz')), {})
+
+        assert status == 503
+        assert service.metrics()['rejected'] == 1
+    finally:
+        service.close()
+
+
+def test_service_replaces_a_worker_that_timed_out(tmpdir):
+    hanging = tmpdir.join('hanging.tar.gz')
+    os.mkfifo(str(hanging))  # reading it blocks until a writer shows up
+    broken = tmpdir.join('broken.tar.gz')
+    broken.write('not a tarball')
+    service = ExtractionService(workers=1, max_pending=1, timeout=2)
+    try:
+        status, body = service.extract(str(hanging), {})
+
+        assert status == 504
+        assert service.metrics()['timeouts'] == 1
+        assert service.metrics()['pending'] == 0
+
+        status, record = service.extract(str(broken), {})
+
+        assert status == 200
+        assert record['error']['type'] == 'InvalidTarball'
+    finally:
+        service.close()
+
+
+def test_service_replaces_spent_workers(tmpdir):
+    broken = tmpdir.join('broken.tar.gz')
+    broken.write('not a tarball')
+    service = ExtractionService(workers=1, max_tasks_per_worker=1)
+    try:
+        pids = set()
+        for _ in range(2):
+            worker = service._idle_workers.queue[0]
+            pids.add(worker.process.pid)
+            status, record = service.extract(str(broken), {})
+            assert status == 200
+
+        assert len(pids) == 2
+        assert service.metrics()['completed'] == 2
+    finally:
+        service.close()
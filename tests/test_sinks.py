@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of plotextractor.
+# Copyright (C) 2020 CERN.
+#
+# plotextractor is free software; you can redistribute it
+# and/or modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# plotextractor is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with plotextractor; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+# MA 02111-1307, USA.
+#
+# In applying this license, CERN does not
+# waive the privileges and immunities granted to it by virtue of its status
+# as an Intergovernmental Organization or submit itself to any jurisdiction.
+
+
+import threading
+import time
+
+import pytest
+
+from plotextractor import sinks
+from plotextractor.sinks import LocalSink, S3Sink, Uploader, get_sink
+
+
+class FakeS3Client(object):
+
+    def __init__(self):
+        self.uploads = []
+
+    def upload_file(self, path, bucket, key, ExtraArgs=None):
+        self.uploads.append((path, bucket, key, ExtraArgs))
+
+
+def test_local_sink_copies_to_its_directory(tmpdir):
+    image = tmpdir.join('work', 'figs', 'plot.png')
+    image.ensure().write('png')
+    sink = LocalSink(str(tmpdir.join('public')))
+
+    url = sink.put(str(image), 'figs/plot.png')
+
+    assert url == str(tmpdir.join('public', 'figs', 'plot.png'))
+    assert tmpdir.join('public', 'figs', 'plot.png').read() == 'png'
+    assert LocalSink().put(str(image), 'figs/plot.png') == str(image)
+
+
+def test_s3_sink_uploads_under_its_prefix():
+    client = FakeS3Client()
+    sink = S3Sink(client, 'figures', prefix='1508.03176')
+
+    url = sink.put('/work/figs/plot.png', 'figs/plot.png')
+
+    assert url == 's3://figures/1508.03176/figs/plot.png'
+    assert client.uploads == [(
+        '/work/figs/plot.png', 'figures', '1508.03176/figs/plot.png',
+        {'ContentType': 'image/png'},
+    )]
+
+
+def test_get_sink_wraps_callables():
+    sink = get_sink(lambda path, key: 'https://example.org/' + key)
+
+    assert sink.put('/work/a.png', 'a.png') == 'https://example.org/a.png'
+    with pytest.raises(TypeError):
+        get_sink('/tmp')
+
+
+def test_uploader_bounds_the_concurrent_uploads(tmpdir):
+    lock = threading.Lock()
+    running = []
+    most_running = []
+
+    def put(path, key):
+        with lock:
+            running.append(key)
+            most_running.append(len(running))
+        time.sleep(0.01)
+        with lock:
+            running.remove(key)
+        return 'sink://' + key
+
+    uploader = Uploader(put, str(tmpdir), workers=2)
+    paths = [str(tmpdir.join('figs', '{0}.png'.format(index)))
+             for index in range(8)]
+    for path in paths:
+        uploader.submit(path)
+
+    urls = uploader.wait()
+
+    assert urls == dict(
+        (path, 'sink://figs/{0}.png'.format(index))
+        for index, path in enumerate(paths))
+    assert max(most_running) == 2
+
+
+def test_uploader_takes_images_from_several_threads(tmpdir, monkeypatch):
+    stages = []
+
+    class SlowStage(sinks.Stage):
+        def __init__(self, *args, **kwargs):
+            # long enough for the other threads to miss the stage
+            time.sleep(0.05)
+            stages.append(self)
+            super(SlowStage, self).__init__(*args, **kwargs)
+    monkeypatch.setattr(sinks, 'Stage', SlowStage)
+    uploader = Uploader(lambda path, key: 'sink://' + key, str(tmpdir))
+    paths = [str(tmpdir.join('{0}.png'.format(index))) for index in range(8)]
+    start = threading.Event()
+
+    def submit(path):
+        start.wait()
+        uploader.submit(path)
+    threads = [threading.Thread(target=submit, args=(path,))
+               for path in paths]
+    for thread in threads:
+        thread.start()
+    start.set()
+    for thread in threads:
+        thread.join()
+
+    assert sorted(uploader.wait()) == sorted(paths)
+    assert len(stages) == 1
+
+
+def test_uploader_raises_the_errors_of_the_sink(tmpdir):
+    def put(path, key):
+        raise IOError('no space left')
+
+    uploader = Uploader(put, str(tmpdir))
+    uploader.submit(str(tmpdir.join('a.png')))
+
+    with pytest.raises(IOError):
+        uploader.wait()
+    assert uploader.wait() == {}
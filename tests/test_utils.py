@@ -23,6 +23,8 @@
 # as an Intergovernmental Organization or submit itself to any jurisdiction.
 
 
+import os
+
 import six
 import plotextractor
 
@@ -87,3 +89,178 @@ def test_get_image_location_includegraphics(tmpdir):
         six.text_type(tmpdir),
         image_list
     )
+
+
+def test_get_image_location_kept_jpeg_without_extension(tmpdir):
+    path = six.text_type(tmpdir.join("photo.jpg"))
+    image_list = [path]
+
+    assert path == plotextractor.output_utils.get_image_location(
+        "photo",
+        six.text_type(tmpdir),
+        image_list
+    )
+
+
+def test_get_image_location_vector_output(tmpdir):
+    image_list = [str(tmpdir.join('figs', 'plot.svg'))]
+
+    assert plotextractor.output_utils.get_image_location(
+        'figs/plot.eps', str(tmpdir), image_list) == image_list[0]
+
+
+def test_get_image_location_vector_output_in_subfolder(tmpdir):
+    tmpdir.mkdir('images').join('plot.svg').write('')
+    image_list = [str(tmpdir.join('images', 'plot.svg'))]
+
+    assert plotextractor.output_utils.get_image_location(
+        'plot.eps', str(tmpdir), image_list) == image_list[0]
+
+
+def test_get_image_location_prefers_the_name_in_the_tex(tmpdir):
+    png = six.text_type(tmpdir.join("photo.png"))
+    jpeg = six.text_type(tmpdir.join("photo.jpg"))
+    image_list = [png, jpeg]
+
+    assert jpeg == plotextractor.output_utils.get_image_location(
+        "photo.jpg",
+        six.text_type(tmpdir),
+        image_list
+    )
+    assert png == plotextractor.output_utils.get_image_location(
+        "photo",
+        six.text_type(tmpdir),
+        image_list
+    )
+
+
+def test_get_image_location_pieces_of_unresolved_names(tmpdir):
+    path = six.text_type(tmpdir.join("plot.png"))
+    image_list = [path]
+
+    assert path == plotextractor.output_utils.get_image_location(
+        "width=0.5 plot.eps",
+        six.text_type(tmpdir),
+        image_list
+    )
+
+
+def test_image_locator_scans_every_directory_once(tmpdir, monkeypatch):
+    sdir = tmpdir.mkdir('paper').mkdir('files')
+    sdir.mkdir('sub').join('loose.png').write('')
+    listed = []
+    listdir = os.listdir
+
+    def counting_listdir(path):
+        listed.append(path)
+        return listdir(path)
+    monkeypatch.setattr(os, 'listdir', counting_listdir)
+    locator = plotextractor.output_utils.ImageLocator(
+        six.text_type(sdir), [])
+
+    for _ in range(3):
+        assert locator.locate('loose') == os.path.join(
+            six.text_type(sdir.join('sub')), 'loose.png')
+        assert locator.locate('a b,c=d e,f missing') is None
+
+    assert len(listed) == len(set(listed)) == 4
+
+
+def test_image_locator_bounds_the_pieces_tried(tmpdir, monkeypatch):
+    locator = plotextractor.output_utils.ImageLocator(
+        six.text_type(tmpdir), [], max_pieces=5)
+    locate = locator.locate
+    tried = []
+
+    def counting_locate(image, recurred=False):
+        tried.append(image)
+        return locate(image, recurred)
+    monkeypatch.setattr(locator, 'locate', counting_locate)
+
+    assert locator._locate(' '.join(['x%d' % i for i in range(50)]),
+                           recurred=False) is None
+    assert len(tried) == 5
+
+
+def test_find_open_and_close_braces_nested_over_lines():
+    lines = ['\\caption{A {nested', 'caption} here} after']
+
+    assert plotextractor.output_utils.find_open_and_close_braces(
+        0, 0, '{', lines) == (8, 0, 13, 1)
+
+
+def test_find_open_and_close_braces_ignores_escaped_and_commented():
+    lines = ['\\label{a\\{b} % {', '}']
+
+    assert plotextractor.output_utils.find_open_and_close_braces(
+        0, 0, '{', lines) == (6, 0, 11, 0)
+
+
+def test_find_open_and_close_braces_hanging_and_missing():
+    lines = ['\\caption{never closed', 'no braces']
+
+    assert plotextractor.output_utils.find_open_and_close_braces(
+        0, 0, '{', lines) == (8, 0, 8, 0)
+    assert plotextractor.output_utils.find_open_and_close_braces(
+        1, 0, '{', lines) == (0, 1, 0, 1)
+    assert plotextractor.output_utils.find_open_and_close_braces(
+        0, 0, '<', lines) == (-1, -1, -1, -1)
+
+
+def test_brace_matcher_finds_several_pairs():
+    lines = ['\\subfigure[a [b]]{x}', '[c]']
+    brace_matcher = plotextractor.output_utils.BraceMatcher(lines)
+
+    assert brace_matcher.find(0, 0, '[') == (10, 0, 16, 0)
+    assert brace_matcher.find(0, 0, '{') == (17, 0, 19, 0)
+    assert brace_matcher.find(0, 17, ']') == (0, 1, 2, 1)
+
+
+def make_extracted_files(tmpdir):
+    working_directory = tmpdir.mkdir('work')
+    for name in ('main.tex', 'styles/a.sty', 'figs/plot.eps',
+                 'figs/plot.png', 'figs/photo.jpg'):
+        working_directory.join(name).ensure().write('')
+    figures = [
+        {
+            'url': str(working_directory.join('figs/plot.png')),
+            'original_url': str(working_directory.join('figs/plot.eps')),
+        },
+        {
+            'url': str(working_directory.join('figs/photo.jpg')),
+            'original_url': str(working_directory.join('figs/photo.jpg')),
+        },
+    ]
+    return working_directory, figures
+
+
+def list_files(directory):
+    return sorted(
+        path.relto(directory) for path in directory.visit() if path.isfile())
+
+
+def test_keep_figure_files_in_place(tmpdir):
+    working_directory, figures = make_extracted_files(tmpdir)
+
+    plotextractor.output_utils.keep_figure_files(
+        figures, str(working_directory))
+
+    assert list_files(working_directory) == ['figs/photo.jpg', 'figs/plot.png']
+    assert not working_directory.join('styles').check()
+
+
+def test_keep_figure_files_moves_them_with_originals(tmpdir):
+    working_directory, figures = make_extracted_files(tmpdir)
+    output_directory = tmpdir.join('output')
+
+    plotextractor.output_utils.keep_figure_files(
+        figures, str(working_directory), str(output_directory),
+        originals=True)
+
+    assert not working_directory.check()
+    assert list_files(output_directory) == [
+        'figs/photo.jpg', 'figs/plot.eps', 'figs/plot.png']
+    assert figures[0] == {
+        'url': str(output_directory.join('figs/plot.png')),
+        'original_url': str(output_directory.join('figs/plot.eps')),
+    }